@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+
+"""Helpers to store expensive to compute results on disk so that they can
+be reused across script runs and processes. Everything lives under the
+``cache`` directory inside the processed data directory and can be safely
+deleted at any time."""
+
+# standard library
+import os
+import sys
+import errno
+import fcntl
+import shutil
+import hashlib
+import pickle
+import tempfile
+import importlib
+import subprocess
+
+# external
+import numpy as np
+
+# local
+import utils
+
+PATHS = utils.config_paths()
+
+
+def cache_dir(*sub_dirs):
+    """Returns the absolute path to a directory inside the cache, creating
+    it if it does not exist.
+
+    Parameters
+    ==========
+    sub_dirs : strings
+        Optional names of nested directories inside the cache directory.
+
+    """
+
+    path = os.path.join(PATHS['processed_data_dir'], 'cache', *sub_dirs)
+
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        # Another process may have created the directory in the meantime.
+        if e.errno != errno.EEXIST:
+            raise
+
+    return path
+
+
+def hash_items(*items):
+    """Returns the hexadecimal SHA1 digest of the provided items. Items that
+    are not byte strings are converted to text before hashing.
+
+    """
+
+    h = hashlib.sha1()
+
+    for item in items:
+        if not isinstance(item, bytes):
+            item = str(item).encode('utf-8')
+        h.update(item)
+        # Separate the items so that ('ab', 'c') and ('a', 'bc') differ.
+        h.update(b'\0')
+
+    return h.hexdigest()
+
+
+def hash_file(path):
+    """Returns the hexadecimal SHA1 digest of the contents of a file."""
+
+    with open(path, 'rb') as f:
+        return hash_items(f.read())
+
+
+def dump(obj, path):
+    """Pickles an object to the provided path. The object is first written
+    to a temporary file in the same directory which is then renamed, so
+    concurrent readers never see a partially written file.
+
+    """
+
+    directory = os.path.dirname(path)
+
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(obj, f, protocol=2)
+        os.rename(tmp_path, path)
+    except:
+        os.remove(tmp_path)
+        raise
+
+
+def load(path):
+    """Returns the unpickled object stored at path or None if the file does
+    not exist or can not be read."""
+
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except (IOError, OSError, EOFError, pickle.UnpicklingError):
+        return None
+
+
+def extension_name(prefix, *items):
+    """Returns a module name that is unique to the provided items and the
+    Python and NumPy versions, e.g. the source code of an extension.
+
+    Parameters
+    ==========
+    prefix : string
+        A valid Python identifier to start the module name with.
+    items : strings
+        The items that define the content of the module.
+
+    """
+
+    key = hash_items(sys.version, np.__version__, *items)
+
+    return '{}_{}'.format(prefix, key[:16])
+
+
+def extension_module(name, sources):
+    """Returns the compiled extension module with the provided name. The
+    module is compiled and stored in the cache the first time it is
+    requested and simply imported from the cache afterwards.
+
+    Parameters
+    ==========
+    name : string
+        The name of the extension module, typically generated with
+        extension_name() so that it is unique to the content of the sources.
+    sources : dictionary or callable
+        Maps file names to the text of the files needed to build the
+        extension. It must contain a 'setup.py' file that builds the module
+        in place. If a function that returns the dictionary is given, it is
+        only called when the module has to be compiled.
+
+    Notes
+    =====
+    This is safe to call from many processes at once. An exclusive file lock
+    ensures that only one process compiles the module while the others wait
+    for it to finish and then import the result.
+
+    """
+
+    ext_dir = cache_dir('extensions')
+    module_dir = os.path.join(ext_dir, name)
+
+    if not os.path.isdir(module_dir):
+        with open(os.path.join(ext_dir, name + '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                # Another process may have compiled it while we waited.
+                if not os.path.isdir(module_dir):
+                    if callable(sources):
+                        sources = sources()
+                    _build_extension(module_dir, sources)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    return _import_extension(module_dir, name)
+
+
+def _build_extension(module_dir, sources):
+    """Compiles the sources in a temporary directory which is renamed to
+    module_dir once the build has succeeded."""
+
+    build_dir = tempfile.mkdtemp(dir=os.path.dirname(module_dir),
+                                 prefix='build-')
+
+    try:
+        for file_name, text in sources.items():
+            with open(os.path.join(build_dir, file_name), 'w') as f:
+                f.write(text)
+
+        cmd = [sys.executable, 'setup.py', 'build_ext', '--inplace']
+        try:
+            subprocess.check_output(cmd, cwd=build_dir,
+                                    stderr=subprocess.STDOUT)
+        except subprocess.CalledProcessError as e:
+            raise Exception('Failed to compile {}:\n{}'.format(
+                os.path.basename(module_dir), e.output.decode()))
+
+        shutil.rmtree(os.path.join(build_dir, 'build'), ignore_errors=True)
+
+        os.rename(build_dir, module_dir)
+    except:
+        shutil.rmtree(build_dir, ignore_errors=True)
+        raise
+
+
+def _import_extension(module_dir, name):
+
+    if name in sys.modules:
+        return sys.modules[name]
+
+    sys.path.insert(0, module_dir)
+    try:
+        return importlib.import_module(name)
+    finally:
+        sys.path.remove(module_dir)
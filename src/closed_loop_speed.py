@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+
+"""This compares the speed of integrating the closed loop equations of
+motion when the controller and the input interpolation are evaluated in
+Python (closed_loop_ode_func) to when everything is evaluated in a single
+compiled call (native_closed_loop_ode_func)."""
+
+import numpy as np
+from scipy.integrate import odeint
+
+from model import QuietStandingModel
+from measured_data import DataGenerator
+from utils import timeit
+
+num_nodes = 4001
+duration = 20.0
+
+ref_noise_std = 0.03
+platform_pos_mag = 0.01
+
+num_runs = 10
+
+model = QuietStandingModel(scaled_gains=0.5 * np.ones((2, 4)))
+model.derive()
+
+data = DataGenerator(duration, num_nodes, ref_noise_std, platform_pos_mag,
+                     model=model)
+
+native_rhs = model.native_closed_loop_ode_func(data.time, data.ref_noise,
+                                               data.actual['a'])
+gains = model.closed_loop_gains()
+
+
+@timeit
+def run_python():
+    for i in range(num_runs):
+        x = odeint(data.rhs, np.zeros(4), data.time, args=(data.r, data.p))
+    return x
+
+
+@timeit
+def run_native():
+    for i in range(num_runs):
+        x = odeint(native_rhs, np.zeros(4), data.time, args=(gains,))
+    return x
+
+
+if __name__ == "__main__":
+
+    python_x, python_time = run_python()
+    native_x, native_time = run_native()
+
+    # The results only differ within the integration tolerances.
+    np.testing.assert_allclose(python_x, native_x, atol=1e-5)
+
+    print('Python controller: {:1.3f} s per simulation'.format(
+        python_time / num_runs))
+    print('Native controller: {:1.3f} s per simulation'.format(
+        native_time / num_runs))
+    print('Speed up: {:1.1f}'.format(python_time / native_time))
@@ -0,0 +1,446 @@
+#!/usr/bin/env python
+
+"""This module generates compiled functions from the symbolic equations of
+motion. The compiled extensions are stored in the on disk cache (see
+cache.py) so that identical functions are only ever compiled once, even when
+many processes request them at the same time."""
+
+import os
+
+import sympy as sy
+import pydy
+from pydy.codegen.cython_code import CythonMatrixGenerator
+from pydy.codegen.ode_function_generator import CythonODEFunctionGenerator
+
+import cache
+
+SRC_DIR = os.path.dirname(os.path.realpath(__file__))
+
+_c_header_template = """\
+void {name}({args});
+"""
+
+_c_source_template = """\
+#include <math.h>
+
+void {name}({args})
+{{
+{body}
+}}
+"""
+
+_closed_loop_setup_template = """\
+#!/usr/bin/env python
+
+from distutils.core import setup
+from distutils.extension import Extension
+
+from Cython.Build import cythonize
+import numpy
+
+extension = Extension(name="{prefix}",
+                      sources=["{prefix}.pyx", "{prefix}_c.c"],
+                      include_dirs=[numpy.get_include(), "{src_dir}"])
+
+setup(name="{prefix}",
+      ext_modules=cythonize([extension], include_path=["{src_dir}"]))
+"""
+
+_closed_loop_pyx_template = """\
+import numpy as np
+cimport numpy as np
+cimport cython
+
+from fast_interpolate cimport Interpolator
+
+cdef extern from "{prefix}_c.h":
+    void open_loop_rhs(double* states, double* specifieds,
+                       double* constants, double* output)
+    void open_loop_jacobians(double* states, double* specifieds,
+                             double* constants, double* output)
+
+
+cdef class ClosedLoopODEFunction:
+    \"\"\"Evaluates the right hand side of the closed loop ODEs, f(x, t, g),
+    where g are the {num_gains} flattened controller gains. The reference
+    noise and the platform acceleration are interpolated from the provided
+    interpolator, whose m = {num_signals} columns are [reference noise,
+    acceleration].\"\"\"
+
+    cdef Interpolator interpolator
+    # Each function has its own search cursor so that many functions, e.g.
+    # in different threads, can share one interpolator.
+    cdef int cursor
+    cdef double[::1] constants
+    cdef double[::1] signals
+    cdef double[::1] specifieds
+    # [df/dx, df/dT] flattened in row major order
+    cdef double[::1] partials
+    # The closed loop state Jacobian flattened in row major order
+    cdef double[::1] closed_loop_partials
+
+    def __init__(self, Interpolator interpolator,
+                 np.ndarray[np.double_t, ndim=1, mode='c'] constants):
+
+        self.interpolator = interpolator
+        self.cursor = 0
+        self.constants = constants.copy()
+        self.signals = np.empty({num_signals}, dtype=float)
+        self.specifieds = np.empty({num_inputs} + 1, dtype=float)
+        self.partials = np.empty({num_states} * {num_states} +
+                                 {num_states} * {num_inputs}, dtype=float)
+        self.closed_loop_partials = np.empty({num_states} * {num_states},
+                                             dtype=float)
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef void _evaluate_specifieds(self, double[::1] x, double t,
+                                   double[::1] gains):
+
+        cdef int i, j
+        cdef double torque
+
+        self.interpolator._interpolate_at(t, &self.signals[0], &self.cursor)
+
+        # r = [a, T_a, T_h]
+        self.specifieds[0] = self.signals[{num_states}]
+
+        # T = (S .* K) * (x_ref - x)
+        for i in range({num_inputs}):
+            torque = 0.0
+            for j in range({num_states}):
+                torque += (gains[i * {num_states} + j] *
+                           (self.signals[j] - x[j]))
+            self.specifieds[i + 1] = torque
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def __call__(self, double[::1] x, double t, double[::1] gains):
+
+        cdef np.ndarray[np.double_t, ndim=1, mode='c'] xdot
+        xdot = np.empty({num_states}, dtype=float)
+
+        self._evaluate_specifieds(x, t, gains)
+
+        open_loop_rhs(&x[0], &self.specifieds[0], &self.constants[0],
+                      <double*> xdot.data)
+
+        return xdot
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def evaluate_many(self, double[:, ::1] x, double t,
+                      double[:, ::1] gains):
+        \"\"\"Returns f(x, t, g) for each row of the states, shape(n,
+        {num_states}), with the gains in the same row of gains, shape(n,
+        {num_gains}), e.g. to simulate many candidate gains at once.\"\"\"
+
+        cdef int k
+        cdef int n = x.shape[0]
+
+        cdef np.ndarray[np.double_t, ndim=2, mode='c'] xdot
+        xdot = np.empty((n, {num_states}), dtype=float)
+
+        for k in range(n):
+            self._evaluate_specifieds(x[k], t, gains[k])
+            open_loop_rhs(&x[k, 0], &self.specifieds[0], &self.constants[0],
+                          <double*> xdot.data + k * {num_states})
+
+        return xdot
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def jacobian(self, double[::1] x, double t, double[::1] gains):
+        \"\"\"Returns the Jacobian of f(x, t, g) with respect to the states,
+        J[i, j] = df_i / dx_j, in the form expected by the Dfun argument of
+        scipy.integrate.odeint.\"\"\"
+
+        cdef np.ndarray[np.double_t, ndim=2, mode='c'] jac
+        jac = np.empty(({num_states}, {num_states}), dtype=float)
+
+        cdef int i, j, k
+        cdef double value
+        cdef int offset = {num_states} * {num_states}
+
+        self._evaluate_specifieds(x, t, gains)
+
+        open_loop_jacobians(&x[0], &self.specifieds[0], &self.constants[0],
+                            &self.partials[0])
+
+        # J = df/dx + df/dT * dT/dx = df/dx - df/dT * (S .* K)
+        for i in range({num_states}):
+            for j in range({num_states}):
+                value = self.partials[i * {num_states} + j]
+                for k in range({num_inputs}):
+                    value -= (self.partials[offset + i * {num_inputs} + k] *
+                              gains[k * {num_states} + j])
+                jac[i, j] = value
+
+        return jac
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def sensitivities(self, double[::1] y, double t, double[::1] gains):
+        \"\"\"Returns the right hand side of the closed loop ODEs augmented
+        with their forward sensitivity equations, where y = [x, Z] and Z are
+        the {num_states} x m partial derivatives of the states with respect
+        to m >= {num_gains} parameters, flattened in row major order. The
+        first {num_gains} parameters are the gains, Z[i, p] = dx_i / dg_p,
+        whose sensitivities evolve as Z' = J * Z + df/dg, where J is the
+        closed loop state Jacobian. Any other parameters, e.g. the initial
+        states, only affect the states through their initial values, so
+        their sensitivities evolve as Z' = J * Z.\"\"\"
+
+        cdef int num_columns = (y.shape[0] - {num_states}) // {num_states}
+
+        cdef np.ndarray[np.double_t, ndim=1, mode='c'] ydot
+        ydot = np.empty(y.shape[0], dtype=float)
+
+        cdef int i, j, k, p
+        cdef double value
+        cdef int offset = {num_states} * {num_states}
+        cdef double[::1] x = y[:{num_states}]
+        cdef double[::1] jac = self.closed_loop_partials
+
+        self._evaluate_specifieds(x, t, gains)
+
+        open_loop_rhs(&x[0], &self.specifieds[0], &self.constants[0],
+                      <double*> ydot.data)
+
+        open_loop_jacobians(&x[0], &self.specifieds[0], &self.constants[0],
+                            &self.partials[0])
+
+        for i in range({num_states}):
+            for j in range({num_states}):
+                value = self.partials[i * {num_states} + j]
+                for k in range({num_inputs}):
+                    value -= (self.partials[offset + i * {num_inputs} + k] *
+                              gains[k * {num_states} + j])
+                jac[i * {num_states} + j] = value
+
+        for i in range({num_states}):
+            for p in range(num_columns):
+                value = 0.0
+                for j in range({num_states}):
+                    value += (jac[i * {num_states} + j] *
+                              y[{num_states} + j * num_columns + p])
+                ydot[{num_states} + i * num_columns + p] = value
+            # T_k = sum_j g_kj * (x_ref_j - x_j) ->
+            # df_i/dg_kj = df_i/dT_k * (x_ref_j - x_j)
+            for k in range({num_inputs}):
+                for j in range({num_states}):
+                    ydot[{num_states} + i * num_columns + k * {num_states} +
+                         j] += (self.partials[offset + i * {num_inputs} + k] *
+                                (self.signals[j] - x[j]))
+
+        return ydot
+"""
+
+
+def cython_matrix_function(arguments, matrices, prefix='pydy_matrices'):
+    """Returns a compiled function that numerically evaluates the provided
+    matrices. This is equivalent to
+    ``CythonMatrixGenerator(arguments, matrices).compile()`` except that the
+    compiled module is looked up in the cache by a hash of the arguments and
+    the matrix expressions, so the code is only generated if the module has
+    to be compiled.
+
+    Parameters
+    ==========
+    arguments : sequence of sequences of SymPy Symbol or Function
+        Each of the sequences will be converted to an input array in the
+        compiled function.
+    matrices : sequence of SymPy Matrix
+        The matrices that should be evaluated by the function.
+    prefix : string, optional
+        The prefix of the compiled module's name.
+
+    Returns
+    =======
+    eval : function
+        The compiled function which takes the input arrays followed by
+        output arrays for each matrix.
+
+    """
+
+    # The key is the input expressions themselves, so a cached module is
+    # found without generating any code.
+    name = cache.extension_name(prefix, pydy.__version__, sy.__version__,
+                                sy.srepr([list(arg) for arg in arguments]),
+                                sy.srepr([sy.Matrix(m) for m in matrices]))
+
+    def sources():
+        g = CythonMatrixGenerator(arguments, matrices, prefix=name)
+        setup_py, pyx, c_header, c_source = g.doprint()
+        return {'setup.py': setup_py,
+                name + '.pyx': pyx,
+                name + '_c.h': c_header,
+                name + '_c.c': c_source}
+
+    return cache.extension_module(name, sources).eval
+
+
+class CachedCythonODEFunctionGenerator(CythonODEFunctionGenerator):
+    """Generates the same right hand side functions as the Cython ODE
+    function generator in PyDy but stores the compiled extensions in the on
+    disk cache instead of compiling a new extension on every call."""
+
+    def _cythonize(self, outputs, inputs):
+        return cython_matrix_function(inputs, outputs, prefix='pydy_rhs')
+
+
+def c_function(name, arguments, matrices):
+    """Returns the text of a C header and source file that contain a single
+    function, ``void name(double* input_0, ..., double* output)``, which
+    evaluates the provided matrices. Common sub-expressions are computed
+    only once.
+
+    Parameters
+    ==========
+    name : string
+        The name of the C function.
+    arguments : sequence of sequences of SymPy Symbol or Function
+        The symbols in each of the sequences are read from the corresponding
+        input array.
+    matrices : sequence of SymPy Matrix
+        The matrices are flattened in row major order and stored one after
+        another in the output array.
+
+    Returns
+    =======
+    c_header : string
+    c_source : string
+
+    """
+
+    replacements = {}
+    for i, argument in enumerate(arguments):
+        for j, symbol in enumerate(argument):
+            replacements[symbol] = sy.Symbol('input_{}[{}]'.format(i, j))
+
+    exprs = [expr.xreplace(replacements) for matrix in matrices
+             for expr in matrix]
+
+    sub_exprs, simplified_exprs = sy.cse(exprs,
+                                         symbols=sy.numbered_symbols('z_'))
+
+    lines = []
+    for var, expr in sub_exprs:
+        lines.append('    double {} = {};'.format(var, sy.ccode(expr)))
+    lines.append('')
+    for i, expr in enumerate(simplified_exprs):
+        lines.append('    output[{}] = {};'.format(i, sy.ccode(expr)))
+
+    args = ', '.join(['double* input_{}'.format(i) for i in
+                      range(len(arguments))] + ['double* output'])
+
+    c_header = _c_header_template.format(name=name, args=args)
+    c_source = _c_source_template.format(name=name, args=args,
+                                         body='\n'.join(lines))
+
+    return c_header, c_source
+
+
+def closed_loop_ode_function_sources(right_hand_side, states, specifieds,
+                                     constants):
+    """Returns the module name and the source files of the extension that
+    evaluates the closed loop ODEs and their state Jacobian entirely in
+    compiled code. The state feedback controller, the gain scaling and the
+    interpolation of the reference noise and platform acceleration all
+    happen in the same native call that evaluates the open loop right hand
+    side.
+
+    Parameters
+    ==========
+    right_hand_side : SymPy Matrix, shape(n, 1)
+        The open loop first order explicit ODEs, x' = f(x, r, p).
+    states : sequence of SymPy Function, len(n)
+        The states, x.
+    specifieds : sequence of SymPy Function, len(q + 1)
+        The platform acceleration followed by the q joint torques.
+    constants : sequence of SymPy Symbol
+        The constant parameters, p.
+
+    Returns
+    =======
+    name : string
+        The name of the extension module.
+    sources : dictionary
+        Maps file names to the text of the files needed to build the
+        extension, see cache.extension_module().
+
+    """
+
+    num_states = len(states)
+    num_inputs = len(specifieds) - 1
+
+    arguments = [states, specifieds, constants]
+
+    rhs_header, rhs_source = c_function('open_loop_rhs', arguments,
+                                        [right_hand_side])
+
+    jac_header, jac_source = c_function(
+        'open_loop_jacobians', arguments,
+        [right_hand_side.jacobian(states),
+         right_hand_side.jacobian(specifieds[1:])])
+
+    c_header = rhs_header + jac_header
+    c_source = rhs_source + '\n' + jac_source
+
+    with open(os.path.join(SRC_DIR, 'fast_interpolate.pxd')) as f:
+        interpolator_declaration = f.read()
+
+    fill = {'num_states': num_states,
+            'num_inputs': num_inputs,
+            'num_gains': num_states * num_inputs,
+            'num_signals': num_states + 1,
+            'src_dir': SRC_DIR}
+
+    fill['prefix'] = cache.extension_name(
+        'closed_loop', c_source, interpolator_declaration,
+        _closed_loop_pyx_template, _closed_loop_setup_template,
+        sorted(fill.items()))
+
+    sources = {'setup.py': _closed_loop_setup_template.format(**fill),
+               fill['prefix'] + '.pyx':
+               _closed_loop_pyx_template.format(**fill),
+               fill['prefix'] + '_c.h': c_header,
+               fill['prefix'] + '_c.c': c_source}
+
+    return fill['prefix'], sources
+
+
+def load_closed_loop_ode_function_class(name, sources):
+    """Returns the ClosedLoopODEFunction class from the extension generated
+    by closed_loop_ode_function_sources(). The extension is imported from
+    the on disk cache and only compiled if it isn't there."""
+
+    return cache.extension_module(name, sources).ClosedLoopODEFunction
+
+
+def closed_loop_ode_function_class(right_hand_side, states, specifieds,
+                                   constants):
+    """Returns an extension type that evaluates the closed loop ODEs and
+    their state Jacobian entirely in compiled code. The arguments are the
+    same as for closed_loop_ode_function_sources().
+
+    Returns
+    =======
+    ClosedLoopODEFunction : class
+        Instantiate with an Interpolator of the [reference noise,
+        acceleration] signals and an array of the numerical constants. The
+        instances are called as f(x, t, g) where g is an array of the q * n
+        flattened gains, S .* K. The ``jacobian`` method has the same
+        signature and returns the n x n closed loop state Jacobian. The
+        ``sensitivities`` method also takes the same arguments, but with
+        the states followed by their partial derivatives with respect to the
+        q * n gains and any other parameters, e.g. the initial states, and
+        returns their time derivatives. The ``evaluate_many`` method
+        evaluates the ODEs for rows of states and gains at once.
+
+    """
+
+    name, sources = closed_loop_ode_function_sources(right_hand_side, states,
+                                                     specifieds, constants)
+
+    return load_closed_loop_ode_function_class(name, sources)
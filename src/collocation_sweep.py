@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+
+"""This module identifies the gains of a grid of trials by indirect
+identification via direct collocation in a pool of processes. Every worker
+builds the collocation problem once and re-targets it for each trial. The
+trials of a row of the grid can be solved in order, each one starting from
+the solution of its neighbour. The result of every trial is stored on disk as
+soon as it is found, so that an interrupted sweep continues where it
+stopped."""
+
+import os
+import time
+import errno
+import tempfile
+from multiprocessing import Pool
+
+import numpy as np
+from progressbar import ProgressBar
+
+from model import QuietStandingModel
+import indirect_collocation
+
+# The collocation problem and the result store of each worker process.
+_worker = {}
+
+
+class CellStore(object):
+
+    def __init__(self, directory):
+        """Stores the result of each trial (cell) of a grid in a separate
+        file in the directory. The files are written to a temporary file
+        first and then renamed, so a file either holds a complete result or
+        does not exist.
+
+        Parameters
+        ==========
+        directory : string
+            The path to the directory that holds the results.
+
+        """
+
+        self.directory = directory
+
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def path(self, i, j):
+        return os.path.join(self.directory,
+                            'cell-{:04d}-{:04d}.npz'.format(i, j))
+
+    def completed(self):
+        """Returns the set of (i, j) indices of the stored cells."""
+
+        cells = set()
+        for file_name in os.listdir(self.directory):
+            if file_name.startswith('cell-') and file_name.endswith('.npz'):
+                i, j = file_name[5:-4].split('-')
+                cells.add((int(i), int(j)))
+        return cells
+
+    def save(self, i, j, **results):
+        """Stores the arrays in results for the cell (i, j)."""
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, **results)
+            os.rename(tmp_path, self.path(i, j))
+        except:
+            os.remove(tmp_path)
+            raise
+
+    def load(self, i, j):
+        """Returns a dictionary of the results of the cell (i, j)."""
+
+        with np.load(self.path(i, j)) as data:
+            return {k: data[k] for k in data.files}
+
+    def collect(self, shape, key):
+        """Returns an array, shape(n, m, ...), of the result named key for
+        every cell of an n x m grid. This raises an error if any cells are
+        missing."""
+
+        n, m = shape
+
+        first = self.load(0, 0)[key]
+        values = np.empty((n, m) + first.shape, dtype=first.dtype)
+
+        for i in range(n):
+            for j in range(m):
+                values[i, j] = self.load(i, j)[key]
+
+        return values
+
+
+def _initialize_worker(num_nodes, time_interval, scaled_gains,
+                       ipopt_options, store):
+    """Builds the model and the collocation problem in a worker process.
+    The symbolic model is loaded from the on disk cache."""
+
+    model = QuietStandingModel(scaled_gains=scaled_gains)
+    model.derive()
+
+    _worker['ider'] = indirect_collocation.CollocationIdentifier(
+        model, num_nodes, time_interval, ipopt_options=ipopt_options)
+    _worker['store'] = store
+
+
+def _identify_chain(task):
+    """Identifies the gains of a chain of neighbouring trials in order and
+    stores the result of each one. Each trial is warm started from the last
+    trial that converged, if any. Returns the number of trials solved."""
+
+    cells, measured_states, measured_accel, warm_start = task
+
+    ider = _worker['ider']
+    store = _worker['store']
+
+    previous = None
+
+    for (i, j), states, accel in zip(cells, measured_states, measured_accel):
+
+        ider.update(states, accel)
+
+        if previous is None:
+            # Give it the known gains as a guess, because all we care about
+            # is how the optimal solution is affected by the accel and
+            # noise. The free gains are the scaled gains.
+            model = ider.model
+            initial_guess = ider.initial_guess(model.numerical_gains /
+                                               model.gain_scale_factors)
+            multipliers = None
+        else:
+            initial_guess, multipliers = previous
+
+        start = time.time()
+        gains = ider.identify(initial_guess, multipliers=multipliers)
+        duration = time.time() - start
+
+        status = int(ider.info['status'])
+
+        store.save(i, j, gains=gains,
+                   status=np.array(status),
+                   status_msg=np.array(ider.info['status_msg']),
+                   iterations=np.array(ider.iterations),
+                   time=np.array(duration),
+                   warm_start=np.array(multipliers is not None))
+
+        # IPOPT's status is 0 if the problem was solved and 1 if it was
+        # solved to acceptable tolerances. The other statuses, e.g. 2
+        # (infeasible), 3 (search direction too small), 4 (diverging), 6
+        # (feasible point found) and the negative errors, are failures that
+        # must not seed the next trial.
+        if warm_start and status in (0, 1):
+            previous = (ider.solution, ider.multipliers)
+
+    return len(cells)
+
+
+def identify_grid(measured_states, measured_accel, time_interval, store,
+                  scaled_gains=0.5, ipopt_options=None, processes=None,
+                  warm_start=True):
+    """Identifies the gains of every trial in a grid with indirect
+    collocation. Trials that are already in the store are skipped.
+
+    If warm_start is True, each row of the grid is solved in order of the
+    column index and each trial starts from the primal and dual solution of
+    the previous trial in the row, which is close to its own solution if
+    the grid is smooth along the columns. The rows are solved in parallel.
+    Otherwise every trial starts from the measured states and the known
+    gains, as do the first trial of each row and the first remaining trial
+    of a row that was interrupted.
+
+    Parameters
+    ==========
+    measured_states : ndarray, shape(n, m, N, 4)
+        The measured state trajectories of each trial.
+    measured_accel : ndarray, shape(n, m, N)
+        The measured platform acceleration of each trial.
+    time_interval : float
+        The time in seconds between the samples.
+    store : CellStore
+        Holds the results of each trial.
+    scaled_gains : float or array_like, shape(2, 4), optional
+        The scaled gains of the model, see QuietStandingModel.
+    ipopt_options : dictionary, optional
+        The IPOPT options of the problem.
+    processes : integer, optional
+        The number of worker processes, defaults to the number of cores.
+    warm_start : boolean, optional
+        Whether to start each trial from the solution of its neighbour.
+
+    Returns
+    =======
+    results : dictionary
+        The 'gains', shape(n, m, 8), and the 'status', 'iterations', solve
+        'time' and whether it was warm started, 'warm_start', of each trial,
+        shape(n, m).
+
+    """
+
+    n, m, num_nodes = measured_states.shape[:3]
+
+    if ipopt_options is None:
+        ipopt_options = {}
+
+    done = store.completed()
+    remaining = [(i, j) for i in range(n) for j in range(m)
+                 if (i, j) not in done]
+
+    if remaining:
+
+        if warm_start:
+            rows = {}
+            for i, j in remaining:
+                rows.setdefault(i, []).append((i, j))
+            chains = [rows[i] for i in sorted(rows)]
+        else:
+            chains = [[cell] for cell in remaining]
+
+        tasks = ((chain,
+                  [measured_states[i, j] for i, j in chain],
+                  [measured_accel[i, j] for i, j in chain],
+                  warm_start)
+                 for chain in chains)
+
+        pool = Pool(processes, initializer=_initialize_worker,
+                    initargs=(num_nodes, time_interval, scaled_gains,
+                              ipopt_options, store))
+
+        pbar = ProgressBar(maxval=len(remaining))
+        pbar.start()
+
+        count = 0
+
+        try:
+            for num_solved in pool.imap_unordered(_identify_chain, tasks):
+                count += num_solved
+                pbar.update(count)
+        finally:
+            pool.terminate()
+
+        pbar.finish()
+
+    return {k: store.collect((n, m), k)
+            for k in ['gains', 'status', 'iterations', 'time', 'warm_start']}
@@ -1,5 +1,9 @@
 #!/usr/bin/env python
 
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
 from scipy.linalg import lstsq
 
 
@@ -60,7 +64,418 @@ class ControllerIdentifier(object):
 
         return res[0].T
 
+    def _decompose(self):
+        """Computes the singular value decomposition of the state matrix,
+        A = U * S * V^T, and U^T * b once for all of the methods that reuse
+        it."""
+
+        if not hasattr(self, '_svd'):
+            u, s, vt = np.linalg.svd(-self.state_traj, full_matrices=False)
+            self._svd = u, s, vt
+            self._ut_b = np.dot(u.T, self.input_traj)
+
+        return self._svd
+
+    def ridge_path(self, penalties):
+        """Returns the ridge regression estimates of the gains, which
+        minimize ||A x - b||^2 + penalty * ||x||^2, for many penalties. All
+        of the estimates come from one singular value decomposition.
+
+        Parameters
+        ==========
+        penalties : array_like, shape(k,)
+            The non-negative regularization weights. A weight of zero gives
+            the least squares estimate.
+
+        Returns
+        =======
+        gains : ndarray, shape(k, m * n)
+            The flattened m x n gain matrices for each penalty.
+
+        """
+
+        u, s, vt = self._decompose()
+
+        penalties = np.atleast_1d(penalties).astype(float)
+
+        # x = V * diag(s / (s**2 + penalty)) * U^T * b
+        filters = s / (s**2 + penalties[:, np.newaxis])
+        solution = np.matmul(vt.T, filters[:, :, np.newaxis] * self._ut_b)
+
+        return np.swapaxes(solution, -1, -2).reshape(len(penalties), -1)
+
+    def bootstrap(self, num_resamples=1000, block_length=None,
+                  confidence=0.95, seed=None, n_jobs=1):
+        """Returns confidence intervals of the gains from a block bootstrap
+        of the samples.
+
+        The trial is split into non-overlapping blocks of consecutive
+        samples which are drawn with replacement to form each resample. The
+        normal equations of each block are computed once in the basis that
+        whitens the state matrix, A * V * S^-1 = U, so the normal equations
+        of all of the resamples are a single product of the matrix of block
+        counts with the stacked block equations, followed by one batched
+        solve of well conditioned n x n systems.
+
+        Parameters
+        ==========
+        num_resamples : integer, optional, default=1000
+            The number of bootstrap resamples.
+        block_length : integer, optional
+            The number of samples in each block. It should be longer than
+            the correlation time of the residuals. Defaults to the cube root
+            of the number of samples, but at least n.
+        confidence : float, optional, default=0.95
+            The confidence level of the percentile intervals.
+        seed : integer, optional
+            The seed of the random number generator.
+        n_jobs : integer, optional, default=1
+            The number of threads to split the resamples over, -1 uses all
+            of the cores.
+
+        Returns
+        =======
+        lower : ndarray, shape(m * n,)
+            The lower bounds of the flattened gains.
+        upper : ndarray, shape(m * n,)
+            The upper bounds of the flattened gains.
+
+        Notes
+        =====
+        The bootstrapped gains are stored in the ``bootstrap_gains``
+        attribute, shape(num_resamples, m * n). Samples after the last full
+        block are not used.
+
+        """
+
+        u, s, vt = self._decompose()
+
+        num_samples, num_states = u.shape
+        num_inputs = self.input_traj.shape[1]
+
+        if block_length is None:
+            block_length = max(num_states,
+                               int(round(num_samples**(1.0 / 3.0))))
+
+        num_blocks = num_samples // block_length
+        used = num_blocks * block_length
+
+        # The normal equations of each block in the whitened basis, stacked
+        # as shape(num_blocks, n * n) and shape(num_blocks, n * m).
+        u_blocks = u[:used].reshape(num_blocks, block_length, num_states)
+        b_blocks = np.asarray(self.input_traj[:used], dtype=float).reshape(
+            num_blocks, block_length, num_inputs)
+        grams = np.matmul(np.swapaxes(u_blocks, 1, 2),
+                          u_blocks).reshape(num_blocks, -1)
+        moments = np.matmul(np.swapaxes(u_blocks, 1, 2),
+                            b_blocks).reshape(num_blocks, -1)
+
+        random = np.random.RandomState(seed)
+        counts = random.multinomial(num_blocks,
+                                    np.ones(num_blocks) / num_blocks,
+                                    size=num_resamples).astype(float)
+
+        # x = V * S^-1 * y where y is the solution in the whitened basis.
+        back = vt.T / s
+
+        def solve(counts):
+            gram = np.dot(counts, grams).reshape(-1, num_states, num_states)
+            moment = np.dot(counts, moments).reshape(-1, num_states,
+                                                     num_inputs)
+            solution = np.matmul(back, np.linalg.solve(gram, moment))
+            return np.swapaxes(solution, -1, -2).reshape(len(counts), -1)
+
+        if n_jobs == -1:
+            n_jobs = cpu_count()
+
+        if n_jobs > 1:
+            # NumPy releases the GIL in the matrix products and solves.
+            pool = ThreadPool(n_jobs)
+            try:
+                chunks = pool.map(solve, np.array_split(counts, n_jobs))
+            finally:
+                pool.close()
+            self.bootstrap_gains = np.vstack(chunks)
+        else:
+            self.bootstrap_gains = solve(counts)
+
+        tail = 50.0 * (1.0 - confidence)
+        lower, upper = np.percentile(self.bootstrap_gains,
+                                     [tail, 100.0 - tail], axis=0)
+
+        return lower, upper
+
+
+class RecursiveControllerIdentifier(object):
+
+    def __init__(self, num_inputs=2, num_states=4, forgetting_factor=1.0,
+                 initial_covariance=1e6):
+        """This class identifies the same state feedback controller as
+        ControllerIdentifier with recursive least squares. The samples can
+        be provided one at a time or in chunks and the current estimate of
+        the gains is available at any time, so long recordings can be
+        processed in bounded memory or the gains can be tracked during an
+        experiment. Each sample costs O(n**2) operations.
+
+        Parameters
+        ==========
+        num_inputs : integer, optional, default=2
+            The number of inputs, m.
+        num_states : integer, optional, default=4
+            The number of states, n.
+        forgetting_factor : float, optional, default=1.0
+            The weight of each past sample is multiplied by this factor for
+            every new sample, 0 < forgetting_factor <= 1. With 1.0 all
+            samples are weighted equally and the estimate converges to the
+            least squares estimate of all of the data.
+        initial_covariance : float, optional, default=1e6
+            The diagonal of the initial (unscaled) covariance of the gains.
+            Large values give little weight to the initial zero gains.
+
+        """
+
+        if not 0.0 < forgetting_factor <= 1.0:
+            raise ValueError('The forgetting factor must be in (0, 1].')
+
+        self.forgetting_factor = forgetting_factor
+
+        self.solution = np.zeros((num_states, num_inputs))
+        self.covariance = initial_covariance * np.eye(num_states)
+        self.num_samples = 0
+
+    def update(self, input_traj, state_traj):
+        """Updates the gain estimates with new samples.
+
+        Parameters
+        ==========
+        input_traj : array_like, shape(m,) or shape(k, m)
+            One or k time steps of the m inputs.
+        state_traj : array_like, shape(n,) or shape(k, n)
+            One or k time steps of the n states.
+
+        """
+
+        input_traj = np.atleast_2d(input_traj)
+        state_traj = np.atleast_2d(state_traj)
+
+        lam = self.forgetting_factor
+        sol = self.solution
+        cov = self.covariance
+
+        for u, x in zip(input_traj, -state_traj):
+
+            cov_x = np.dot(cov, x)
+            denominator = lam + np.dot(x, cov_x)
+
+            sol += np.outer(cov_x / denominator, u - np.dot(x, sol))
+            # The outer product of a vector with itself is exactly
+            # symmetric, otherwise round off errors grow by 1 / lam every
+            # sample.
+            cov -= np.outer(cov_x, cov_x) / denominator
+            cov /= lam
+
+        self.num_samples += len(state_traj)
+
+    def identify(self):
+        """Returns the current estimates of the state feedback controller
+        gains, shape(m, n)."""
+
+        return self.solution.T.copy()
+
+
+class CumulativeControllerIdentifier(object):
+
+    def __init__(self, input_traj, state_traj, block_size=None):
+        """This class identifies the same state feedback controller as
+        ControllerIdentifier for many contiguous windows of one trial, e.g.
+        all prefixes for a study of the effect of the trial duration. The
+        sums of the normal equations' terms, A^T A and A^T b, are computed
+        in a single pass over the data, so the gains of any window only
+        require a few sums of n x n matrices and the solution of an n x n
+        system.
+
+        Parameters
+        ==========
+        input_traj : array_like, shape(N, m)
+            The N time steps of the m inputs.
+        state_traj : array_like, shape(N, n)
+            The N time steps of the n states.
+        block_size : integer, optional
+            The number of samples in each block of the cumulative sums,
+            defaults to the square root of N.
+
+        Notes
+        =====
+        The cumulative sums start over at each block, so the sums of a
+        window are the difference of two cumulative sums within a block
+        plus the sums of the whole blocks in between. Differences of sums
+        over the whole trial would lose the precision of a short window
+        late in a long trial through cancellation.
+
+        Solving the normal equations squares the condition number of the
+        state trajectory compared to ControllerIdentifier. This is not an
+        issue for the well excited trials in this project. The windows must
+        contain at least n samples.
+
+        """
+
+        a = -np.asarray(state_traj, dtype=float)
+        b = np.asarray(input_traj, dtype=float)
+
+        num_samples, num_states = a.shape
+        num_inputs = b.shape[1]
+
+        if block_size is None:
+            block_size = max(int(np.sqrt(num_samples)), 1)
+        self.block_size = block_size
+
+        gram = a[:, :, np.newaxis] * a[:, np.newaxis, :]
+        moment = a[:, :, np.newaxis] * b[:, np.newaxis, :]
+
+        starts = np.arange(0, num_samples, block_size)
+
+        self.block_gram = np.add.reduceat(gram, starts, axis=0)
+        self.block_moment = np.add.reduceat(moment, starts, axis=0)
+
+        # The entry k is the sum of the samples from the start of the block
+        # that contains sample k up to, but not including, sample k.
+        self.cumulative_gram = np.zeros((num_samples + 1, num_states,
+                                         num_states))
+        self.cumulative_moment = np.zeros((num_samples + 1, num_states,
+                                           num_inputs))
+
+        for start in starts:
+            stop = min(start + block_size, num_samples)
+            np.cumsum(gram[start:stop], axis=0,
+                      out=self.cumulative_gram[start + 1:stop + 1])
+            np.cumsum(moment[start:stop], axis=0,
+                      out=self.cumulative_moment[start + 1:stop + 1])
+
+        # The sums start over at the first sample of each block.
+        self.cumulative_gram[::block_size] = 0.0
+        self.cumulative_moment[::block_size] = 0.0
+
+    def _window_sums(self, sums, blocks, start, stop):
+        """Returns the sum of the samples in [start, stop) from the
+        cumulative sums within the blocks and the sums of the blocks."""
+
+        first = start // self.block_size
+        last = stop // self.block_size
+
+        return (np.sum(blocks[first:last], axis=0) - sums[start] +
+                sums[stop])
+
+    def identify_windows(self, starts, stops):
+        """Returns the least square estimates of the gains for each window
+        of samples, [start, stop).
+
+        Parameters
+        ==========
+        starts : array_like of integers, shape(k,)
+            The indices of the first samples of the windows.
+        stops : array_like of integers, shape(k,)
+            The indices after the last samples of the windows.
+
+        Returns
+        =======
+        gains : ndarray, shape(k, m * n)
+            The flattened m x n gain matrices of each window.
+
+        """
+
+        starts = np.atleast_1d(starts)
+        stops = np.atleast_1d(stops)
+
+        gram = np.array([self._window_sums(self.cumulative_gram,
+                                           self.block_gram, start, stop)
+                         for start, stop in zip(starts, stops)])
+        moment = np.array([self._window_sums(self.cumulative_moment,
+                                             self.block_moment, start, stop)
+                           for start, stop in zip(starts, stops)])
+
+        solution = np.linalg.solve(gram, moment)
+
+        return np.swapaxes(solution, -1, -2).reshape(len(solution), -1)
+
+    def identify_prefixes(self, lengths):
+        """Returns the least square estimates of the gains using the first
+        samples of the trial.
+
+        Parameters
+        ==========
+        lengths : array_like of integers, shape(k,)
+            The number of samples in each prefix.
+
+        Returns
+        =======
+        gains : ndarray, shape(k, m * n)
+            The flattened m x n gain matrices of each prefix.
+
+        """
+
+        lengths = np.atleast_1d(lengths)
+
+        return self.identify_windows(np.zeros_like(lengths), lengths)
+
 
 def identify(input_traj, state_traj):
     ider = ControllerIdentifier(input_traj, state_traj)
     return ider.identify().flatten()
+
+
+def identify_batch(input_trajs, state_trajs, rcond=None):
+    """Returns the least square estimates of the state feedback controller
+    gains for many trials at once. All of the least squares problems are
+    solved with a single batched singular value decomposition instead of a
+    loop over the trials.
+
+    Parameters
+    ==========
+    input_trajs : array_like, shape(..., N, m)
+        The N time steps of the m inputs of each trial, e.g. shape(n_i,
+        n_j, N, m) for a grid of trials.
+    state_trajs : array_like, shape(..., N, n)
+        The N time steps of the n states of each trial.
+    rcond : float, optional
+        Singular values smaller than rcond times the largest singular value
+        of a trial are treated as zero. Defaults to machine precision times
+        max(N, n), like numpy.linalg.lstsq.
+
+    Returns
+    =======
+    gains : ndarray, shape(..., m * n)
+        The flattened m x n gain matrices, the same as identify() returns
+        for each trial.
+    residuals : ndarray, shape(..., m)
+        The sum of the squared residuals of each input.
+    ranks : ndarray, shape(...)
+        The effective rank of each trial's state trajectory.
+
+    """
+
+    a = -np.asarray(state_trajs, dtype=float)
+    b = np.asarray(input_trajs, dtype=float)
+
+    num_samples, num_states = a.shape[-2:]
+    num_inputs = b.shape[-1]
+
+    if rcond is None:
+        rcond = np.finfo(float).eps * max(num_samples, num_states)
+
+    # a = u * diag(s) * vt
+    u, s, vt = np.linalg.svd(a, full_matrices=False)
+
+    keep = s > rcond * s[..., :1]
+    s_inv = np.where(keep, 1.0 / np.where(keep, s, 1.0), 0.0)
+
+    # x = v * diag(1 / s) * u.T * b, shape(..., n, m)
+    x = np.matmul(np.swapaxes(vt, -1, -2),
+                  np.expand_dims(s_inv, -1) *
+                  np.matmul(np.swapaxes(u, -1, -2), b))
+
+    residuals = np.sum((np.matmul(a, x) - b)**2, axis=-2)
+
+    gains = np.swapaxes(x, -1, -2).reshape(x.shape[:-2] +
+                                           (num_inputs * num_states,))
+
+    return gains, residuals, np.sum(keep, axis=-1)
@@ -21,6 +21,7 @@ from model import QuietStandingModel
 from measured_data import DataGenerator
 import direct_identification
 import indirect_collocation
+import windowed_collocation
 import utils
 
 sample_rate = 100.0  # hz
@@ -34,9 +35,8 @@ model.derive()
 logbook.info('Defining the model.')
 generator = DataGenerator(duration, total_num_nodes, 0.0, 0.1, model)
 logbook.info('Simulating.')
-# NOTE : Joblib can't pickle the DataGenerator because it has unpickable
-# SymPy functions tied to the model, so the generate() call can't be cached.
-# TODO : Manually cache this result.
+# NOTE : The DataGenerator can be pickled (the model is replaced by a numerical
+# runtime), so this result could be cached with joblib.Memory.
 accel_noise = 11.0 - 9.75
 coord_noise = 0.068 - 0.058
 speed_noise = 0.212 - 0.199
@@ -50,13 +50,31 @@ num_durations = 30
 duration_lengths = np.logspace(np.log10(1.0), np.log10(duration),
                                num_durations)
 
-direct_identified_gains = np.empty((num_durations,
-                                    generator.model.numerical_gains.size),
-                                   dtype=float)
-indirect_identified_gains = np.empty_like(direct_identified_gains)
+# The direct identification of every prefix is cheap, so it is computed for
+# a much denser set of durations.
+num_direct_durations = 3000
+direct_duration_lengths = np.logspace(np.log10(1.0), np.log10(duration),
+                                      num_direct_durations)
+
+logbook.info('Identifying the gains directly.')
+ider = direct_identification.CumulativeControllerIdentifier(
+    generator.measured['u'], generator.measured['x'])
+direct_identified_gains = ider.identify_prefixes(
+    np.round(direct_duration_lengths / time_interval).astype(int))
+
+indirect_identified_gains = np.empty((num_durations,
+                                      generator.model.numerical_gains.size),
+                                     dtype=float)
 
 indirect_times = []
 
+# Durations longer than a window are also identified from 20 s windows that
+# agree on the gains, which bounds the size of each collocation problem.
+window_num_nodes = int(20.0 * sample_rate) + 1
+
+windowed_identified_gains = np.nan * np.ones_like(indirect_identified_gains)
+windowed_times = np.nan * np.ones(num_durations)
+
 ipopt_opts = {'print_level': 0,
               'sb': "yes",
               'linear_solver': 'ma57'}
@@ -64,11 +82,7 @@ ipopt_opts = {'print_level': 0,
 logbook.info('Identifying the gains.')
 for i, dur_len in enumerate(duration_lengths):
     idx = np.argmin(np.abs(generator.time - dur_len))
-    input_traj = generator.measured['u'][:idx]
     state_traj = generator.measured['x'][:idx]
-    logbook.info('Identifying the gains directly.')
-    direct_identified_gains[i] = direct_identification.identify(input_traj,
-                                                                state_traj)
 
     logbook.info('Identifying the gains indirectly.')
     accel = generator.measured['a'][:idx]
@@ -97,6 +111,14 @@ for i, dur_len in enumerate(duration_lengths):
     indirect_identified_gains[i] = \
         model.gain_scale_factors.flatten() * solution[-8:]
 
+    if idx > window_num_nodes:
+        logbook.info('Identifying the gains from windows.')
+        results, windowed_times[i] = utils.timeit(
+            windowed_collocation.identify)(state_traj, accel, time_interval,
+                                           window_num_nodes,
+                                           ipopt_options=ipopt_opts)
+        windowed_identified_gains[i] = results['gains']
+
 known_gains = model.numerical_gains.flatten()
 
 logbook.info('Plotting.')
@@ -107,7 +129,7 @@ for i, gains in enumerate(direct_identified_gains.T):
 
     rel_error = np.abs((gains - known_gains[i]) / known_gains[i])
 
-    axes[i].plot(duration_lengths, rel_error)
+    axes[i].plot(direct_duration_lengths, rel_error)
     axes[i].set_xscale('log')
 
     if i > 3:
@@ -133,5 +155,7 @@ for i, gains in enumerate(indirect_identified_gains.T):
         axes[i].set_ylabel('Relative Error')
 
 fig, ax = plt.subplots()
-ax.plot(duration_lengths, indirect_times)
+ax.plot(duration_lengths, indirect_times, label='Full')
+ax.plot(duration_lengths, windowed_times, label='Windowed')
 ax.set_xscale('log')
+ax.legend()
@@ -0,0 +1,30 @@
+cdef class Interpolator:
+
+    cdef int n
+    # The search cursor used by interpolate() and _interpolate().
+    cdef int saved_j_low
+    cdef int ascending
+    # The uniform spacing is stored as its inverse, 1 / dx.
+    cdef readonly int uniform
+    cdef double x0
+    cdef double inv_dx
+    # NOTE: Cython has a limitiation and can't store cdef'd ndarrays on the
+    # class so these are stored as objects. Typed memory views may alleviate
+    # having to type them inside the method calls below.
+    cdef object x
+    cdef object y
+    # 'zero', 'linear' or 'cubic'
+    cdef readonly object kind
+    # Whether kind is 'zero', for the C level interpolation.
+    cdef int zero_order
+    # The polynomial coefficients of each interval, shape(n - 1, k, m).
+    cdef object coefficients
+    # Typed memory views of x and y for the C level interpolation.
+    cdef double[::1] x_view
+    cdef double[:, ::1] y_view
+    cdef double[:, :, ::1] coefficients_view
+
+    cdef int _hunt(self, double x, int j_low) nogil
+    cdef int _find_idx(self, double x, int* cursor) nogil
+    cdef void _interpolate_at(self, double x, double* y, int* cursor) nogil
+    cdef void _interpolate(self, double x, double* y)
@@ -3,24 +3,60 @@ cimport numpy as np
 cimport cython
 
 
+KINDS = ('zero', 'linear', 'cubic')
+
+
+def _coefficients(x, y, kind):
+    """Returns the coefficients of the polynomials in each interval,
+    shape(n - 1, k, m), where y = sum(c[j, i] * (x - x[j])**i)."""
+
+    spacing = np.expand_dims(np.diff(x), 1)
+    slopes = np.diff(y, axis=0) / spacing
+
+    if kind == 'zero':
+        coefficients = [y[:-1]]
+    elif kind == 'linear':
+        coefficients = [y[:-1], slopes]
+    elif kind == 'cubic':
+        if len(x) < 3:
+            raise ValueError('Cubic interpolation requires at least 3 '
+                             'samples, the derivatives at the samples are '
+                             'estimated from second order differences.')
+        # Cubic Hermite polynomials with the derivatives at the data points
+        # estimated by second order finite differences, which have
+        # continuous first derivatives.
+        derivatives = np.gradient(y, x, axis=0, edge_order=2)
+        d0 = derivatives[:-1]
+        d1 = derivatives[1:]
+        coefficients = [y[:-1], d0,
+                        (3.0 * slopes - 2.0 * d0 - d1) / spacing,
+                        (d0 + d1 - 2.0 * slopes) / spacing**2]
+    else:
+        raise ValueError('kind must be one of {}.'.format(KINDS))
+
+    return np.ascontiguousarray(np.stack(coefficients, axis=1))
+
+
 cdef class Interpolator:
-    """This class implements linear interpolation based on the algorithm
-    described in the Numerical Recipes book."""
-
-    cdef int n
-    cdef int saved_j_low
-    cdef int dj
-    cdef int ascending
-    cdef int cor
-    # NOTE: Cython has a limitiation and can't store cdef'd ndarrays on the
-    # class so these are stored as objects. Typed memory views may alleviate
-    # having to type them inside the method calls below.
-    cdef object x
-    cdef object y
+    """This class implements piecewise polynomial interpolation, e.g.
+    linear interpolation, with the search algorithm described in the
+    Numerical Recipes book.
+
+    If the abscissa is uniformly spaced, the interval that contains a value
+    is computed directly instead of being searched for. The polynomial
+    coefficients of each interval are computed once on initialization.
+
+    The data is never modified after initialization. The compiled kernel,
+    _interpolate_at, runs without the GIL and takes the search cursor from
+    the caller, so one interpolator can be shared by many threads.
+
+    The attributes are declared in fast_interpolate.pxd so that other
+    Cython modules can cimport this class and call _interpolate directly."""
 
     def __init__(self,
                  np.ndarray[np.double_t, ndim=1, mode='c'] x,
-                 np.ndarray[np.double_t, ndim=2, mode='c'] y):
+                 np.ndarray[np.double_t, ndim=2, mode='c'] y,
+                 uniform=None, kind='linear'):
         """
         Parameters
         ==========
@@ -28,6 +64,12 @@ cdef class Interpolator:
             The monotonically increasing or decreasing abscissa of the data.
         y : c contiguous ndarray, shape(n, m)
             The ordinates of the data.
+        uniform : boolean, optional
+            Whether x is uniformly spaced. If None, this is detected from x.
+        kind : string, optional
+            The kind of interpolation: 'zero' holds the value at the start
+            of each interval, 'linear' and 'cubic' give continuous values
+            and continuous first derivatives, respectively.
         """
 
         self.x = x
@@ -38,121 +80,170 @@ cdef class Interpolator:
         if self.n < 2:
             raise ValueError('x must contain more than one entry.')
 
+        if y.shape[0] != self.n:
+            raise ValueError('x and y must have the same number of rows.')
+
         self.ascending = x[self.n - 1] >= x[0]
 
         self.saved_j_low = 0
 
-        # These variables are used to determine if locate or hunt is called.
-        self.cor = 0
-        self.dj = int(max(1, self.n**0.25))
+        spacing = np.diff(x)
 
-    @cython.boundscheck(False)
-    @cython.wraparound(False)
-    cdef int _locate(self, double x):
-        """Returns the index from the abscissa just before the provde value
-        x. Bisection is used to locate the index."""
+        if uniform is None:
+            uniform = np.allclose(spacing, spacing[0], rtol=1e-9, atol=0.0)
+        self.uniform = uniform
 
-        cdef int j_low = 0
-        cdef int j_up = self.n - 1
-        cdef int jm
-        cdef np.ndarray[np.double_t, ndim=1, mode='c'] xx
-        xx = self.x
+        self.x0 = x[0]
+        self.inv_dx = (self.n - 1) / (x[self.n - 1] - x[0])
 
-        while (j_up - j_low) > 1:
+        self.kind = kind
+        self.zero_order = kind == 'zero'
+        self.coefficients = _coefficients(x, y, kind)
 
-            jm = (j_up + j_low) / 2
-
-            if (x >= xx[jm]) == self.ascending:
-                j_low = jm
-            else:
-                j_up = jm
+        self.x_view = x
+        self.y_view = y
+        self.coefficients_view = self.coefficients
 
-        # If this value of x is near the last value computed with this
-        # method, then use the _hunt method on the next value.
-        self.cor = 0 if abs(j_low - self.saved_j_low) > self.dj else 1
-        self.saved_j_low = j_low
-
-        return j_low
+    def __reduce__(self):
+        # Only the data is pickled, the search starts over when unpickled.
+        return (Interpolator, (self.x, self.y, bool(self.uniform),
+                               self.kind))
 
     @cython.boundscheck(False)
     @cython.wraparound(False)
-    cdef int _hunt(self, x):
-        """Returns the index from the abscissa just before the provde value
-        x. The index is first determined by hunting around the last x value
-        used, and finally bisection is used to home in on the index. There
-        is a computation time penalty if x is far away from the last x value
-        relative to the _locate method. This works well for firing inside a
-        variable step solver, for example."""
-
-        cdef int j_low = self.saved_j_low
+    cdef int _hunt(self, double x, int j_low) nogil:
+        """Returns the index from the abscissa just before the provided
+        value x. The index is first determined by hunting around the index
+        j_low, e.g. the one found for the last x value, and finally
+        bisection is used to home in on the index. This works well for
+        firing inside a variable step solver, for example."""
+
         cdef int j_up
-        cdef int inc
-        cdef int jm
-        cdef np.ndarray[np.double_t, ndim=1, mode='c'] xx
-        xx = self.x
+        cdef int j_m
+        cdef int inc = 1
 
-        if j_low < 0 or j_low > self.n - 1:
+        if j_low < 0 or j_low > self.n - 2:
             j_low = 0
             j_up = self.n - 1
+        elif (x >= self.x_view[j_low]) == self.ascending:
+            while 1:
+                j_up = j_low + inc
+                if j_up >= self.n - 1:
+                    j_up = self.n - 1
+                    break
+                elif (x < self.x_view[j_up]) == self.ascending:
+                    break
+                else:
+                    j_low = j_up
+                    inc += inc
         else:
-            inc = 1
-            if (x >= xx[j_low]) == self.ascending:
-                while 1:
-                    j_up = j_low + inc
-                    if j_up >= self.n - 1:
-                        j_up = self.n - 1
-                        break
-                    elif (x < xx[j_up]) == self.ascending:
-                        break
-                    else:
-                        j_low = j_up
-                        inc += inc
-            else:
-                j_up = j_low
-                while 1:
-                    j_low = j_low - inc
-                    if j_low <=0:
-                        j_low = 0
-                        break
-                    elif (x >= xx[j_low]) == self.ascending:
-                        break
-                    else:
-                        j_up = j_low
-                        inc += inc
-
-        # TODO: This duplicates code in _locate, could refactor.
+            j_up = j_low
+            while 1:
+                j_low = j_low - inc
+                if j_low <= 0:
+                    j_low = 0
+                    break
+                elif (x >= self.x_view[j_low]) == self.ascending:
+                    break
+                else:
+                    j_up = j_low
+                    inc += inc
+
         while j_up - j_low > 1:
 
             j_m = (j_up + j_low) / 2
 
-            if x >= xx[j_m]: # == self.ascending:
+            if (x >= self.x_view[j_m]) == self.ascending:
                 j_low = j_m
             else:
                 j_up = j_m
 
-        self.cor = 0 if abs(j_low - self.saved_j_low) > self.dj else 1
-
-        self.saved_j_low = j_low
-
         return j_low
 
     @cython.boundscheck(False)
     @cython.wraparound(False)
-    cdef int _find_idx(self, double x):
-        """Returns the index just below x in the abscissa. Either _hunt or
-        _locate is used depending on how close the last two values were each
-        other."""
-
-        if self.cor:
-            return self._hunt(x)
+    cdef int _find_idx(self, double x, int* cursor) nogil:
+        """Returns the index just below x in the abscissa and stores it in
+        cursor. The index is computed directly for uniformly spaced data.
+        Otherwise it is hunted for starting from the index in cursor."""
+
+        cdef double position
+        cdef int j
+
+        if self.uniform:
+            position = (x - self.x0) * self.inv_dx
+            # Values outside of the data are extrapolated from the first or
+            # last interval.
+            if not position >= 0.0:
+                j = 0
+            elif position >= self.n - 2:
+                j = self.n - 2
+            else:
+                j = <int> position
+            # The rounding of the position can give the neighbouring
+            # interval when x is at, or within an ulp of, a sample.
+            if self.ascending:
+                if j < self.n - 2 and x >= self.x_view[j + 1]:
+                    j += 1
+                elif j > 0 and x < self.x_view[j]:
+                    j -= 1
+            else:
+                if j < self.n - 2 and x <= self.x_view[j + 1]:
+                    j += 1
+                elif j > 0 and x > self.x_view[j]:
+                    j -= 1
+            cursor[0] = j
         else:
-            return self._locate(x)
+            cursor[0] = self._hunt(x, cursor[0])
+
+        return cursor[0]
 
     @cython.boundscheck(False)
     @cython.wraparound(False)
+    cdef void _interpolate_at(self, double x, double* y, int* cursor) nogil:
+        """Stores the interpolated ordinate values at x in y, which must
+        point to at least m doubles.
+
+        The search for the interval starts at and updates the caller's
+        cursor instead of the state of the interpolator, so this is
+        reentrant. Threads can share one interpolator as long as each
+        passes its own cursor, initially 0."""
+
+        cdef int j = self._find_idx(x, cursor)
+        cdef double dx = x - self.x_view[j]
+
+        cdef int i, k
+        cdef int last = self.coefficients_view.shape[1] - 1
+        cdef double value
+
+        # The zero order hold gives the last value from the last sample on,
+        # like SciPy, instead of the value at the start of the last interval.
+        if self.zero_order and j == self.n - 2 and (
+                (self.ascending and x >= self.x_view[self.n - 1]) or
+                (not self.ascending and x <= self.x_view[self.n - 1])):
+            for i in range(self.y_view.shape[1]):
+                y[i] = self.y_view[self.n - 1, i]
+            return
+
+        # Horner's method
+        for i in range(self.coefficients_view.shape[2]):
+            value = self.coefficients_view[j, last, i]
+            for k in range(last - 1, -1, -1):
+                value = value * dx + self.coefficients_view[j, k, i]
+            y[i] = value
+
+    cdef void _interpolate(self, double x, double* y):
+        """Stores the interpolated ordinate values at x in y, which must
+        point to at least m doubles. This can be called from
+        other Cython modules without any Python overhead. The interpolator
+        keeps the search cursor, so use _interpolate_at to share the
+        interpolator between threads."""
+
+        self._interpolate_at(x, y, &self.saved_j_low)
+
     def interpolate(self, double x,
                     np.ndarray[np.double_t, ndim=1, mode='c'] y):
-        """Returns the linear interpolation of the ordinate values.
+        """Returns the interpolated ordinate values.
 
         Parameters
         ==========
@@ -168,31 +259,53 @@ cdef class Interpolator:
 
         """
 
-        cdef np.ndarray[np.double_t, ndim=1, mode='c'] xx
-        cdef np.ndarray[np.double_t, ndim=2, mode='c'] yy
-        xx = self.x
-        yy = self.y
+        if y.shape[0] < self.y_view.shape[1]:
+            raise ValueError('y must have at least {} entries.'.format(
+                self.y_view.shape[1]))
+
+        self._interpolate(x, <double*> y.data)
+
+        return y
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def interpolate_many(self,
+                         np.ndarray[np.double_t, ndim=1, mode='c'] x,
+                         np.ndarray[np.double_t, ndim=2, mode='c'] out=None):
+        """Returns the interpolated ordinate values at many abscissa
+        values.
 
-        cdef int first, second
-        first = self._find_idx(x)
-        second = first + 1
+        Parameters
+        ==========
+        x : c contiguous ndarray, shape(k,)
+            The values of the abscissa of the desired ordinate values. The
+            search for non-uniformly spaced data is fastest if x is sorted.
+        out : c contiguous ndarray, shape(k, m), optional
+            An array to store the result in.
 
-        cdef np.ndarray[np.double_t, ndim=1, mode='c'] y_first_row
-        cdef np.ndarray[np.double_t, ndim=1, mode='c'] y_second_row
-        y_first_row = yy[first]
-        y_second_row = yy[second]
+        Returns
+        =======
+        out : c contiguous ndarray, shape(k, m)
+            The interpolated values of the ordinate.
 
-        cdef double xx_first = xx[first]
-        cdef double xx_second = xx[second]
+        """
 
+        cdef int k = x.shape[0]
+        cdef int m = self.y_view.shape[1]
         cdef int i
-        cdef int n_r, n_c
-        n_r, n_c = self.y.shape
-        cdef double m, b
+        cdef int cursor = 0
 
-        for i in range(n_c):
-            m = (y_first_row[i] - y_second_row[i]) / (xx_first - xx_second)
-            b = y_second_row[i] - m * xx_second
-            y[i] = m * x + b
+        if out is None:
+            out = np.empty((k, m), dtype=float)
+        elif out.shape[0] != k or out.shape[1] != m:
+            raise ValueError('out must have shape ({}, {}).'.format(k, m))
 
-        return y
+        cdef double* xx = <double*> x.data
+        cdef double* yy = <double*> out.data
+
+        # The cursor is local, so many threads can call this at once.
+        with nogil:
+            for i in range(k):
+                self._interpolate_at(xx[i], yy + i * m, &cursor)
+
+        return out
@@ -8,27 +8,29 @@ import os
 
 import numpy as np
 from scipy.ndimage.filters import uniform_filter
-from progressbar import ProgressBar
 from matplotlib import cm
 import matplotlib.pyplot as plt
 # this import is required for the projection='3d' to work
 from mpl_toolkits.mplot3d.axes3d import Axes3D
 import logbook
 
-from model import QuietStandingModel
-import indirect_collocation
+import collocation_sweep
 import direct_identification
 import utils
 
 KNOWN_GAINS = np.array([[950.0, 175.0, 185.0, 50.0],
                         [45.0, 290.0, 60.0, 26.0]])
 
+PATHS = utils.config_paths()
+
 file_names = {'input_data': 'bias_comparison_input_data.npz',
               'direct_results': 'directly-identified-gains.npy',
-              'indirect_results': 'indirectly-indentified-gains.npz',
-              'indirect_times': 'indirect-times.npz',
-              'indirect_status': 'indirect-status.npz'}
-file_paths = {k: os.path.join(utils.config_paths(), v) for k, v in
+              'indirect_results': 'indirectly-identified-gains.npy',
+              'indirect_times': 'indirect-times.npy',
+              'indirect_status': 'indirect-status.npy',
+              'indirect_status_csv': 'indirect-status.csv',
+              'indirect_cells': 'indirect-cells'}
+file_paths = {k: os.path.join(PATHS['processed_data_dir'], v) for k, v in
               file_names.items()}
 
 # TODO : This is a bad hack. Fix.
@@ -42,10 +44,9 @@ from generate_bias_comparison_input_data import (ref_noise_stds,
 
 
 def identify_gains_indirectly():
-    # create a Problem for each of the platform eaccelerations because that
-    # is although it seems like you may be able to change out the
-    # known_trajectory_map dynamically in the constrain collocator.  the obj
-    # and obj_grad is easily subbed out
+    """Returns the indirectly identified gains of every trial. The trials
+    are solved in parallel and each result is stored as soon as it is
+    found, so an interrupted run continues with the remaining trials."""
 
     if os.path.isfile(file_paths['indirect_results']):
 
@@ -55,87 +56,39 @@ def identify_gains_indirectly():
     else:
         logbook.info('Indirectly identifying gains.')
 
-        n = len(ref_noise_stds)
-        m = len(platform_pos_mags)
+        num_nodes = measured_states[0, 0].shape[0]
+        duration = 5.0  # TODO : This should be in the generated data.
+        time_interval = duration / (num_nodes - 1)
+
+        ipopt_options = {'print_level': 0,
+                         'sb': "yes",  # suppress IPOPT banner
+                         'linear_solver': 'ma57',
+                         'max_iter': 300,
+                         # 3 seconds will take 8 hrs for 10200 trials
+                         # 5 seconds will take 14 hrs, on a single core
+                         'max_cpu_time': 6.0}
 
-        shape = (n, m, KNOWN_GAINS.size)
-        identified_gains = np.empty(shape, dtype=float)
+        store = collocation_sweep.CellStore(file_paths['indirect_cells'])
 
-        status_nums = np.empty((n, m), dtype=int)
-        times = np.empty((n, m), dtype=float)
+        results = collocation_sweep.identify_grid(
+            measured_states, measured_accel, time_interval, store,
+            scaled_gains=0.5, ipopt_options=ipopt_options)
 
-        model = QuietStandingModel(scaled_gains=0.5)
-        model.derive()
+        logbook.info('Sweep done.')
 
-        num_nodes = measured_states[0, 0].shape[0]
-        duration = 5.0  # TODO : This should be in the generated data.
-        time_interval = duration / (num_nodes - 1)
+        identified_gains = results['gains']
 
-        # set the problem up with some dummy inputs
-        prob = indirect_collocation.setup_problem(num_nodes, time_interval,
-                                                  measured_states[0, 0].T.flatten(),
-                                                  measured_accel[0, 0],
-                                                  model)
-
-        prob.addOption('print_level', 0)
-        prob.addOption('sb', "yes")  # suppress IPOPT banner
-        prob.addOption('linear_solver', 'ma57')
-        prob.addOption('max_iter', 300)
-        # 3 seconds will take 8 hrs for 10200 trials
-        # 5 seconds will take 14 hrs
-        prob.addOption('max_cpu_time', 6.0)
-
-        acc_sym = model.specifieds['platform_acceleration']
-        initial_guess = np.zeros(prob.num_free)
-        # Give it the known gains as a guess, because all we care about is
-        # how the optimal solution is affected by the accel and noise.
-        initial_guess[-8:] = model.numerical_gains.flatten()
-
-        f = open('status.csv', 'w')
-        f.write('i,j,status,status_msg\n')
-
-        logbook.info('Staring loop.')
-
-        pbar = ProgressBar(maxval=n * m)
-        pbar.start()
-
-        count = 0
-        for i in range(n):
-            for j in range(m):
-
-                x_meas_vec = measured_states[i, j].T.flatten()
-                initial_guess[:-8] = x_meas_vec
-                prob.obj = indirect_collocation.nlp_obj(
-                    num_nodes, time_interval, x_meas_vec)
-                prob.obj_grad = indirect_collocation.nlp_obj_grad(
-                    num_nodes, time_interval, x_meas_vec)
-                prob.collocator.known_trajectory_map[acc_sym] = measured_accel[i, j]
-                # TODO : Time this call.
-                @utils.timeit
-                def solve():
-                    solution, info = prob.solve(initial_guess)
-                    return solution, info
-                solution, info, time = solve()
-                times[i, j] = time
-                status_nums[i, j] = int(info['status'])
-                line = '{},{},{},{}\n'.format(i, j, info['status'], info['status_msg'])
-                f.write(line)
-                # TODO : Capture if it doesn't find a solution.
-                identified_gains[i, j, :] = \
-                    model.gain_scale_factors.flatten() * solution[-8:]
-
-                pbar.update(count)
-                count += 1
-
-        logbook.info('Loop done.')
-
-        f.close()
-
-        pbar.finish()
+        with open(file_paths['indirect_status_csv'], 'w') as f:
+            f.write('i,j,status,status_msg,iterations,time,warm_start\n')
+            for i, j in sorted(store.completed()):
+                cell = store.load(i, j)
+                f.write('{},{},{},{},{},{},{}\n'.format(
+                    i, j, cell['status'], cell['status_msg'],
+                    cell['iterations'], cell['time'], cell['warm_start']))
 
         np.save(file_paths['indirect_results'], identified_gains)
-        np.save(file_paths['indirect_status'], status_nums)
-        np.save(file_paths['indirect_times'], times)
+        np.save(file_paths['indirect_status'], results['status'])
+        np.save(file_paths['indirect_times'], results['time'])
 
     return identified_gains
 
@@ -150,30 +103,8 @@ def identify_gains_directly():
     else:
         print('Directly identifying gains.')
 
-        n = len(ref_noise_stds)
-        m = len(platform_pos_mags)
-
-        shape = (n, m, KNOWN_GAINS.size)
-        identified_gains = np.empty(shape, dtype=float)
-
-        pbar = ProgressBar(maxval=len(ref_noise_stds) * len(platform_pos_mags))
-        pbar.start()
-
-        count = 0
-
-        for i in range(n):
-            for j in range(m):
-
-                direct_gains = direct_identification.identify(
-                    measured_joint_torques[i, j],
-                    measured_states[i, j])
-
-                identified_gains[i, j, :] = direct_gains
-
-                pbar.update(count)
-                count += 1
-
-        pbar.finish()
+        identified_gains = direct_identification.identify_batch(
+            measured_joint_torques, measured_states)[0]
 
         np.save(file_paths['direct_results'], identified_gains)
 
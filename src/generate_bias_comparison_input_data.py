@@ -7,16 +7,16 @@ import os
 
 import numpy as np
 from progressbar import ProgressBar
-from joblib import Parallel, delayed
 
 from model import QuietStandingModel
-from measured_data import DataGenerator
+from measured_data import reference_noise, platform_acceleration
 import utils
 
 NUM_GAINS = 8
 
 file_name = 'bias_comparison_input_data.npz'
-file_path = os.path.join(utils.config_paths(), file_name)
+file_path = os.path.join(utils.config_paths()['processed_data_dir'],
+                         file_name)
 
 if os.path.isfile(file_path):
 
@@ -45,11 +45,9 @@ else:
     max_ref_noise_std = 0.04  # radians and radian/sec
     max_platform_pos_mag = 0.1  # meters
 
-    # All measurement noise is set to zero.
-    platform_accel_noise_std = 0.0
-    coordinate_noise_std = 0.0
-    speed_noise_std = 0.0
-    torque_noise_std = 0.0
+    # The trials are simulated together in chunks of this many rows of the
+    # grid to limit the memory used by the integrator.
+    rows_per_chunk = 25
 
     # Generate the symbolic dynamic model.
     model = QuietStandingModel()
@@ -61,6 +59,8 @@ else:
     platform_pos_mags = np.linspace(0.0, max_platform_pos_mag,
                                     num=num_platform_pos_mags)
 
+    time = np.linspace(0.0, duration, num=num_nodes)
+
     # Create empty arrays to store all generated data.
     platform_acc_stds = np.empty((num_ref_noise_stds,
                                   num_platform_pos_mags), dtype=float)
@@ -74,62 +74,46 @@ else:
                                        num_platform_pos_mags, num_nodes, 2),
                                       dtype=float)
 
-    # Create this object and generate the rhs once (internally), then we'll
-    # just switch out the ref_noise and platform_position each time in the
-    # loop without having to regenerate the rhs function.
-    data = DataGenerator(duration, num_nodes, ref_noise_stds[0],
-                         platform_pos_mags[0], model=model)
-    data.generate(platform_accel_noise_std, coordinate_noise_std,
-                  speed_noise_std, torque_noise_std)
+    for i, ref_noise_std in enumerate(ref_noise_stds):
+        for j, platform_pos_mag in enumerate(platform_pos_mags):
+            reference_noises[i, j] = reference_noise(num_nodes,
+                                                     ref_noise_std)
+            measured_accel[i, j] = platform_acceleration(time,
+                                                         platform_pos_mag)
 
-    pbar = ProgressBar(maxval=len(ref_noise_stds))
+    pbar = ProgressBar(maxval=num_ref_noise_stds)
     pbar.start()
 
-    def gen(platform_pos_mag):
-
-        # This is necessary so that each forked process gets the seed reset.
-        np.random.seed()
+    for start in range(0, num_ref_noise_stds, rows_per_chunk):
 
-        data.platform_pos_mag = platform_pos_mag
+        rows = slice(start, start + rows_per_chunk)
+        num_rows = len(ref_noise_stds[rows])
+        num_trials = num_rows * num_platform_pos_mags
 
-        data._generate_model_inputs()
-        # Skip the rhs generation call but change out the variables
-        # needed in the controller function. This can only be done if
-        # the size of ref_noise and actual['a'] do not change in this
-        # loop. This saves computation time.
-        data.model.all_sigs[:, :] = np.hstack(
-            (data.ref_noise, np.expand_dims(data.actual['a'], 1)))
-        data._generate_simulation_outputs()
-        data._generate_measured_outputs()
+        x_n = reference_noises[rows].reshape(num_trials, num_nodes, 4)
+        a = measured_accel[rows].reshape(num_trials, num_nodes)
 
-        x_n = data.actual['x_n']
-        a = data.measured['a']
-        x = data.measured['x']
-        u = data.measured['u']
+        x = model.simulate_ensemble(time, x_n, a)
 
-        return x_n, a, x, u
-
-    for i, ref_noise_std in enumerate(ref_noise_stds):
+        # Back out the torques used in the control.
+        u = np.dot(x_n - x, model.numerical_gains.T)
 
-        data.ref_noise_std = ref_noise_std
+        # All measurement noise is set to zero, so the measured values are
+        # the actual values.
+        measured_states[rows] = x.reshape(num_rows, num_platform_pos_mags,
+                                          num_nodes, 4)
+        measured_joint_torques[rows] = u.reshape(num_rows,
+                                                 num_platform_pos_mags,
+                                                 num_nodes, 2)
 
-        res = Parallel(n_jobs=-1)(delayed(gen)(platform_pos_mag) for
-                                  platform_pos_mag in platform_pos_mags)
-
-        for j, (x_n, a, x, u) in enumerate(res):
-
-            platform_acc_stds[i, j] = a.std()
-            reference_noises[i, j, :, :] = x_n
-            measured_accel[i, j, :] = a
-            measured_states[i, j, :, :] = x
-            measured_joint_torques[i, j, :, :] = u
-
-        pbar.update(i)
+        pbar.update(start + num_rows - 1)
 
     pbar.finish()
 
+    platform_acc_stds[:, :] = measured_accel.std(axis=2)
+
     np.savez(file_path,
-             time=data.time,
+             time=time,
              ref_noise_stds=ref_noise_stds,
              platform_pos_mags=platform_pos_mags,
              platform_acc_stds=platform_acc_stds,
@@ -1,11 +1,29 @@
 #!/usr/bin/env python
 
+import time
+
 import numpy as np
+from scipy import sparse
+from scipy.sparse.linalg import splu
+from scipy.optimize import lsq_linear
 from logbook import Logger
 from opty.direct_collocation import Problem
 
 log = Logger('Log')
 
+# IPOPT options of a solve that starts from the primal and dual solution of a
+# nearby problem and their defaults, which are used for cold starts. The
+# interior point is not pushed away from the bounds and the barrier parameter
+# starts small, otherwise most of the information in the guess is lost.
+WARM_START_OPTIONS = {'warm_start_init_point': 'yes',
+                      'warm_start_bound_push': 1e-9,
+                      'warm_start_mult_bound_push': 1e-9,
+                      'mu_init': 1e-6}
+COLD_START_OPTIONS = {'warm_start_init_point': 'no',
+                      'warm_start_bound_push': 1e-3,
+                      'warm_start_mult_bound_push': 1e-3,
+                      'mu_init': 0.1}
+
 
 def nlp_obj(num_nodes, interval, measured_states):
     """Returns a function that evaluates the least square error between the
@@ -64,6 +82,97 @@ def nlp_obj_grad(num_nodes, interval, measured_states):
     return obj_grad
 
 
+def interpolation_matrix(node_times, sample_times):
+    """Returns a sparse matrix, W, that linearly interpolates values at
+    uniformly spaced nodes to the sample times, i.e. the values at the
+    sample times are W * x where x are the values at the nodes. Samples
+    outside of the nodes are extrapolated from the first or last interval.
+
+    Parameters
+    ==========
+    node_times : ndarray, shape(n,)
+        The uniformly spaced times of the nodes.
+    sample_times : ndarray, shape(M,)
+        The times of the samples.
+
+    Returns
+    =======
+    W : scipy.sparse.csr_matrix, shape(M, n)
+
+    """
+
+    num_nodes = len(node_times)
+    num_samples = len(sample_times)
+
+    position = ((sample_times - node_times[0]) /
+                (node_times[1] - node_times[0]))
+    lower = np.clip(np.floor(position).astype(int), 0, num_nodes - 2)
+    weight = position - lower
+
+    rows = np.hstack((np.arange(num_samples), np.arange(num_samples)))
+    cols = np.hstack((lower, lower + 1))
+    vals = np.hstack((1.0 - weight, weight))
+
+    return sparse.csr_matrix((vals, (rows, cols)),
+                             shape=(num_samples, num_nodes))
+
+
+def nlp_obj_interpolated(num_nodes, interval, measured_states, matrix):
+    """Returns a function that evaluates the least square error between the
+    simulated states, interpolated to the sample times, and the measured
+    states for the NLP problem.
+
+    Parameters
+    ==========
+    num_nodes : integer
+        The number of time nodes.
+    interval : float
+        The time interval between the samples.
+    measured_states : ndarray, shape(4 * M,)
+        The flattened measured state time trajectories.
+    matrix : scipy.sparse matrix, shape(M, num_nodes)
+        The interpolation matrix from the nodes to the samples, see
+        interpolation_matrix().
+
+    """
+    measured = measured_states.reshape(4, -1)
+
+    def obj(free):
+        simulated = matrix.dot(free[:4 * num_nodes].reshape(4, num_nodes).T)
+        return interval * np.sum((measured - simulated.T)**2)
+    return obj
+
+
+def nlp_obj_grad_interpolated(num_nodes, interval, measured_states, matrix):
+    """Returns a function that evaluates the gradient of the least square
+    error between the simulated states, interpolated to the sample times,
+    and the measured states for the NLP problem.
+
+    Parameters
+    ==========
+    num_nodes : integer
+        The number of time nodes.
+    interval : float
+        The time interval between the samples.
+    measured_states : ndarray, shape(4 * M,)
+        The flattened measured state time trajectories.
+    matrix : scipy.sparse matrix, shape(M, num_nodes)
+        The interpolation matrix from the nodes to the samples, see
+        interpolation_matrix().
+
+    """
+    measured = measured_states.reshape(4, -1)
+    matrix_transpose = matrix.T.tocsr()
+
+    def obj_grad(free):
+        simulated = matrix.dot(free[:4 * num_nodes].reshape(4, num_nodes).T)
+        grad = np.zeros_like(free)
+        grad[:4 * num_nodes] = -2.0 * interval * matrix_transpose.dot(
+            measured.T - simulated).T.flatten()
+        return grad
+    return obj_grad
+
+
 def setup_problem(num_nodes, time_interval, measured_states,
                   measured_platform_accel, model):
     """Returns the optimal gains using indirect identification via direct
@@ -116,6 +225,414 @@ def setup_problem(num_nodes, time_interval, measured_states,
     return prob
 
 
+class CollocationIdentifier(object):
+
+    def __init__(self, model, num_nodes, time_interval, ipopt_options=None,
+                 num_samples=None):
+        """This class identifies the gains with indirect identification via
+        direct collocation for any number of trials with the same number of
+        nodes and time interval. The collocation problem is set up once and
+        the measurements of each new trial are copied into the arrays that
+        the objective and constraint functions read, so no symbolic or
+        compilation work is repeated.
+
+        Parameters
+        ==========
+        model : instance of QuietStandingModel
+            This should be a model which has already be derived.
+        num_nodes : integer
+            The number of collocation nodes.
+        time_interval : float
+            The time in seconds between the nodes.
+        ipopt_options : dictionary, optional
+            IPOPT options to add to the problem.
+        num_samples : integer, optional
+            The number of measured samples, uniformly spaced over the same
+            duration as the nodes. Defaults to one sample at each node. If
+            it differs, the objective compares the measured states to the
+            node states linearly interpolated to the sample times and the
+            platform acceleration is interpolated to the nodes, so the size
+            of the problem depends on the number of nodes only.
+
+        """
+
+        if num_samples is None:
+            num_samples = num_nodes
+
+        self.model = model
+        self.num_nodes = num_nodes
+        self.num_samples = num_samples
+        self.time_interval = time_interval
+
+        duration = time_interval * (num_nodes - 1)
+        self.node_times = np.linspace(0.0, duration, num=num_nodes)
+        self.sample_times = np.linspace(0.0, duration, num=num_samples)
+
+        # The objective and the constraints always read these arrays.
+        self.measured_states = np.zeros(4 * num_samples)
+        self.measured_accel = np.zeros(num_nodes)
+
+        self.prob = setup_problem(num_nodes, time_interval,
+                                  np.zeros((num_nodes, 4)),
+                                  self.measured_accel, model)
+
+        if num_samples == num_nodes:
+            self._obj = nlp_obj(num_nodes, time_interval,
+                                self.measured_states)
+            self._obj_grad = nlp_obj_grad(num_nodes, time_interval,
+                                          self.measured_states)
+            self._sample_interval = time_interval
+            # Maps the node states to the measured states.
+            self._state_map = sparse.identity(4 * num_nodes, format='csr')
+        else:
+            matrix = interpolation_matrix(self.node_times, self.sample_times)
+            sample_interval = duration / (num_samples - 1)
+            self._obj = nlp_obj_interpolated(num_nodes, sample_interval,
+                                             self.measured_states, matrix)
+            self._obj_grad = nlp_obj_grad_interpolated(
+                num_nodes, sample_interval, self.measured_states, matrix)
+            self._sample_interval = sample_interval
+            self._state_map = sparse.kron(sparse.identity(4), matrix,
+                                          format='csr')
+
+        # A quadratic penalty on the distance of the scaled gains from a
+        # target can be added to the objective, see set_gain_penalty().
+        self.gain_penalty = 0.0
+        self.gain_target = np.zeros(8)
+
+        self.prob.obj = self.objective
+        self.prob.obj_grad = self.objective_gradient
+
+        # The problem must refer to the same array as this object.
+        acc_sym = model.specifieds['platform_acceleration']
+        self.prob.collocator.known_trajectory_map[acc_sym] = \
+            self.measured_accel
+
+        if ipopt_options is None:
+            ipopt_options = {}
+        self.ipopt_options = ipopt_options
+
+        for k, v in ipopt_options.items():
+            self.prob.addOption(k, v)
+
+    def update(self, measured_states, measured_accel):
+        """Replaces the measurements that the gains are identified from.
+
+        Parameters
+        ==========
+        measured_states : ndarray, shape(num_samples, 4)
+            The measured state trajectories.
+        measured_accel : ndarray, shape(num_samples,)
+            The measured platform acceleration.
+
+        """
+
+        self.measured_states[:] = np.asarray(measured_states).T.flatten()
+
+        if self.num_samples == self.num_nodes:
+            self.measured_accel[:] = measured_accel
+        else:
+            self.measured_accel[:] = np.interp(self.node_times,
+                                               self.sample_times,
+                                               measured_accel)
+
+    def set_gain_penalty(self, weight, target):
+        """Adds weight * ||g - target||^2 to the objective, where g are the
+        scaled gains. This couples problems that share the gains, e.g. the
+        windows of a long trial. A weight of zero removes the penalty.
+
+        Parameters
+        ==========
+        weight : float
+            The weight of the penalty.
+        target : array_like, shape(8,)
+            The scaled gains that the solution is pulled towards.
+
+        """
+
+        self.gain_penalty = weight
+        self.gain_target[:] = np.asarray(target).flatten()
+
+    def objective(self, free):
+        """Returns the value of the objective at the free variables."""
+
+        value = self._obj(free)
+
+        if self.gain_penalty > 0.0:
+            value += self.gain_penalty * np.sum((free[-8:] -
+                                                 self.gain_target)**2)
+
+        return value
+
+    def objective_gradient(self, free):
+        """Returns the gradient of the objective at the free variables."""
+
+        grad = self._obj_grad(free)
+
+        if self.gain_penalty > 0.0:
+            grad[-8:] += 2.0 * self.gain_penalty * (free[-8:] -
+                                                    self.gain_target)
+
+        return grad
+
+    def initial_guess(self, gains=None):
+        """Returns an initial guess of the free variables made of the
+        measured states and the provided scaled gains, which default to
+        zero."""
+
+        initial_guess = np.zeros(self.prob.num_free)
+
+        if self.num_samples == self.num_nodes:
+            initial_guess[:4 * self.num_nodes] = self.measured_states
+        else:
+            measured = self.measured_states.reshape(4, self.num_samples)
+            initial_guess[:4 * self.num_nodes] = np.hstack(
+                [np.interp(self.node_times, self.sample_times, x)
+                 for x in measured])
+
+        if gains is not None:
+            initial_guess[-8:] = np.asarray(gains).flatten()
+
+        return initial_guess
+
+    @property
+    def multipliers(self):
+        """The constraint and the lower and upper bound multipliers of the
+        last solution, which can be used to warm start the next solve."""
+
+        return (self.info['mult_g'], self.info['mult_x_L'],
+                self.info['mult_x_U'])
+
+    def identify(self, initial_guess=None, multipliers=None):
+        """Returns the identified gains for the current measurements.
+
+        Parameters
+        ==========
+        initial_guess : ndarray, shape(n,), optional
+            The initial guess of the free variables, defaults to zeros.
+        multipliers : tuple of ndarray, optional
+            The constraint and the lower and upper bound multipliers of a
+            nearby problem, see the multipliers attribute. If given, IPOPT
+            is warm started from them and the initial guess, which should be
+            the solution of the same problem.
+
+        Returns
+        =======
+        identified_gains : ndarray, shape(8,)
+            The optimal gains found by direct collocation.
+
+        Notes
+        =====
+        The solution, the IPOPT info dictionary and the number of
+        iterations of the solve are stored in the ``solution``, ``info``
+        and ``iterations`` attributes.
+
+        """
+
+        if initial_guess is None:
+            initial_guess = np.zeros(self.prob.num_free)
+
+        if multipliers is None:
+            options = COLD_START_OPTIONS
+        else:
+            options = WARM_START_OPTIONS
+
+        for k, v in options.items():
+            self.prob.addOption(k, self.ipopt_options.get(k, v))
+
+        # The objective value is appended at every iteration.
+        del self.prob.obj_value[:]
+
+        if multipliers is None:
+            self.solution, self.info = self.prob.solve(initial_guess)
+        else:
+            lagrange, zl, zu = multipliers
+            self.solution, self.info = self.prob.solve(
+                initial_guess, lagrange=lagrange, zl=zl, zu=zu)
+        self.iterations = len(self.prob.obj_value)
+
+        return self.model.gain_scale_factors.flatten() * self.solution[-8:]
+
+    def _constraint_jacobian(self, free):
+        """Returns the sparse Jacobian of the constraints with respect to
+        the free variables."""
+
+        rows, cols = self.prob.jacobianstructure()
+
+        return sparse.csr_matrix((self.prob.jacobian(free), (rows, cols)),
+                                 shape=(self.prob.num_constraints,
+                                        self.prob.num_free))
+
+    def _project(self, states):
+        """Returns the scaled gains, within their bounds, that minimize the
+        sum of the squared defects of the state trajectory, the remaining
+        defects, an orthonormal basis of the range of the defect's Jacobian
+        with respect to the gains that are not at a bound and the Jacobian
+        of the defects with respect to the states at the optimal gains."""
+
+        n = 4 * self.num_nodes
+
+        # The defects are linear in the gains, so the Jacobian with respect
+        # to the gains is exact at any gains.
+        free = np.hstack((states, np.zeros(8)))
+        defects = self.prob.constraints(free)
+        regressor = self._constraint_jacobian(free)[:, n:].toarray()
+
+        result = lsq_linear(regressor, -defects, bounds=(0.0, 1.0),
+                            method='bvls')
+        gains = result.x
+
+        defects = defects + np.dot(regressor, gains)
+
+        inside = regressor[:, result.active_mask == 0]
+        if inside.shape[1] > 0:
+            u, s, vt = np.linalg.svd(inside, full_matrices=False)
+            basis = u[:, s > s[0] * max(inside.shape) * np.finfo(float).eps]
+        else:
+            basis = np.zeros((len(defects), 0))
+
+        state_jacobian = self._constraint_jacobian(
+            np.hstack((states, gains)))[:, :n]
+
+        return gains, defects, basis, state_jacobian
+
+    def identify_projected(self, initial_states=None, weight=1e4,
+                           max_iterations=500, tolerance=1e-10,
+                           step_tolerance=1e-8):
+        """Returns the identified gains for the current measurements found
+        by variable projection. The defects of the discretized equations of
+        motion are linear in the gains, so for any state trajectory the
+        gains that minimize the sum of the squared defects are found with a
+        small bounded linear least squares problem. This leaves a nonlinear
+        least squares problem in the states only, which minimizes the
+        squared state error plus the weighted sum of the squared defects
+        that remain after the gains are eliminated.
+
+        It is solved with the Levenberg-Marquardt method. The Jacobian of
+        the remaining defects is the state Jacobian projected onto the
+        complement of the range of the gain Jacobian (Kaufman's
+        simplification), which is a sparse matrix plus a low rank matrix,
+        so each step is a sparse factorization and a few extra solves.
+
+        Parameters
+        ==========
+        initial_states : ndarray, shape(4 * num_nodes,), optional
+            The initial guess of the flattened node states, defaults to the
+            measured states.
+        weight : float, optional
+            The weight of the squared defects. The larger the weight the
+            closer the solution is to one that satisfies the equations of
+            motion exactly, like the one found by identify().
+        max_iterations : integer, optional
+            The maximum number of Levenberg-Marquardt steps.
+        tolerance : float, optional
+            The solve stops when a step reduces the cost by less than this
+            fraction.
+        step_tolerance : float, optional
+            The solve stops when the norm of a step is less than this
+            fraction of the norm of the states.
+
+        Returns
+        =======
+        identified_gains : ndarray, shape(8,)
+            The optimal gains.
+
+        Notes
+        =====
+        The solution and the number of steps are stored in the ``solution``
+        and ``iterations`` attributes. The final 'cost', whether the solve
+        'converged' and the number of cost 'evaluations' are stored in the
+        ``projection_info`` dictionary.
+
+        """
+
+        if initial_states is None:
+            initial_states = self.initial_guess()[:4 * self.num_nodes]
+
+        state_map = self._state_map
+        sqrt_interval = np.sqrt(self._sample_interval)
+        sqrt_weight = np.sqrt(weight)
+
+        state_normal = sqrt_interval**2 * state_map.T.dot(state_map)
+
+        def evaluate(states):
+            gains, defects, basis, state_jacobian = self._project(states)
+            state_residuals = sqrt_interval * (state_map.dot(states) -
+                                               self.measured_states)
+            defect_residuals = sqrt_weight * defects
+            cost = 0.5 * (np.sum(state_residuals**2) +
+                          np.sum(defect_residuals**2))
+            return (cost, gains, state_residuals, defect_residuals, basis,
+                    state_jacobian)
+
+        states = initial_states
+        current = evaluate(states)
+        evaluations = 1
+        damping = 1e-3
+        converged = False
+
+        iteration = 0
+        while iteration < max_iterations and not converged:
+            iteration += 1
+
+            (cost, gains, state_residuals, defect_residuals, basis,
+             state_jacobian) = current
+
+            # The gains are optimal for the states, so the gradient is the
+            # one with the gains held fixed.
+            gradient = (sqrt_interval * state_map.T.dot(state_residuals) +
+                        sqrt_weight * state_jacobian.T.dot(defect_residuals))
+
+            # The Gauss-Newton matrix of the projected Jacobian is the sparse
+            # normal matrix less the low rank correction, J'J = A - C C'.
+            normal = (state_normal +
+                      weight * state_jacobian.T.dot(state_jacobian))
+            correction = sqrt_weight * state_jacobian.T.dot(basis)
+
+            while True:
+
+                damped = normal + damping * sparse.diags(normal.diagonal())
+                lu = splu(damped.tocsc())
+
+                # Woodbury identity for the low rank part.
+                step = lu.solve(-gradient)
+                solved_correction = lu.solve(correction)
+                capacitance = (np.eye(correction.shape[1]) -
+                               np.dot(correction.T, solved_correction))
+                step += np.dot(solved_correction,
+                               np.linalg.solve(capacitance,
+                                               np.dot(correction.T, step)))
+
+                trial = evaluate(states + step)
+                evaluations += 1
+
+                if trial[0] < cost:
+                    states = states + step
+                    current = trial
+                    damping = max(damping / 3.0, 1e-12)
+                    converged = (cost - trial[0] < tolerance * cost or
+                                 np.linalg.norm(step) < step_tolerance *
+                                 np.linalg.norm(states))
+                    break
+                elif damping > 1e12:
+                    # No step reduces the cost, so this is a minimum to
+                    # machine precision.
+                    converged = True
+                    break
+                else:
+                    damping *= 4.0
+
+        gains = current[1]
+
+        self.solution = np.hstack((states, gains))
+        self.iterations = iteration
+        self.projection_info = {'cost': current[0],
+                                'converged': converged,
+                                'evaluations': evaluations}
+
+        return self.model.gain_scale_factors.flatten() * gains
+
+
 def identify(num_nodes, time_interval, measured_states,
              measured_platform_accel, model):
     """Returns the optimal gains using indirect identification via direct
@@ -141,14 +658,92 @@ def identify(num_nodes, time_interval, measured_states,
 
     """
 
-    prob = setup_problem(num_nodes, time_interval, measured_states,
-                         measured_platform_accel, model)
-
-    initial_guess = np.zeros(prob.num_free)
+    ider = CollocationIdentifier(model, num_nodes, time_interval)
+    ider.update(measured_states, measured_platform_accel)
 
     # TODO : Time this solve command.
-    solution, info = prob.solve(initial_guess)
+    return ider.identify()
+
+
+def identify_multilevel(time_interval, measured_states,
+                        measured_platform_accel, model, factors=(16, 4, 1),
+                        ipopt_options=None):
+    """Returns the optimal gains using indirect identification via direct
+    collocation solved on a sequence of finer and finer meshes. The first
+    level has a node at every factors[0]-th sample and starts from the
+    measured states and zero gains. Each following level starts from the
+    states of the previous solution, linearly interpolated to its nodes, and
+    the previous gains. The coarse levels are cheap and leave few iterations
+    for the fine ones.
+
+    Parameters
+    ==========
+    time_interval : float
+        The time in seconds between the samples.
+    measured_states : ndarray, shape(N, 4)
+        The measured state trajectories.
+    measured_platform_accel : ndarray, shape(N,)
+        The measured platform acceleration.
+    model : instance of QuietStandingModel
+        This should be a model which has already be derived.
+    factors : sequence of integers, optional
+        The number of samples between the nodes of each level. The last
+        factor should be 1 to identify the gains from all of the samples.
+    ipopt_options : dictionary, optional
+        The IPOPT options of every level.
+
+    Returns
+    =======
+    results : dictionary
+        The identified 'gains', shape(8,), and a list of the 'levels' with
+        the 'num_nodes', 'setup_time', 'solve_time', 'iterations' and IPOPT
+        'status' of each level.
+
+    """
+
+    num_nodes = measured_states.shape[0]
+    times = time_interval * np.arange(num_nodes)
+
+    levels = []
+    previous = None
+
+    for factor in factors:
+
+        indices = np.arange(0, num_nodes, factor)
+        level_num_nodes = len(indices)
+
+        log.info('Solving the level with {} nodes.'.format(level_num_nodes))
+
+        start = time.time()
+        ider = CollocationIdentifier(model, level_num_nodes,
+                                     factor * time_interval,
+                                     ipopt_options=ipopt_options)
+        setup_time = time.time() - start
+
+        ider.update(measured_states[indices],
+                    measured_platform_accel[indices])
+
+        if previous is None:
+            initial_guess = ider.initial_guess()
+        else:
+            previous_times, previous_states, previous_gains = previous
+            states = np.array([np.interp(times[indices], previous_times, x)
+                               for x in previous_states])
+            initial_guess = np.hstack((states.flatten(), previous_gains))
+
+        start = time.time()
+        identified_gains = ider.identify(initial_guess)
+        solve_time = time.time() - start
+
+        previous = (times[indices],
+                    ider.solution[:4 * level_num_nodes].reshape(
+                        4, level_num_nodes),
+                    ider.solution[-8:])
 
-    identified_gains = model.gain_scale_factors.flatten() * solution[-8:]
+        levels.append({'num_nodes': level_num_nodes,
+                       'setup_time': setup_time,
+                       'solve_time': solve_time,
+                       'iterations': ider.iterations,
+                       'status': int(ider.info['status'])})
 
-    return identified_gains
+    return {'gains': identified_gains, 'levels': levels}
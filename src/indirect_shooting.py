@@ -12,13 +12,19 @@
 
 """
 
+import os
+import atexit
+import shutil
+import tempfile
 import multiprocessing as mp
 
 import numpy as np
 from scipy.integrate import odeint
-from scipy.optimize import minimize
+from scipy.optimize import minimize, least_squares
 import cma
 
+import cache
+
 # TODO : Make sure that we are simulating with the MEASURED platform
 # acceleration. The identification simluations should be using the measured
 # values not the actual values.
@@ -47,7 +53,7 @@ def sum_of_squares(measured_states, simulated_states, interval=1.0):
 
 
 def objective(gain_matrix, model, rhs, initial_conditions, time_vector,
-              rhs_args, measured_state_trajectory):
+              rhs_args, measured_state_trajectory, jac=None):
     """
     Parameters
     ==========
@@ -56,6 +62,10 @@ def objective(gain_matrix, model, rhs, initial_conditions, time_vector,
     K = [k_00, k_01, k_02, k_03]
         [k_10, k_11, k_12, k_13]
 
+    jac : function, optional
+        A function, J(x, t, *rhs_args), that evaluates the Jacobian of the
+        rhs with respect to the states. It is passed to odeint as Dfun.
+
     """
     print('Shooting...')
     print('Trying gains: {}'.format(gain_matrix))
@@ -68,7 +78,8 @@ def objective(gain_matrix, model, rhs, initial_conditions, time_vector,
     model_state_trajectory = odeint(rhs,
                                     initial_conditions,
                                     time_vector,
-                                    args=rhs_args)
+                                    args=rhs_args,
+                                    Dfun=jac)
 
     s = sum_of_squares(measured_state_trajectory, model_state_trajectory)
 
@@ -77,8 +88,395 @@ def objective(gain_matrix, model, rhs, initial_conditions, time_vector,
     return s
 
 
+def shooting_residuals(gains, runtime, measured_states, gain_scale_factors):
+    """Returns the differences between the simulated and the measured
+    states and their exact partial derivatives with respect to the scaled
+    gains, from a single integration of the states and their sensitivity
+    equations.
+
+    Parameters
+    ==========
+    gains : array_like, shape(8,)
+        The scaled gains.
+    runtime : runtime.ClosedLoopRuntime
+        The closed loop system with its input signals.
+    measured_states : ndarray, shape(N, 4)
+        The measured state trajectories.
+    gain_scale_factors : ndarray, shape(2, 4)
+        The factors, S, that give the closed loop gains, S .* K.
+
+    Returns
+    =======
+    residuals : ndarray, shape(4 * N,)
+        The flattened state errors.
+    jacobian : ndarray, shape(4 * N, 8)
+        The derivatives of the residuals with respect to the scaled gains.
+
+    """
+
+    scale_factors = np.asarray(gain_scale_factors, dtype=float).flatten()
+
+    simulated_states, sensitivities = runtime.simulate_sensitivities(
+        scale_factors * np.asarray(gains, dtype=float).flatten())
+
+    residuals = (simulated_states - measured_states).flatten()
+
+    # dx/dK = dx/dg * S
+    jacobian = (sensitivities * scale_factors).reshape(-1, len(scale_factors))
+
+    return residuals, jacobian
+
+
+def objective_and_gradient(gains, runtime, measured_states,
+                           gain_scale_factors):
+    """Returns the sum of the squares of the state error and its exact
+    gradient with respect to the scaled gains, see shooting_residuals(). The
+    arguments are the same as for shooting_residuals().
+
+    Returns
+    =======
+    value : float
+    gradient : ndarray, shape(8,)
+
+    """
+
+    residuals, jacobian = shooting_residuals(gains, runtime, measured_states,
+                                             gain_scale_factors)
+
+    return np.dot(residuals, residuals), 2.0 * np.dot(jacobian.T, residuals)
+
+
+def population_objective(population, runtime, measured_states,
+                         gain_scale_factors, substeps=4):
+    """Returns the sum of the squares of the state error of every candidate
+    of a population of scaled gains. All of the candidates are simulated
+    together with ClosedLoopRuntime.simulate_ensemble(), i.e. with fixed
+    step fourth order Runge-Kutta instead of odeint, so the values differ
+    slightly from objective() but the whole population is evaluated with
+    one compiled call per step.
+
+    Parameters
+    ==========
+    population : array_like, shape(n, 8)
+        The candidate scaled gains.
+    runtime : runtime.ClosedLoopRuntime
+        The closed loop system with its input signals.
+    measured_states : ndarray, shape(N, 4)
+        The measured state trajectories.
+    gain_scale_factors : array_like, shape(2, 4)
+        The factors, S, that give the closed loop gains, S .* K.
+    substeps : integer, optional
+        The number of integration steps between each sample.
+
+    Returns
+    =======
+    values : ndarray, shape(n,)
+
+    """
+
+    population = np.atleast_2d(np.asarray(population, dtype=float))
+
+    gains = np.asarray(gain_scale_factors).flatten() * population
+
+    simulated_states = runtime.simulate_ensemble(gains, substeps=substeps)
+
+    return np.sum((simulated_states - measured_states) ** 2, axis=(1, 2))
+
+
+# The problems loaded in a worker process of a ShootingPool.
+_worker = {}
+
+
+def _load_problem(path):
+    """Loads the problem stored by ShootingPool.load() in a worker process,
+    unless it is already loaded. Only the last problem is kept."""
+
+    if _worker.get('path') != path:
+        problem = cache.load(os.path.join(path, 'problem.pkl'))
+        _worker['path'] = path
+        _worker['runtime'] = problem['runtime']
+        _worker['gain_scale_factors'] = problem['gain_scale_factors']
+        # All of the workers share the pages of the memory mapped file.
+        _worker['measured_states'] = np.load(
+            os.path.join(path, 'measured_states.npy'), mmap_mode='r')
+
+    return _worker
+
+
+def _shooting_objective(task):
+    """Returns the sum of the squares of the state error of one candidate of
+    scaled gains, simulated in a worker process."""
+
+    path, gains = task
+
+    problem = _load_problem(path)
+
+    rhs = problem['runtime'].rhs
+    closed_loop_gains = problem['gain_scale_factors'] * gains
+
+    simulated_states = odeint(rhs, np.zeros(4), problem['runtime'].time,
+                              args=(closed_loop_gains,), Dfun=rhs.jacobian)
+
+    return sum_of_squares(problem['measured_states'], simulated_states)
+
+
+def _shooting_population_objective(task):
+    """Returns the sums of the squares of the state error of a chunk of a
+    population, simulated together in a worker process."""
+
+    path, population = task
+
+    problem = _load_problem(path)
+
+    return population_objective(population, problem['runtime'],
+                                problem['measured_states'],
+                                problem['gain_scale_factors'])
+
+
+def _simulate_segment(task):
+    """Returns the states of one shooting segment and their derivatives
+    with respect to the scaled gains and the segment's initial states,
+    simulated in a worker process."""
+
+    path, gains, start, stop, initial_state = task
+
+    problem = _load_problem(path)
+
+    runtime = problem['runtime']
+    scale_factors = problem['gain_scale_factors']
+
+    states, dxdg, dxdx0 = runtime.simulate_sensitivities(
+        scale_factors * gains, initial_conditions=initial_state,
+        time=runtime.time[start:stop + 1],
+        initial_condition_sensitivities=True)
+
+    # dx/dK = dx/dg * S
+    return states, dxdg * scale_factors, dxdx0
+
+
+def segment_boundaries(num_samples, num_segments):
+    """Returns the indices of the samples that bound the shooting segments.
+    Segment m starts at sample boundaries[m] and ends at sample
+    boundaries[m + 1], which is also the start of the next segment.
+
+    Parameters
+    ==========
+    num_samples : integer
+        The number of samples of the trial.
+    num_segments : integer
+        The number of segments.
+
+    Returns
+    =======
+    boundaries : ndarray, shape(num_segments + 1,)
+
+    """
+
+    if num_segments < 1 or num_segments > num_samples - 1:
+        raise ValueError('There must be between 1 and {} segments.'.format(
+            num_samples - 1))
+
+    return np.round(np.linspace(0, num_samples - 1,
+                                num=num_segments + 1)).astype(int)
+
+
+class ShootingPool(object):
+
+    def __init__(self, processes=None):
+        """A pool of processes that simulate the closed loop system for
+        candidate gains, e.g. the population of each CMA-ES generation. The
+        pool is started once and can be used for any number of
+        identifications. The data of each identification is written to
+        disk once and every worker loads it and builds the compiled ODE
+        function the first time it needs it, so the tasks only hold the
+        gains.
+
+        Parameters
+        ==========
+        processes : integer, optional
+            The number of worker processes, defaults to the number of cores.
+
+        """
+
+        self.processes = processes
+        self._directory = None
+        self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def pool(self):
+        """The process pool, which is started when first needed."""
+
+        if self._pool is None:
+            self._pool = mp.Pool(self.processes)
+
+        return self._pool
+
+    @property
+    def directory(self):
+        """The temporary directory of the stored data, which is created
+        when first needed."""
+
+        if self._directory is None:
+            self._directory = tempfile.mkdtemp(prefix='shooting-')
+
+        return self._directory
+
+    def load(self, runtime, measured_states, gain_scale_factors):
+        """Stores the data of an identification for the workers and returns
+        the key to pass to objective(). The same data gives the same key, so
+        it is only stored once.
+
+        Parameters
+        ==========
+        runtime : runtime.ClosedLoopRuntime
+            The closed loop system with its input signals, see
+            QuietStandingModel.closed_loop_runtime().
+        measured_states : ndarray, shape(n, 4)
+            The measured state trajectories.
+        gain_scale_factors : ndarray, shape(2, 4)
+            The factors, S, that give the closed loop gains from the scaled
+            gains, S .* K.
+
+        Returns
+        =======
+        key : string
+
+        """
+
+        measured_states = np.ascontiguousarray(measured_states, dtype=float)
+        gain_scale_factors = np.asarray(gain_scale_factors,
+                                        dtype=float).flatten()
+
+        key = cache.hash_items(runtime.module_name,
+                               runtime.constants.tobytes(),
+                               runtime.time.tobytes(),
+                               runtime.reference_noise.tobytes(),
+                               runtime.platform_acceleration.tobytes(),
+                               runtime.interpolation,
+                               measured_states.tobytes(),
+                               gain_scale_factors.tobytes())
+
+        path = os.path.join(self.directory, key)
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+            np.save(os.path.join(path, 'measured_states.npy'),
+                    measured_states)
+            cache.dump({'runtime': runtime,
+                        'gain_scale_factors': gain_scale_factors},
+                       os.path.join(path, 'problem.pkl'))
+
+        return path
+
+    def objective(self, key, population, vectorized=False):
+        """Returns the sum of the squares of the state error of each
+        candidate.
+
+        Parameters
+        ==========
+        key : string
+            The key returned by load().
+        population : sequence of array_like, shape(8,)
+            The candidate scaled gains.
+        vectorized : boolean, optional
+            If true, the population is split into a chunk per worker and
+            each chunk is simulated at once with population_objective(),
+            otherwise each candidate is simulated with odeint.
+
+        Returns
+        =======
+        values : list of floats
+
+        """
+
+        if vectorized:
+            population = np.asarray(population, dtype=float)
+            num_chunks = min(len(population),
+                             self.processes or mp.cpu_count())
+            tasks = [(key, chunk)
+                     for chunk in np.array_split(population, num_chunks)]
+            values = self.pool.map(_shooting_population_objective, tasks)
+            return list(np.hstack(values))
+
+        tasks = [(key, np.asarray(gains, dtype=float))
+                 for gains in population]
+
+        return self.pool.map(_shooting_objective, tasks)
+
+    def simulate_segments(self, key, gains, boundaries, initial_states):
+        """Simulates every segment of a multiple shooting problem in
+        parallel, see identify_multiple_shooting().
+
+        Parameters
+        ==========
+        key : string
+            The key returned by load().
+        gains : array_like, shape(8,)
+            The scaled gains.
+        boundaries : ndarray, shape(m + 1,)
+            The sample indices that bound the segments, see
+            segment_boundaries().
+        initial_states : ndarray, shape(m, 4)
+            The initial states of each segment.
+
+        Returns
+        =======
+        segments : list of tuples
+            The states, shape(n, 4), and their derivatives with respect to
+            the scaled gains, shape(n, 4, 8), and to the segment's initial
+            states, shape(n, 4, 4), at the n samples of each segment.
+
+        """
+
+        gains = np.asarray(gains, dtype=float)
+
+        tasks = [(key, gains, start, stop, initial_state)
+                 for start, stop, initial_state in zip(boundaries[:-1],
+                                                       boundaries[1:],
+                                                       initial_states)]
+
+        return self.pool.map(_simulate_segment, tasks)
+
+    def close(self):
+        """Stops the worker processes and deletes the stored data. The pool
+        can still be used afterwards, which starts it again."""
+
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+        if self._directory is not None:
+            shutil.rmtree(self._directory, ignore_errors=True)
+            self._directory = None
+
+
+_default_pool = None
+
+
+def default_pool():
+    """Returns a ShootingPool, with a process per core, that is shared by
+    all identifications in this process that don't provide their own. It is
+    closed when the interpreter exits."""
+
+    global _default_pool
+
+    if _default_pool is None:
+        _default_pool = ShootingPool()
+        atexit.register(_default_pool.close)
+
+    return _default_pool
+
+
 def identify(time, measured_states, rhs, rhs_args, model, method='SLSQP',
-             initial_guess=None, tol=1e-8):
+             initial_guess=None, tol=1e-8, runtime=None, pool=None,
+             vectorized=False, exact_gradient=False):
     """
     Parameters
     ==========
@@ -90,12 +488,33 @@ def identify(time, measured_states, rhs, rhs_args, model, method='SLSQP',
         A function, f(x, t, r, p), that evaluates the right hand side of the
         ordinary differential equations describing the closed loop system.
     rhs_args : tuple
-        The specified input and the constants.
+        The specified input and the constants. The closed loop Jacobian,
+        model.closed_loop_jacobian_func(), is evaluated with these too.
     model : QuietStandingModel
     method : string, optional
-        Any method available in scipy.optimize.minimize or 'CMA'.
+        Any method available in scipy.optimize.minimize, 'CMA' or 'LM'. The
+        'LM' method solves the least squares problem with the
+        Levenberg-Marquardt method of scipy.optimize.least_squares and the
+        exact Jacobian of the state errors, see shooting_residuals().
     initial_guess : ndarray, shape(8,), optional
         The initial guess for the gains.
+    runtime : runtime.ClosedLoopRuntime, optional
+        The closed loop system that the 'CMA' and 'LM' methods simulate and
+        that the exact gradients are computed with, see
+        QuietStandingModel.closed_loop_runtime(). It must have the same
+        input signals as rhs and is required by those methods.
+    pool : ShootingPool, optional
+        The pool that evaluates each 'CMA' generation, defaults to
+        default_pool() unless vectorized is true.
+    vectorized : boolean, optional
+        If true, the 'CMA' method simulates the candidates of each
+        generation together with population_objective(). The whole
+        generation is simulated in this process unless a pool is given, in
+        which case it is split among the workers.
+    exact_gradient : boolean, optional
+        If true, the scipy.optimize.minimize methods are given the exact
+        gradient of the objective, see objective_and_gradient(), instead of
+        estimating it with finite differences.
 
     Returns
     =======
@@ -106,45 +525,232 @@ def identify(time, measured_states, rhs, rhs_args, model, method='SLSQP',
 
     x0 = np.zeros(4)
 
+    jac = model.closed_loop_jacobian_func()
+
     if initial_guess is None:
         initial_guess = np.zeros_like(model.scaled_gains.copy())
         #initial_guess = model.scaled_gains.copy()
 
+    if runtime is None and (method in ('CMA', 'LM') or exact_gradient):
+        raise ValueError("The 'CMA' and 'LM' methods and the exact "
+                         "gradients need the runtime of the closed loop "
+                         "system.")
+
     if method == 'CMA':
         sigma = 0.125
 
-        # NOTE : The objective function needs to be importable from this
-        # module to work with multiprocessing. Making it a global allows it
-        # to inherit all the variables from inside the identify function and
-        # be importable. This shows a more elegant solution than making the
-        # function a global: http://stackoverflow.com/a/16071616/467314
-        global obj
-        def obj(gains):
-            return objective(gains, model, rhs, x0, time, rhs_args,
-                             measured_states)
-
-        # This method of parallelization is taken from the cma.py docstring
-        # for CMAEvolutionStrategy.
+        if vectorized and pool is None:
+            def evaluate(population):
+                return list(population_objective(
+                    population, runtime, measured_states,
+                    model.gain_scale_factors))
+        else:
+            if pool is None:
+                pool = default_pool()
+
+            # Only the candidate gains are sent to the workers.
+            key = pool.load(runtime, measured_states,
+                            model.gain_scale_factors)
+
+            def evaluate(population):
+                return pool.objective(key, population, vectorized=vectorized)
+
         es = cma.CMAEvolutionStrategy(initial_guess.flatten(), sigma,
                                       {'tolx': tol})
 
-        pool = mp.Pool(es.popsize)
-
         while not es.stop():
-            # TODO : This gains is a group of gains for each iteration.
             gains = es.ask()
-            f_values = pool.map_async(obj, gains).get()
+            f_values = evaluate(gains)
             es.tell(gains, f_values)
             es.disp()
             es.logger.add()
+
+        gains = es.result()[0]
+    elif method == 'LM':
+        # least_squares() asks for the residuals and the Jacobian
+        # separately, but both come from the same integration.
+        last = {}
+
+        def evaluate(gains):
+            if 'gains' not in last or not np.array_equal(gains,
+                                                         last['gains']):
+                last['gains'] = gains.copy()
+                last['residuals'], last['jacobian'] = shooting_residuals(
+                    gains, runtime, measured_states, model.gain_scale_factors)
+            return last
+
+        result = least_squares(lambda g: evaluate(g)['residuals'],
+                               initial_guess.flatten(),
+                               jac=lambda g: evaluate(g)['jacobian'],
+                               method='lm', ftol=tol, xtol=tol, verbose=1)
+        gains = result.x.flatten()
+    elif exact_gradient:
+        result = minimize(objective_and_gradient,
+                          initial_guess.flatten(),
+                          method=method,
+                          jac=True,
+                          args=(runtime, measured_states,
+                                model.gain_scale_factors),
+                          tol=tol,
+                          options={'disp': True})
+        gains = result.x.flatten()
     else:
         result = minimize(objective,
                           initial_guess,
                           method=method,
                           args=(model, rhs, x0, time, rhs_args,
-                                measured_states),
+                                measured_states, jac),
                           tol=tol,
                           options={'disp': True})
         gains = result.x.flatten()
 
     return model.gain_scale_factors.flatten() * gains
+
+
+def identify_multiple_shooting(runtime, measured_states, gain_scale_factors,
+                               num_segments, initial_guess=None,
+                               weight=1e3, tol=1e-8, pool=None):
+    """Returns the gains identified by multiple shooting. The trial is split
+    into segments which each start from their own initial state, so each
+    simulation is short and stays bounded even for gains that make the
+    closed loop system unstable. The segments are simulated in parallel in
+    the workers of a ShootingPool along with their sensitivities, and the
+    gains and the initial states are found with the Levenberg-Marquardt
+    method of scipy.optimize.least_squares.
+
+    The continuity constraints, i.e. that each segment ends at the initial
+    state of the next, are enforced as residuals with a large weight. The
+    first segment starts from zero, like in identify().
+
+    Parameters
+    ==========
+    runtime : runtime.ClosedLoopRuntime
+        The closed loop system with its input signals.
+    measured_states : ndarray, shape(N, 4)
+        The measured state trajectories.
+    gain_scale_factors : ndarray, shape(2, 4)
+        The factors, S, that give the closed loop gains, S .* K.
+    num_segments : integer
+        The number of segments, see segment_boundaries().
+    initial_guess : ndarray, shape(8,), optional
+        The initial guess for the scaled gains, defaults to zeros. The
+        initial states of the segments start at the measured states.
+    weight : float, optional
+        The weight of the continuity defects relative to the state errors.
+        The larger the weight the closer the solution is to a continuous
+        trajectory, like the one of identify().
+    tol : float, optional
+        The relative tolerance of the cost and of the solution.
+    pool : ShootingPool, optional
+        The pool that simulates the segments, defaults to default_pool().
+
+    Returns
+    =======
+    results : dictionary
+        The identified 'gains', shape(8,), the 'initial_states' of the
+        segments, shape(m, 4), the 'boundaries' of the segments, shape(m +
+        1,), the unweighted continuity 'defects', shape(m - 1, 4), the final
+        'cost', the number of 'evaluations' and the 'status' of
+        scipy.optimize.least_squares.
+
+    """
+
+    num_samples = measured_states.shape[0]
+    num_gains = np.size(gain_scale_factors)
+
+    boundaries = segment_boundaries(num_samples, num_segments)
+
+    if initial_guess is None:
+        initial_guess = np.zeros(num_gains)
+
+    if pool is None:
+        pool = default_pool()
+
+    key = pool.load(runtime, measured_states, gain_scale_factors)
+
+    def unpack(free):
+        initial_states = np.zeros((num_segments, 4))
+        initial_states[1:] = free[num_gains:].reshape(-1, 4)
+        return free[:num_gains], initial_states
+
+    last = {}
+
+    def evaluate(free):
+
+        if 'free' in last and np.array_equal(free, last['free']):
+            return last
+
+        gains, initial_states = unpack(free)
+
+        segments = pool.simulate_segments(key, gains, boundaries,
+                                          initial_states)
+
+        num_rows = 4 * num_samples + 4 * (num_segments - 1)
+        residuals = np.empty(num_rows)
+        jacobian = np.zeros((num_rows, len(free)))
+
+        defects = np.empty((num_segments - 1, 4))
+
+        row = 0
+        for m, (states, dxdg, dxdx0) in enumerate(segments):
+
+            # The last sample of a segment is the first of the next one, so
+            # it is only compared to the measurements in the last segment.
+            if m < num_segments - 1:
+                end = -1
+            else:
+                end = len(states)
+
+            start, stop = boundaries[m], boundaries[m] + len(states[:end])
+            rows = slice(row, row + 4 * (stop - start))
+
+            residuals[rows] = (states[:end] -
+                               measured_states[start:stop]).flatten()
+            jacobian[rows, :num_gains] = dxdg[:end].reshape(-1, num_gains)
+            if m > 0:
+                columns = slice(num_gains + 4 * (m - 1), num_gains + 4 * m)
+                jacobian[rows, columns] = dxdx0[:end].reshape(-1, 4)
+
+            row = rows.stop
+
+        for m, (states, dxdg, dxdx0) in enumerate(segments[:-1]):
+
+            rows = slice(row, row + 4)
+
+            defects[m] = states[-1] - initial_states[m + 1]
+
+            residuals[rows] = weight * defects[m]
+            jacobian[rows, :num_gains] = weight * dxdg[-1]
+            if m > 0:
+                columns = slice(num_gains + 4 * (m - 1), num_gains + 4 * m)
+                jacobian[rows, columns] = weight * dxdx0[-1]
+            columns = slice(num_gains + 4 * m, num_gains + 4 * (m + 1))
+            jacobian[rows, columns] = -weight * np.eye(4)
+
+            row = rows.stop
+
+        last['free'] = free.copy()
+        last['residuals'] = residuals
+        last['jacobian'] = jacobian
+        last['defects'] = defects
+
+        return last
+
+    free = np.hstack((np.asarray(initial_guess, dtype=float).flatten(),
+                      measured_states[boundaries[1:-1]].flatten()))
+
+    # least_squares() asks for the residuals and the Jacobian separately,
+    # but both come from the same simulations.
+    result = least_squares(lambda x: evaluate(x)['residuals'], free,
+                           jac=lambda x: evaluate(x)['jacobian'],
+                           method='lm', ftol=tol, xtol=tol, verbose=1)
+
+    gains, initial_states = unpack(result.x)
+
+    return {'gains': np.asarray(gain_scale_factors).flatten() * gains,
+            'initial_states': initial_states,
+            'boundaries': boundaries,
+            'defects': evaluate(result.x)['defects'],
+            'cost': result.cost,
+            'evaluations': result.nfev,
+            'status': result.status}
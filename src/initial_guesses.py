@@ -87,10 +87,18 @@ initial_guesses = {'all zeros': np.zeros(NUM_GAINS),
 
 shooting_solutions = {}
 
-for k, v in initial_guesses.items():
-    logbook.info('Trying initial guess: {}.'.format(k))
-    shooting_solutions[k] = \
-        indirect_shooting.identify(generator.time, generator.measured['x'],
-                                   generator.rhs, (generator.r,
-                                                   generator.p), model,
-                                   method='CMA', initial_guess=v)
+# The same closed loop system and worker processes are used for every initial
+# guess, so the workers only load the data and compile the ODE function once.
+runtime = model.closed_loop_runtime(generator.time, generator.ref_noise,
+                                    generator.actual['a'])
+
+with indirect_shooting.ShootingPool() as pool:
+    for k, v in initial_guesses.items():
+        logbook.info('Trying initial guess: {}.'.format(k))
+        shooting_solutions[k] = \
+            indirect_shooting.identify(generator.time,
+                                       generator.measured['x'],
+                                       generator.rhs, (generator.r,
+                                                       generator.p), model,
+                                       method='CMA', initial_guess=v,
+                                       runtime=runtime, pool=pool)
@@ -96,3 +96,31 @@ class Interpolator(object):
             return self._hunt(x)
         else:
             return self._locate(x)
+
+    def interpolate(self, x, y):
+        """Returns the linear interpolation of the ordinate values.
+
+        Parameters
+        ==========
+        x : float
+            The value of abscissa of the desired ordinate values.
+        y : ndarray, shape(m,)
+            An empty array to store the result in.
+
+        Returns
+        =======
+        y : ndarray, shape(m,)
+            The interpolated values of the ordinate.
+
+        """
+
+        first = self._find_idx(x)
+        second = first + 1
+
+        m = ((self.y[first] - self.y[second]) /
+             (self.x[first] - self.x[second]))
+        b = self.y[second] - m * self.x[second]
+
+        y[:] = m * x + b
+
+        return y
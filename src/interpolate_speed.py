@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+
+"""This compares the speed of the interpolators on the kind of data used in
+the simulations: 60 s of the four reference noise signals and the platform
+acceleration sampled at 100 Hz."""
+
+import numpy as np
+from scipy.interpolate import interp1d
+
+from fast_interpolate import Interpolator
+import interpolate
+from utils import timeit
+
+duration = 60.0
+num_samples = 6001
+num_calls = 10000
+
+x = np.linspace(0.0, duration, num=num_samples)
+y = np.random.random((num_samples, 5))
+
+# The times requested by an integrator move slowly forward.
+x_new = np.sort(duration * np.random.random(num_calls))
+
+interpolators = [('scipy.interpolate.interp1d', interp1d(x, y, axis=0)),
+                 ('interpolate.Interpolator', interpolate.Interpolator(x, y)),
+                 ('fast_interpolate.Interpolator, search',
+                  Interpolator(x, y, uniform=False)),
+                 ('fast_interpolate.Interpolator, uniform',
+                  Interpolator(x, y))]
+
+
+@timeit
+def call_scalar(interpolator):
+    res = np.empty(5)
+    if isinstance(interpolator, interp1d):
+        for xi in x_new:
+            interpolator(xi)
+    else:
+        for xi in x_new:
+            interpolator.interpolate(xi, res)
+
+
+@timeit
+def call_many(interpolator):
+    if isinstance(interpolator, interp1d):
+        return interpolator(x_new)
+    elif isinstance(interpolator, Interpolator):
+        return interpolator.interpolate_many(x_new)
+
+
+if __name__ == "__main__":
+
+    print('{} scalar calls'.format(num_calls))
+    for label, interpolator in interpolators:
+        _, t = call_scalar(interpolator)
+        print('  {}: {:1.2f} us per call'.format(label, 1e6 * t / num_calls))
+
+    print('One call with {} values'.format(num_calls))
+    for label, interpolator in interpolators:
+        if isinstance(interpolator, interpolate.Interpolator):
+            continue
+        _, t = call_many(interpolator)
+        print('  {}: {:1.2f} us per value'.format(label, 1e6 * t / num_calls))
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+"""This compares the number of integration steps, right hand side
+evaluations and the computation time needed to simulate the sample_id.py
+scenario with each kind of interpolation of the input signals. The adaptive
+integrator has to take small steps around the kinks at every sample of the
+linearly interpolated signals and the jumps of the zero order hold."""
+
+import numpy as np
+from scipy.integrate import odeint
+
+from model import QuietStandingModel
+from measured_data import DataGenerator
+from utils import timeit
+
+num_nodes = 4001
+duration = 20.0
+
+ref_noise_std = 0.0
+platform_pos_mag = 0.01
+
+num_runs = 10
+
+model = QuietStandingModel(scaled_gains=0.5 * np.ones((2, 4)))
+model.derive()
+
+data = DataGenerator(duration, num_nodes, ref_noise_std, platform_pos_mag,
+                     model=model)
+gains = model.closed_loop_gains()
+
+
+@timeit
+def simulate(rhs):
+    for i in range(num_runs):
+        x, info = odeint(rhs, np.zeros(4), data.time, args=(gains,),
+                         Dfun=rhs.jacobian, full_output=True)
+    return x, info
+
+
+if __name__ == "__main__":
+
+    results = {}
+
+    for kind in ['zero', 'linear', 'cubic']:
+
+        model.interpolation = kind
+        rhs = model.native_closed_loop_ode_func(data.time, data.ref_noise,
+                                                data.actual['a'])
+
+        (x, info), t = simulate(rhs)
+        results[kind] = x
+
+        print('{}: {} steps, {} rhs evaluations, {:1.3f} s per '
+              'simulation'.format(kind, info['nst'][-1], info['nfe'][-1],
+                                  t / num_runs))
+
+    for kind in ['zero', 'cubic']:
+        print('Max difference from linear, {}: {:1.2e}'.format(
+            kind, np.abs(results[kind] - results['linear']).max()))
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+"""This compares the number of right hand side evaluations and the
+computation time needed to integrate the 600 second simulation used in
+duration_plot.py with and without the analytic closed loop Jacobian. Without
+the Jacobian, LSODA has to estimate it with finite differences.
+
+The Jacobian is only used once LSODA switches to its stiff method. With the
+known gains the closed loop poles are slow (about -2 +/- 9j rad/s), so the
+non-stiff method is used throughout and no Jacobians are evaluated. The last
+run scales the gains by 200 to show the stiff case, e.g. a poor candidate
+in the shooting optimization."""
+
+import numpy as np
+from scipy.integrate import odeint
+
+from model import QuietStandingModel
+from measured_data import DataGenerator
+from utils import timeit
+
+sample_rate = 100.0  # hz
+duration = 600.0  # s
+total_num_nodes = int(sample_rate * duration) + 1
+
+model = QuietStandingModel(scaled_gains=0.5)
+model.derive()
+
+generator = DataGenerator(duration, total_num_nodes, 0.0, 0.1, model)
+
+native_rhs = model.native_closed_loop_ode_func(generator.time,
+                                               generator.ref_noise,
+                                               generator.actual['a'])
+gains = model.closed_loop_gains()
+
+
+@timeit
+def simulate(rhs, args, jac=None):
+    return odeint(rhs, np.zeros(4), generator.time, args=args, Dfun=jac,
+                  full_output=True)
+
+
+if __name__ == "__main__":
+
+    runs = [('Python controller', generator.rhs,
+             (generator.r, generator.p), generator.jac),
+            ('Native controller', native_rhs, (gains,), native_rhs.jacobian),
+            ('Native controller, 200 x gains', native_rhs, (200.0 * gains,),
+             native_rhs.jacobian)]
+
+    for label, rhs, args, jac in runs:
+
+        (x_fd, info_fd), time_fd = simulate(rhs, args)
+        (x_an, info_an), time_an = simulate(rhs, args, jac)
+
+        np.testing.assert_allclose(x_fd, x_an, atol=1e-5)
+
+        print(label)
+        print('  Finite difference Jacobian: {} rhs evaluations, '
+              '{:1.2f} s'.format(info_fd['nfe'][-1], time_fd))
+        print('  Analytic Jacobian: {} rhs evaluations, {} Jacobian '
+              'evaluations, {:1.2f} s'.format(info_an['nfe'][-1],
+                                              info_an['nje'][-1], time_an))
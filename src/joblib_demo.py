@@ -30,16 +30,17 @@ num = 12
 
 def gen(platform_pos_mag):
 
-    # This involves generating the rhs function and is slower.
+    # This involves generating the rhs function, but the compiled extension
+    # is loaded from the on disk cache after it has been compiled once.
     data = DataGenerator(duration, num_nodes, ref_noise_std,
                          platform_pos_mag, model=model)
     # This step is fast.
     data.generate(platform_accel_noise_std, coordinate_noise_std,
                   speed_noise_std, torque_noise_std)
 
-    # NOTE : You can't return the data object here because something inside
-    # it can't be pickled, so I return the dictionary instead.
-    return data.measured
+    # The model is swapped for a picklable numerical runtime when the data
+    # object is sent back to the parent process.
+    return data
 
 platform_pos_mags = np.linspace(0.0, 0.3, num=num)
 
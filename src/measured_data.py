@@ -1,5 +1,7 @@
 #!/usr/bin/env python
 
+import hashlib
+
 import numpy as np
 from numpy.random import normal
 from scipy.integrate import odeint
@@ -15,6 +17,64 @@ from model import QuietStandingModel
 # the whole model.
 
 
+def reference_noise(num_samples, ref_noise_std):
+    """Returns the noise added to the reference states.
+
+    The person is trying to track a nominal state of [0, 0, 0, 0], i.e.
+    angles and rates are zero, but may not be able to sense the error in
+    their trajectory perfectly, so this adds some noise to the reference
+    tracking which is ultimately fed into the controller and corrupts the
+    output.
+
+    Parameters
+    ==========
+    num_samples : integer
+        The number of samples.
+    ref_noise_std : float
+        The standard deviation of the Gaussian noise in radians.
+
+    Returns
+    =======
+    ref_noise : ndarray, shape(num_samples, 4)
+
+    """
+
+    if np.allclose(0.0, ref_noise_std):
+        return np.zeros((num_samples, 4))
+    else:
+        return normal(scale=ref_noise_std, size=(num_samples, 4))
+
+
+def platform_acceleration(time, platform_pos_mag):
+    """Returns a random platform acceleration input with bandwidth in the
+    human control regime.
+
+    Parameters
+    ==========
+    time : ndarray, shape(N,)
+        The time values.
+    platform_pos_mag : float
+        The magnitude of the sine motion of the platform in meters.
+
+    Returns
+    =======
+    accel : ndarray, shape(N,)
+
+    """
+
+    start_freq = 0.03  # hz
+    stop_freq = 2.18  # hz
+
+    freq = 2.0 * np.pi * np.logspace(np.log10(start_freq),
+                                     np.log10(stop_freq), num=20)
+
+    # NOTE : This function is not deterministic and give different
+    # results every call.
+    pos, vel, accel = sum_of_sines(platform_pos_mag, freq, time)
+
+    return accel
+
+
 class DataGenerator(object):
 
     def __init__(self, duration, num_samples, ref_noise_std,
@@ -59,6 +119,9 @@ class DataGenerator(object):
         self.actual = {}
         self.measured = {}
 
+        # Identifies the inputs used for the simulation stored in actual.
+        self._simulation_key = None
+
         self._generate_model_inputs()
         self._generate_rhs_function()
 
@@ -67,85 +130,129 @@ class DataGenerator(object):
         self.interval = self.duration / (self.num_samples - 1)
         self.time = np.linspace(0.0, self.duration, num=self.num_samples)
 
-        # The person is trying to track a nominal state of [0, 0, 0, 0],
-        # i.e. angles and rates are zero, but may not be able to sense the
-        # error in their trajectory perfectly, so this adds some noise to
-        # the reference tracking which is ultimately fed into the controller
-        # and corrupts the output.
-        if np.allclose(0.0, self.ref_noise_std):
-            self.ref_noise = np.zeros((len(self.time), 4))
-        else:
-            self.ref_noise = normal(scale=self.ref_noise_std,
-                                    size=(len(self.time), 4))
+        self.ref_noise = reference_noise(self.num_samples,
+                                         self.ref_noise_std)
 
         self.actual['x_n'] = self.ref_noise
 
-        # Generate a random platform acceleration input with bandwidth in
-        # the human control regime.
-        start_freq = 0.03  # hz
-        stop_freq = 2.18  # hz
-
-        freq2 = 2.0 * np.pi * np.logspace(np.log10(start_freq),
-                                          np.log10(stop_freq), num=20)
-
-        # NOTE : This function is not deterministic and give different
-        # results every call.
-        pos, vel, accel = sum_of_sines(self.platform_pos_mag, freq,
-                                       self.time)
-
-        self.actual['a'] = accel
+        self.actual['a'] = platform_acceleration(self.time,
+                                                 self.platform_pos_mag)
 
     def _generate_rhs_function(self):
 
         self.rhs, self.r, self.p = \
             self.model.closed_loop_ode_func(self.time, self.ref_noise,
                                             self.actual['a'])
+        self.jac = self.model.closed_loop_jacobian_func()
+
+    def __getstate__(self):
+        """The model and the functions generated from it can't be pickled,
+        so they are replaced by a numerical runtime of the closed loop
+        system which is used for any further simulations."""
+
+        state = self.__dict__.copy()
+
+        if self.model is not None:
+            state['runtime'] = self.model.closed_loop_runtime(
+                self.time, self.ref_noise, self.actual['a'])
+            state['numerical_gains'] = self.model.numerical_gains
+
+        for key in ('model', 'rhs', 'r', 'jac'):
+            state[key] = None
+
+        return state
+
+    def _gains(self):
+        """Returns the flattened closed loop gains, S .* K, used in the
+        simulation and the gains, K, used to back out the joint torques."""
+
+        if self.model is None:
+            return self.runtime.gains, self.numerical_gains
+        else:
+            return (self.model.closed_loop_gains(),
+                    self.model.numerical_gains)
+
+    def _current_simulation_key(self):
+        """Returns a digest of everything the simulation depends on: the
+        time, reference noise and platform acceleration arrays, the model
+        constants and the controller gains."""
+
+        h = hashlib.sha1()
+        for array in ((self.time, self.ref_noise, self.actual['a'], self.p) +
+                      self._gains()):
+            h.update(np.ascontiguousarray(array, dtype=float))
+        return h.hexdigest()
 
     def _generate_simulation_outputs(self):
 
+        key = self._current_simulation_key()
+
+        # The simulation does not depend on the measurement noise, so it is
+        # only recomputed if the inputs have changed.
+        if key == self._simulation_key:
+            return
+
         #print('Integrating equations of motion.')
         # The initial conditions of the states are always zero.
-        x = odeint(self.rhs, np.zeros(4), self.time, args=(self.r, self.p))
+        if self.model is None:
+            # This generator has been unpickled.
+            x = self.runtime.simulate()
+        else:
+            x = odeint(self.rhs, np.zeros(4), self.time,
+                       args=(self.r, self.p), Dfun=self.jac)
 
         # Back out the torques used in the control.
         # N x 4 = ((2 x 4) * (4 x N)).T
-        u = np.dot(self.model.numerical_gains,
-                   (self.ref_noise - x).T).T
+        u = np.dot(self._gains()[1], (self.ref_noise - x).T).T
 
         self.actual['x'] = x
         self.actual['u'] = u
 
-    def _generate_measured_outputs(self):
+        self._simulation_key = key
 
-        # Add measurement noise to the kinematic data.
-        if np.allclose(0.0, self.platform_accel_noise_std):
-            self.measured['a'] = self.actual['a']
+    def _add_noise(self, values, std, num_realizations):
+        """Returns num_realizations noisy copies of values stacked along a
+        new first axis."""
+
+        shape = (num_realizations,) + values.shape
+
+        if np.allclose(0.0, std):
+            return np.tile(values, (num_realizations,) + (1,) * values.ndim)
         else:
-            self.measured['a'] = self.actual['a'] + normal(
-                scale=self.platform_accel_noise_std,
-                size=self.actual['a'].shape)
+            return values + normal(scale=std, size=shape)
+
+    def _noisy_outputs(self, num_realizations):
+
+        # Add measurement noise to the kinematic data.
+        a = self._add_noise(self.actual['a'], self.platform_accel_noise_std,
+                            num_realizations)
 
         x = self.actual['x']
-        if np.allclose(0.0, self.coordinate_noise_std):
-            coord_noise = np.zeros_like(x[:, :2])
-        else:
-            coord_noise = normal(scale=self.coordinate_noise_std,
-                                 size=x[:, :2].shape)
-        if np.allclose(0.0, self.speed_noise_std):
-            speed_noise = np.zeros_like(x[:, 2:])
-        else:
-            speed_noise = normal(scale=self.speed_noise_std,
-                                 size=x[:, 2:].shape)
-        x_noise = np.hstack((coord_noise, speed_noise))
-        self.measured['x'] = x + x_noise
+        x = np.concatenate((self._add_noise(x[:, :2],
+                                            self.coordinate_noise_std,
+                                            num_realizations),
+                            self._add_noise(x[:, 2:], self.speed_noise_std,
+                                            num_realizations)), axis=-1)
 
         # Add measurement noise to the joint torques.
-        u = self.actual['u']
-        if np.allclose(0.0, self.torque_noise_std):
-            u_meas = u
-        else:
-            u_meas = u + normal(scale=self.torque_noise_std, size=u.shape)
-        self.measured['u'] = u_meas
+        u = self._add_noise(self.actual['u'], self.torque_noise_std,
+                            num_realizations)
+
+        return {'a': a, 'x': x, 'u': u}
+
+    def _generate_measured_outputs(self):
+
+        for k, v in self._noisy_outputs(1).items():
+            self.measured[k] = v[0]
+
+    def _set_noise(self, platform_accel_noise_std, coordinate_noise_std,
+                   speed_noise_std, torque_noise_std):
+
+        # Measurement noise, doesn't require a model recomputation.
+        self.platform_accel_noise_std = platform_accel_noise_std
+        self.coordinate_noise_std = coordinate_noise_std
+        self.speed_noise_std = speed_noise_std
+        self.torque_noise_std = torque_noise_std
 
     def generate(self, platform_accel_noise_std, coordinate_noise_std,
                  speed_noise_std, torque_noise_std):
@@ -166,17 +273,49 @@ class DataGenerator(object):
         torque_noise_std : float
             The standard deviation of the Gaussian noise in N-m applied to
             the actual joint torques to create the measured joint torques.
+
+        Notes
+        =====
+        The equations of motion are only integrated if the simulation inputs
+        or the model gains have changed since the last call, so sweeping the
+        measurement noise only costs new noise draws.
+
         """
 
-        # Measurement noise, doesn't require a model recomputation.
-        self.platform_accel_noise_std = platform_accel_noise_std
-        self.coordinate_noise_std = coordinate_noise_std
-        self.speed_noise_std = speed_noise_std
-        self.torque_noise_std = torque_noise_std
+        self._set_noise(platform_accel_noise_std, coordinate_noise_std,
+                        speed_noise_std, torque_noise_std)
 
         self._generate_simulation_outputs()
         self._generate_measured_outputs()
 
+    def generate_many(self, num_realizations, platform_accel_noise_std,
+                      coordinate_noise_std, speed_noise_std,
+                      torque_noise_std):
+        """Returns many independent noisy measurements of a single
+        simulation. The arguments after num_realizations are the same as
+        for generate().
+
+        Parameters
+        ==========
+        num_realizations : integer
+            The number of noisy realizations, n.
+
+        Returns
+        =======
+        measured : dictionary
+            'a' : ndarray, shape(n, N)
+            'x' : ndarray, shape(n, N, 4)
+            'u' : ndarray, shape(n, N, 2)
+
+        """
+
+        self._set_noise(platform_accel_noise_std, coordinate_noise_std,
+                        speed_noise_std, torque_noise_std)
+
+        self._generate_simulation_outputs()
+
+        return self._noisy_outputs(num_realizations)
+
     def plot(self):
 
         fig, axes = plt.subplots(3, 1, sharex=True)
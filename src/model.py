@@ -1,19 +1,37 @@
 #!/usr/bin/env python
 
 import os
+import sys
+import inspect
 from collections import OrderedDict
 
 import numpy as np
 import sympy as sy
 import sympy.physics.mechanics as me
+from sympy.core.function import AppliedUndef
 import yeadon
-from pydy.codegen.ode_function_generator import generate_ode_function
 
-from fast_interpolate import Interpolator
+from fast_interpolate import Interpolator, _coefficients
+from codegen import CachedCythonODEFunctionGenerator
+import codegen
+from runtime import ClosedLoopRuntime
+import cache
 import utils
 
 PATHS = utils.config_paths()
 
+YEADON_MEASUREMENTS = os.path.join(PATHS['raw_data_dir'],
+                                   'JasonYeadonMeas.txt')
+
+# Increment this if the structure of the cached derivation changes.
+MODEL_CACHE_VERSION = 1
+
+# These are the symbolic results of QuietStandingModel.derive() that are
+# stored in the cache.
+CACHED_EXPRESSIONS = ['fr_plus_frstar', 'mass_matrix', 'forcing_vector',
+                      'mass_matrix_full', 'forcing_vector_full', 'rhs',
+                      'fr_plus_frstar_closed', 'A', 'B']
+
 sym_kwargs = {'positive': True, 'real': True}
 me.dynamicsymbols._t = sy.symbols('t', **sym_kwargs)
 
@@ -147,7 +165,7 @@ class QuietStandingModel(object):
 
     """
 
-    def __init__(self, scaled_gains=None):
+    def __init__(self, scaled_gains=None, interpolation='linear'):
         """
 
         Parameters
@@ -157,10 +175,15 @@ class QuietStandingModel(object):
             gains are be Hadamard multiplied by the gain scale factors to
             get the actual gain matrix. If None, the gains are not scaled.
             For NLP problems, this should probably be between 0 and 1.
+        interpolation : string, optional
+            How the sampled reference noise and platform acceleration are
+            interpolated in the closed loop simulations, 'zero' (zero order
+            hold), 'linear' or 'cubic'. See fast_interpolate.Interpolator.
 
         """
 
         self.scaled_gains = scaled_gains
+        self.interpolation = interpolation
 
     def _create_states(self):
 
@@ -400,17 +423,10 @@ class QuietStandingModel(object):
                           self.coordinates.values()])
         self.rhs = qdot.col_join(udot)
 
-    def _create_symbolic_controller(self):
-
-        states = self.coordinates.values() + self.speeds.values()
-        inputs = self.specifieds.values()[-2:]
-
-        num_states = len(states)
-        num_inputs = len(inputs)
+    def _create_gain_symbols(self):
 
-        # The equilibrium point is the nominal upright configuration and
-        # zero angular velocity.
-        xeq = sy.Matrix([0 for x in states])
+        num_states = len(self.coordinates) + len(self.speeds)
+        num_inputs = 2
 
         K = sy.Matrix(num_inputs, num_states, lambda i, j:
                       sy.symbols('k_{}{}'.format(i, j)))
@@ -420,12 +436,25 @@ class QuietStandingModel(object):
                       sy.symbols('s_{}{}'.format(i, j)))
         self.scale_matrix = S
 
-        x = sy.Matrix(states)
-        T = sy.Matrix(inputs)
-
         self.gain_symbols = [k for k in K]
         self.scale_symbols = [s for s in S]
 
+    def _create_symbolic_controller(self):
+
+        states = self.coordinates.values() + self.speeds.values()
+        inputs = self.specifieds.values()[-2:]
+
+        # The equilibrium point is the nominal upright configuration and
+        # zero angular velocity.
+        xeq = sy.Matrix([0 for x in states])
+
+        self._create_gain_symbols()
+        K = self.gain_matrix
+        S = self.scale_matrix
+
+        x = sy.Matrix(states)
+        T = sy.Matrix(inputs)
+
         # T = K * (xeq - x) -> 0 = T - S .* K * (xeq - x)
 
         self.controller_dict = sy.solve(T - S.multiply_elementwise(K) *
@@ -436,10 +465,11 @@ class QuietStandingModel(object):
         self.fr_plus_frstar_closed = me.msubs(self.fr_plus_frstar,
                                               self.controller_dict)
 
-    def _numerical_parameters(self):
+    def _body_segment_parameters(self):
+        """Returns a dictionary mapping the parameter names to the values
+        computed from the Yeadon measurements."""
 
-        h = yeadon.Human(os.path.join(PATHS['raw_data_dir'],
-                                      'JasonYeadonMeas.txt'))
+        h = yeadon.Human(YEADON_MEASUREMENTS)
 
         hip_pos = h.J1.pos
         ankle_pos = h.J2.solids[1].pos
@@ -464,6 +494,13 @@ class QuietStandingModel(object):
         p['torso_inertia'] = torso_inertia[0, 0]
         p['g'] = 9.81
 
+        return p
+
+    def _numerical_parameters(self, p=None):
+
+        if p is None:
+            p = self._body_segment_parameters()
+
         self.open_loop_par_map = OrderedDict()
 
         for k, v in self.parameters.items():
@@ -514,7 +551,95 @@ class QuietStandingModel(object):
         self.A = sy.simplify(A)
         self.B = sy.simplify(B)
 
-    def derive(self):
+    def _cache_path(self):
+        """Returns the path to the cache file for the derived equations.
+        The file name is a hash of the source code of this whole module, the
+        SymPy and Yeadon versions, and the contents of the Yeadon measurement
+        file. The module source is hashed rather than the class source, so
+        that a change to a module level constant or helper used by the
+        derivation also results in a new derivation."""
+
+        key = cache.hash_items(MODEL_CACHE_VERSION,
+                               sy.__version__,
+                               yeadon.__version__,
+                               inspect.getsource(sys.modules[__name__]),
+                               cache.hash_file(YEADON_MEASUREMENTS))
+
+        return os.path.join(cache.cache_dir('models'),
+                            'quiet-standing-{}.pkl'.format(key))
+
+    def _save_derived(self):
+
+        data = {'version': MODEL_CACHE_VERSION,
+                'expressions': {},
+                'controller': [],
+                'parameter_values': [float(v) for v in
+                                     self.open_loop_par_map.values()]}
+
+        for name in CACHED_EXPRESSIONS:
+            data['expressions'][name] = sy.srepr(getattr(self, name))
+
+        for k, v in self.controller_dict.items():
+            data['controller'].append((sy.srepr(k), sy.srepr(v)))
+
+        cache.dump(data, self._cache_path())
+
+    def _load_derived(self):
+        """Populates the derived attributes from the cache and returns True
+        if a valid cache file exists, otherwise returns False."""
+
+        data = cache.load(self._cache_path())
+
+        if data is None or data.get('version') != MODEL_CACHE_VERSION:
+            return False
+
+        # Creating the symbols, frames, and points is cheap, so they are
+        # always recreated. Only the KanesMethod object is not available
+        # when the equations are loaded from the cache.
+        self._setup_problem()
+        self._create_gain_symbols()
+
+        # SymPy's string representation does not retain the assumptions on
+        # undefined functions, so the loaded functions and symbols are
+        # swapped out with the ones created above by name.
+        live = [self.time] + self.parameters.values() + self.gain_symbols
+        live += self.scale_symbols + self.states()
+        live += self.specifieds.values()
+        by_name = {str(s): s for s in live}
+
+        def restore(text):
+            expr = sy.sympify(text)
+            atoms = expr.atoms(sy.Symbol, AppliedUndef)
+            return expr.xreplace({a: by_name[str(a)] for a in atoms
+                                  if str(a) in by_name})
+
+        for name, text in data['expressions'].items():
+            setattr(self, name, restore(text))
+
+        self.controller_dict = {restore(k): restore(v) for k, v in
+                                data['controller']}
+
+        p = dict(zip(self.parameters.keys(), data['parameter_values']))
+        self._numerical_parameters(p)
+
+        return True
+
+    def derive(self, use_cache=True):
+        """Derives the equations of motion.
+
+        Parameters
+        ==========
+        use_cache : boolean, optional, default=True
+            If true, the derived equations are loaded from the on disk cache
+            if available and the cache is populated after a fresh
+            derivation. The ``kane`` attribute is only available after a
+            fresh derivation.
+
+        """
+
+        if use_cache and self._load_derived():
+            return
+
         self._setup_problem()
         self._generate_eoms()
         self._generate_rhs()
@@ -523,6 +648,9 @@ class QuietStandingModel(object):
         self._numerical_parameters()
         self._linearize()
 
+        if use_cache:
+            self._save_derived()
+
     def numerical_linear(self):
 
         return (sy.matrix2numpy(self.A.subs(self.open_loop_par_map),
@@ -560,7 +688,8 @@ class QuietStandingModel(object):
         self.all_sigs = np.hstack((reference_noise,
                                    np.expand_dims(platform_acceleration, 1)))
 
-        interpolator = Interpolator(time, self.all_sigs)
+        interpolator = Interpolator(time, self.all_sigs,
+                                    kind=self.interpolation)
         sig_result = np.zeros_like(self.all_sigs[0, :])
 
         def controller(x, t):
@@ -584,16 +713,289 @@ class QuietStandingModel(object):
 
             return controls
 
-        rhs = generate_ode_function(self.rhs,
-                                    self.coordinates.values(),
-                                    self.speeds.values(),
-                                    self.parameters.values(),
-                                    specifieds=self.specifieds.values()[-3:],
-                                    constants_arg_type='array',
-                                    specifieds_arg_type='function',
-                                    generator='cython')
+        return (self.open_loop_ode_func(), controller,
+                np.array(self.open_loop_par_map.values()))
+
+    def closed_loop_jacobian_func(self):
+        """Returns a function, J(x, t, r, p), that evaluates the Jacobian of
+        the closed loop first order ODEs with respect to the states, i.e.
+        J[i, j] = df_i / dx_j. It takes the same arguments as the rhs
+        function returned by closed_loop_ode_func() and can be passed as the
+        Dfun argument to scipy.integrate.odeint."""
+
+        if not hasattr(self, '_open_loop_jacobians'):
+            states = self.states()
+            specifieds = self.specifieds.values()[-3:]
+            self._open_loop_jacobians = codegen.cython_matrix_function(
+                [states, specifieds, self.parameters.values()],
+                [self.rhs.jacobian(states),
+                 self.rhs.jacobian(specifieds[1:])],
+                prefix='pydy_jac')
+
+        evaluate = self._open_loop_jacobians
+
+        state_partials = np.empty(16, dtype=float)
+        torque_partials = np.empty(8, dtype=float)
+
+        def jacobian(x, t, r, p):
+
+            dfdx, dfdT = evaluate(x, r(x, t), p, state_partials,
+                                  torque_partials)
+
+            # T = (S .* K) * (x_ref - x) -> dT/dx = -(S .* K)
+            gains = self.closed_loop_gains().reshape(2, 4)
+
+            return dfdx - np.dot(dfdT, gains)
+
+        return jacobian
+
+    def closed_loop_gains(self):
+        """Returns the flattened gain matrix, S .* K, used by the
+        controller."""
+
+        if self.scaled_gains is None:
+            K = self.numerical_gains
+        else:
+            K = self.scaled_gains
+
+        return (self.gain_scale_factors * K).flatten()
+
+    def native_closed_loop_ode_func(self, time, reference_noise,
+                                    platform_acceleration):
+        """Returns a function that evaluates the continous closed loop
+        system first order ODEs in a single compiled call, i.e. the
+        interpolation of the inputs and the controller are not evaluated in
+        Python like with closed_loop_ode_func().
+
+        Parameters
+        ----------
+        time : ndarray, shape(N,)
+            The monotonically increasing time values.
+        reference_noise : ndarray, shape(N, 4)
+            The reference noise vector at each time.
+        platform_acceleration : ndarray, shape(N,)
+            The acceleration of the platform at each time.
+
+        Returns
+        -------
+        rhs : ClosedLoopODEFunction
+            A callable, f(x, t, g), where g is the flattened gain matrix,
+            see closed_loop_gains(). Use it with scipy.integrate.odeint by
+            passing ``args=(model.closed_loop_gains(),)`` and
+            ``Dfun=rhs.jacobian``.
+
+        """
+
+        if not hasattr(self, '_closed_loop_ode_class'):
+            self._closed_loop_ode_class = \
+                codegen.load_closed_loop_ode_function_class(
+                    *self._closed_loop_ode_sources())
+
+        signals = np.hstack((reference_noise,
+                             np.expand_dims(platform_acceleration, 1)))
+
+        interpolator = Interpolator(time, signals, kind=self.interpolation)
+
+        return self._closed_loop_ode_class(
+            interpolator, np.array(self.open_loop_par_map.values()))
+
+    def _closed_loop_ode_sources(self):
+        """Returns the name and source files of the compiled closed loop
+        ODE extension."""
+
+        if not hasattr(self, '_closed_loop_ode_name_sources'):
+            self._closed_loop_ode_name_sources = \
+                codegen.closed_loop_ode_function_sources(
+                    self.rhs, self.states(), self.specifieds.values()[-3:],
+                    self.parameters.values())
+
+        return self._closed_loop_ode_name_sources
+
+    def closed_loop_runtime(self, time, reference_noise,
+                            platform_acceleration):
+        """Returns a numerical version of the closed loop system which
+        holds no SymPy objects and can be pickled, e.g. to send simulations
+        to a process pool.
+
+        Parameters
+        ----------
+        time : ndarray, shape(N,)
+            The monotonically increasing time values.
+        reference_noise : ndarray, shape(N, 4)
+            The reference noise vector at each time.
+        platform_acceleration : ndarray, shape(N,)
+            The acceleration of the platform at each time.
+
+        Returns
+        -------
+        runtime : runtime.ClosedLoopRuntime
+            Holds the compiled function's name and sources, the constants,
+            the current closed loop gains and the input signals.
+
+        """
+
+        name, sources = self._closed_loop_ode_sources()
+
+        return ClosedLoopRuntime(name, sources,
+                                 np.array(self.open_loop_par_map.values()),
+                                 self.closed_loop_gains(), time,
+                                 reference_noise, platform_acceleration,
+                                 interpolation=self.interpolation)
+
+    def ensemble_closed_loop_rhs(self):
+        """Returns a function, f(x, r, g), that evaluates the closed loop
+        first order ODEs of many trials at once with NumPy.
+
+        The returned function takes these arguments:
+
+        x : ndarray, shape(n, 4)
+            The states of the n trials.
+        r : ndarray, shape(n, 5)
+            The reference noise and platform acceleration of each trial.
+        g : ndarray, shape(8,) or shape(n, 8)
+            The flattened gain matrix, S .* K, shared by all trials or for
+            each trial.
+
+        and returns the state derivatives, ndarray shape(n, 4).
+
+        """
+
+        if not hasattr(self, '_open_loop_numpy_rhs'):
+            args = (self.states() + self.specifieds.values()[-3:] +
+                    self.parameters.values())
+            self._open_loop_numpy_rhs = sy.lambdify(args, list(self.rhs),
+                                                    modules='numpy')
+
+        evaluate = self._open_loop_numpy_rhs
+        constants = list(self.open_loop_par_map.values())
+
+        def rhs(x, r, g):
+
+            # T = (S .* K) * (x_ref - x) for each trial
+            gains = np.reshape(g, (-1, 2, 4))
+            torques = np.matmul(gains, (r[:, :4] - x)[:, :, np.newaxis])
+
+            xdot = evaluate(*(list(x.T) + [r[:, 4], torques[:, 0, 0],
+                                           torques[:, 1, 0]] + constants))
+
+            # Expressions that do not depend on the inputs are scalars.
+            return np.column_stack(np.broadcast_arrays(*xdot))
+
+        return rhs
+
+    def simulate_ensemble(self, time, reference_noises,
+                          platform_accelerations, gains=None,
+                          initial_conditions=None, substeps=4):
+        """Returns the state trajectories of many closed loop simulations
+        that share the same time vector. All of the trials are stepped
+        together with a fixed step fourth order Runge-Kutta method, so each
+        step is a handful of array operations regardless of the number of
+        trials. The inputs are interpolated between the samples with the
+        model's interpolation kind like in closed_loop_ode_func().
+
+        Parameters
+        ----------
+        time : ndarray, shape(N,)
+            The equally spaced time values.
+        reference_noises : ndarray, shape(n, N, 4)
+            The reference noise of each trial.
+        platform_accelerations : ndarray, shape(n, N)
+            The acceleration of the platform of each trial.
+        gains : ndarray, shape(8,) or shape(n, 8), optional
+            The flattened gain matrix, S .* K, for all trials or for each
+            trial. Defaults to closed_loop_gains().
+        initial_conditions : ndarray, shape(4,) or shape(n, 4), optional
+            The initial states, defaults to zero.
+        substeps : integer, optional
+            The number of integration steps between each sample.
+
+        Returns
+        -------
+        states : ndarray, shape(n, N, 4)
+            The state trajectories of each trial.
+
+        """
+
+        interval = time[1] - time[0]
+        if not np.allclose(np.diff(time), interval):
+            raise ValueError('The time values must be equally spaced.')
+
+        if gains is None:
+            gains = self.closed_loop_gains()
+
+        rhs = self.ensemble_closed_loop_rhs()
+
+        signals = np.concatenate((reference_noises,
+                                  platform_accelerations[:, :, np.newaxis]),
+                                 axis=2)
+
+        num_trials, num_samples = signals.shape[:2]
+
+        # The polynomial coefficients of the inputs in each interval, the
+        # same ones the Interpolator uses, shape(N - 1, k, n, 5).
+        coefficients = _coefficients(
+            time, signals.transpose(1, 0, 2).reshape(num_samples, -1),
+            self.interpolation).reshape(num_samples - 1, -1, num_trials, 5)
+
+        def inputs(k, offset):
+            c = coefficients[k]
+            value = c[-1]
+            for i in range(len(c) - 2, -1, -1):
+                value = value * offset + c[i]
+            return value
+
+        x = np.zeros((num_trials, 4))
+        if initial_conditions is not None:
+            x[:] = initial_conditions
+
+        states = np.empty((num_trials, num_samples, 4))
+        states[:, 0] = x
+
+        h = interval / substeps
+
+        for k in range(num_samples - 1):
+
+            for j in range(substeps):
+
+                r_start = inputs(k, j * h)
+                r_mid = inputs(k, (j + 0.5) * h)
+                if j == substeps - 1:
+                    # The interpolator gives the next sample at the end of
+                    # the interval, which differs for a zero order hold.
+                    r_end = signals[:, k + 1]
+                else:
+                    r_end = inputs(k, (j + 1) * h)
+
+                k1 = rhs(x, r_start, gains)
+                k2 = rhs(x + h / 2.0 * k1, r_mid, gains)
+                k3 = rhs(x + h / 2.0 * k2, r_mid, gains)
+                k4 = rhs(x + h * k3, r_end, gains)
+
+                x = x + h / 6.0 * (k1 + 2.0 * k2 + 2.0 * k3 + k4)
+
+            states[:, k + 1] = x
+
+        return states
+
+    def open_loop_ode_func(self):
+        """Returns the compiled function that evaluates the right hand side
+        of the open loop first order ODEs, f(x, t, r, p), where r is a
+        function, r(x, t), that returns [a, T_a, T_h] and p is the array of
+        constants. The compiled extension is stored in the on disk cache, so
+        it is only compiled the first time it is requested on a machine."""
+
+        if not hasattr(self, '_open_loop_rhs'):
+            g = CachedCythonODEFunctionGenerator(
+                self.rhs,
+                self.coordinates.values(),
+                self.speeds.values(),
+                self.parameters.values(),
+                specifieds=self.specifieds.values()[-3:],
+                constants_arg_type='array',
+                specifieds_arg_type='function')
+            self._open_loop_rhs = g.generate()
 
-        return rhs, controller, np.array(self.open_loop_par_map.values())
+        return self._open_loop_rhs
 
     def first_order_implicit(self):
         return sy.Matrix(self.kin_diff_eqs).col_join(self.fr_plus_frstar_closed)
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+"""This compares the time to indirectly identify the gains with direct
+collocation on a single mesh with a node at every sample to the time of the
+coarse to fine multilevel solve, indirect_collocation.identify_multilevel(),
+for trials of increasing length sampled at 100 Hz."""
+
+import sys
+import time
+
+import numpy as np
+
+from model import QuietStandingModel
+from measured_data import DataGenerator
+import indirect_collocation
+
+sample_rate = 100.0  # hz
+node_counts = [4001, 6001, 60001]
+factors = (16, 4, 1)
+
+ipopt_options = {'print_level': 0,
+                 'sb': "yes",
+                 'linear_solver': 'ma57'}
+
+model = QuietStandingModel(scaled_gains=0.5)
+model.derive()
+
+
+def single_level(time_interval, states, accel):
+    start = time.time()
+    ider = indirect_collocation.CollocationIdentifier(
+        model, len(states), time_interval, ipopt_options=ipopt_options)
+    setup_time = time.time() - start
+
+    ider.update(states, accel)
+
+    start = time.time()
+    gains = ider.identify(ider.initial_guess())
+    solve_time = time.time() - start
+
+    return gains, setup_time, solve_time, ider.iterations
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) > 1:
+        node_counts = [int(n) for n in sys.argv[1:]]
+
+    known_gains = model.numerical_gains.flatten()
+
+    for num_nodes in node_counts:
+
+        duration = (num_nodes - 1) / sample_rate
+        time_interval = 1.0 / sample_rate
+
+        data = DataGenerator(duration, num_nodes, 0.0, 0.1, model)
+        data.generate(0.0, 0.0, 0.0, 0.0)
+        states, accel = data.measured['x'], data.measured['a']
+
+        gains, setup_time, solve_time, iterations = single_level(
+            time_interval, states, accel)
+
+        print('{} nodes'.format(num_nodes))
+        print('  Single level: setup {:1.1f} s, solve {:1.1f} s, '
+              '{} iterations, max gain error {:1.2%}'.format(
+                  setup_time, solve_time, iterations,
+                  np.max(np.abs(gains - known_gains) / known_gains)))
+
+        results = indirect_collocation.identify_multilevel(
+            time_interval, states, accel, model, factors=factors,
+            ipopt_options=ipopt_options)
+
+        for level in results['levels']:
+            print('  Level with {num_nodes} nodes: setup {setup_time:1.1f} '
+                  's, solve {solve_time:1.1f} s, {iterations} '
+                  'iterations'.format(**level))
+
+        multilevel_setup = sum(l['setup_time'] for l in results['levels'])
+        multilevel_solve = sum(l['solve_time'] for l in results['levels'])
+
+        print('  Multilevel: setup {:1.1f} s, solve {:1.1f} s, max gain '
+              'error {:1.2%}'.format(
+                  multilevel_setup, multilevel_solve,
+                  np.max(np.abs(results['gains'] - known_gains) /
+                         known_gains)))
+        print('  Solve speed up: {:1.1f}'.format(solve_time /
+                                                  multilevel_solve))
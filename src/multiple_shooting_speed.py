@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+"""This compares single shooting, with Levenberg-Marquardt and the exact
+Jacobian, to multiple shooting with segments simulated in parallel, on a
+trial as long as the one in initial_guesses.py, from an initial guess near
+the known gains and from all zeros. The number of worker processes can be
+given as the first argument and defaults to the number of cores."""
+
+import sys
+import time
+
+import numpy as np
+
+from model import QuietStandingModel
+from measured_data import DataGenerator
+import indirect_shooting
+
+sample_rate = 100.0  # hz
+duration = 60.0  # s
+segment_duration = 1.0  # s
+
+num_samples = int(sample_rate * duration) + 1
+num_segments = int(duration / segment_duration)
+
+model = QuietStandingModel(scaled_gains=0.5 * np.ones((2, 4)))
+model.derive()
+
+data = DataGenerator(duration, num_samples, 0.0, 0.05, model)
+data.generate(0.0, 0.0, 0.0, 0.0)
+
+runtime = model.closed_loop_runtime(data.time, data.ref_noise,
+                                    data.actual['a'])
+
+known_gains = model.numerical_gains.flatten()
+measured_states = data.measured['x']
+
+# The scaled gains are 0.5.
+initial_guesses = [('20% from the known gains', 0.4 * np.ones(8)),
+                   ('all zeros', np.zeros(8))]
+
+
+def report(name, gains, duration):
+    print('  {}: {:1.1f} s, max gain error {:1.2%}'.format(
+        name, duration, np.max(np.abs(gains - known_gains) / known_gains)))
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) > 1:
+        processes = int(sys.argv[1])
+    else:
+        processes = None
+
+    print('{} samples, {} segments'.format(num_samples, num_segments))
+
+    with indirect_shooting.ShootingPool(processes) as pool:
+
+        for name, initial_guess in initial_guesses:
+
+            print('Initial guess: {}'.format(name))
+
+            start = time.time()
+            gains = indirect_shooting.identify(
+                data.time, measured_states, data.rhs, (data.r, data.p),
+                model, method='LM', initial_guess=initial_guess,
+                runtime=runtime)
+            report('Single shooting', gains, time.time() - start)
+
+            start = time.time()
+            results = indirect_shooting.identify_multiple_shooting(
+                runtime, measured_states, model.gain_scale_factors,
+                num_segments, initial_guess=initial_guess, pool=pool)
+            report('Multiple shooting', results['gains'],
+                   time.time() - start)
+            print('    Evaluations: {}, max continuity defect: '
+                  '{:1.2e}'.format(results['evaluations'],
+                                   np.max(np.abs(results['defects']))))
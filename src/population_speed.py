@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+"""This compares the time to evaluate the shooting objective of a CMA-ES
+population when each candidate is simulated with odeint to when the whole
+population is simulated at once with
+indirect_shooting.population_objective(), both in this process and split
+among the workers of a ShootingPool, and checks that all of them give the
+same values."""
+
+import time
+
+import numpy as np
+
+from model import QuietStandingModel
+from measured_data import DataGenerator
+import indirect_shooting
+
+num_nodes = 2001
+duration = 20.0
+population_size = 48
+
+model = QuietStandingModel(scaled_gains=0.5)
+model.derive()
+
+data = DataGenerator(duration, num_nodes, 0.0, 0.05, model)
+data.generate(0.0, 0.0, 0.0, 0.0)
+
+runtime = model.closed_loop_runtime(data.time, data.ref_noise,
+                                    data.actual['a'])
+
+np.random.seed(0)
+population = np.random.uniform(0.25, 0.75, size=(population_size, 8))
+
+measured_states = data.measured['x']
+
+
+def odeint_objective():
+    scale_factors = model.gain_scale_factors.flatten()
+    return np.array([indirect_shooting.sum_of_squares(
+        measured_states, runtime.simulate(scale_factors * gains))
+        for gains in population])
+
+
+def vectorized_objective():
+    return indirect_shooting.population_objective(
+        population, runtime, measured_states, model.gain_scale_factors)
+
+
+def report(name, function):
+    start = time.time()
+    values = np.asarray(function())
+    print('{}: {:1.2f} s'.format(name, time.time() - start))
+    return values
+
+
+if __name__ == "__main__":
+
+    print('{} candidates, {} samples'.format(population_size, num_nodes))
+
+    expected = report('odeint, one candidate at a time', odeint_objective)
+    values = report('Vectorized', vectorized_objective)
+    print('  Max relative difference: {:1.2e}'.format(
+        np.max(np.abs(values - expected) / expected)))
+
+    with indirect_shooting.ShootingPool() as pool:
+        key = pool.load(runtime, measured_states, model.gain_scale_factors)
+        # The first generation loads the data in the workers.
+        pool.objective(key, population)
+        report('Pool, odeint',
+               lambda: pool.objective(key, population))
+        values = report('Pool, vectorized chunks',
+                        lambda: pool.objective(key, population,
+                                               vectorized=True))
+        difference = np.max(np.abs(values - expected) / expected)
+        print('  Max relative difference: {:1.2e}'.format(difference))
+        # The pooled values must be the same objective as the serial one,
+        # up to the difference of the integrators.
+        assert difference < 1e-3
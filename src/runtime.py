@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+
+"""A purely numerical version of the closed loop system that can be pickled
+and sent to other processes. The QuietStandingModel holds SymPy objects and
+the functions generated from it can't be pickled, so spawn based process
+pools and joblib's caching can't work with it directly."""
+
+import numpy as np
+from scipy.integrate import odeint
+
+from fast_interpolate import Interpolator
+import codegen
+
+
+class ClosedLoopRuntime(object):
+
+    def __init__(self, module_name, sources, constants, gains, time,
+                 reference_noise, platform_acceleration,
+                 interpolation='linear'):
+        """Create these with QuietStandingModel.closed_loop_runtime().
+
+        Parameters
+        ==========
+        module_name : string
+            The name of the compiled closed loop ODE extension.
+        sources : dictionary
+            The source files needed to compile the extension if it isn't in
+            the on disk cache of the process that uses the runtime.
+        constants : ndarray, shape(p,)
+            The numerical values of the model constants.
+        gains : ndarray, shape(8,)
+            The flattened closed loop gain matrix, S .* K.
+        time : ndarray, shape(N,)
+            The monotonically increasing time values.
+        reference_noise : ndarray, shape(N, 4)
+            The reference noise vector at each time.
+        platform_acceleration : ndarray, shape(N,)
+            The acceleration of the platform at each time.
+        interpolation : string, optional
+            The kind of interpolation of the input signals.
+
+        """
+
+        self.module_name = module_name
+        self.sources = sources
+        self.constants = np.ascontiguousarray(constants, dtype=float)
+        self.gains = np.ascontiguousarray(gains, dtype=float).flatten()
+        self.time = np.ascontiguousarray(time, dtype=float)
+        self.reference_noise = np.ascontiguousarray(reference_noise,
+                                                    dtype=float)
+        self.platform_acceleration = np.ascontiguousarray(
+            platform_acceleration, dtype=float)
+        self.interpolation = interpolation
+
+        self._interpolator = None
+        self._rhs = None
+
+    def __getstate__(self):
+        # The compiled function and the interpolator are created again when
+        # they are first needed.
+        state = self.__dict__.copy()
+        state['_interpolator'] = None
+        state['_rhs'] = None
+        return state
+
+    @property
+    def interpolator(self):
+        """The interpolator of the [reference noise, platform acceleration]
+        signals which is shared by all of the ODE functions."""
+
+        if self._interpolator is None:
+            signals = np.hstack((self.reference_noise,
+                                 np.expand_dims(self.platform_acceleration,
+                                                1)))
+            self._interpolator = Interpolator(self.time, signals,
+                                              kind=self.interpolation)
+
+        return self._interpolator
+
+    def ode_function(self):
+        """Returns a new compiled closed loop ODE function, f(x, t, g), see
+        QuietStandingModel.native_closed_loop_ode_func(). The functions
+        share the runtime's interpolator but have their own work arrays and
+        search cursor, so use a separate function in each thread."""
+
+        ode_class = codegen.load_closed_loop_ode_function_class(
+            self.module_name, self.sources)
+
+        return ode_class(self.interpolator, self.constants)
+
+    @property
+    def rhs(self):
+        """A compiled closed loop ODE function, see ode_function()."""
+
+        if self._rhs is None:
+            self._rhs = self.ode_function()
+
+        return self._rhs
+
+    def simulate(self, gains=None, initial_conditions=None):
+        """Returns the states of the closed loop system at each time.
+
+        Parameters
+        ==========
+        gains : array_like, shape(8,) or shape(2, 4), optional
+            The closed loop gains, S .* K, defaults to the runtime's gains.
+        initial_conditions : array_like, shape(4,), optional
+            The initial states, defaults to zero.
+
+        Returns
+        =======
+        x : ndarray, shape(N, 4)
+
+        """
+
+        if gains is None:
+            gains = self.gains
+        else:
+            gains = np.ascontiguousarray(gains, dtype=float).flatten()
+
+        if initial_conditions is None:
+            initial_conditions = np.zeros(4)
+
+        # A new function is used so that many simulations can run at once in
+        # a thread pool with the same input signals.
+        rhs = self.ode_function()
+
+        return odeint(rhs, initial_conditions, self.time, args=(gains,),
+                      Dfun=rhs.jacobian)
+
+    def simulate_ensemble(self, gains, initial_conditions=None, substeps=4):
+        """Returns the states of the closed loop system at each time for
+        many gains. All of the simulations are stepped together with a fixed
+        step fourth order Runge-Kutta method, so each step evaluates the
+        compiled ODEs of every simulation in a single call. The inputs are
+        interpolated like in simulate().
+
+        Parameters
+        ==========
+        gains : array_like, shape(n, 8)
+            The closed loop gains, S .* K, of each simulation.
+        initial_conditions : array_like, shape(4,) or shape(n, 4), optional
+            The initial states, defaults to zero.
+        substeps : integer, optional
+            The number of integration steps between each time.
+
+        Returns
+        =======
+        x : ndarray, shape(n, N, 4)
+
+        """
+
+        gains = np.ascontiguousarray(np.atleast_2d(gains), dtype=float)
+        num_simulations = gains.shape[0]
+
+        x = np.zeros((num_simulations, 4))
+        if initial_conditions is not None:
+            x[:] = initial_conditions
+
+        states = np.empty((num_simulations, len(self.time), 4))
+        states[:, 0] = x
+
+        rhs = self.ode_function().evaluate_many
+
+        for k in range(len(self.time) - 1):
+
+            h = (self.time[k + 1] - self.time[k]) / substeps
+
+            for j in range(substeps):
+
+                t = self.time[k] + j * h
+
+                k1 = rhs(x, t, gains)
+                k2 = rhs(x + h / 2.0 * k1, t + h / 2.0, gains)
+                k3 = rhs(x + h / 2.0 * k2, t + h / 2.0, gains)
+                k4 = rhs(x + h * k3, t + h, gains)
+
+                x = x + h / 6.0 * (k1 + 2.0 * k2 + 2.0 * k3 + k4)
+
+            states[:, k + 1] = x
+
+        return states
+
+    def simulate_sensitivities(self, gains=None, initial_conditions=None,
+                               time=None,
+                               initial_condition_sensitivities=False):
+        """Returns the states of the closed loop system and their partial
+        derivatives with respect to the closed loop gains at each time. The
+        sensitivity equations are integrated along with the states, so the
+        derivatives are exact up to the integration tolerances.
+
+        Parameters
+        ==========
+        gains : array_like, shape(8,) or shape(2, 4), optional
+            The closed loop gains, S .* K, defaults to the runtime's gains.
+        initial_conditions : array_like, shape(4,), optional
+            The initial states, defaults to zero.
+        time : ndarray, shape(n,), optional
+            The monotonically increasing times, within the runtime's time
+            values, of the initial conditions and the returned states.
+            Defaults to the runtime's time values.
+        initial_condition_sensitivities : boolean, optional
+            If true, the partial derivatives of the states with respect to
+            the initial conditions are also returned.
+
+        Returns
+        =======
+        x : ndarray, shape(n, 4)
+        dxdg : ndarray, shape(n, 4, 8)
+            dxdg[k, i, p] is the derivative of x_i with respect to g_p at
+            the kth time.
+        dxdx0 : ndarray, shape(n, 4, 4)
+            dxdx0[k, i, j] is the derivative of x_i at the kth time with
+            respect to the jth initial condition. Only returned if
+            initial_condition_sensitivities is true.
+
+        """
+
+        if gains is None:
+            gains = self.gains
+        else:
+            gains = np.ascontiguousarray(gains, dtype=float).flatten()
+
+        if time is None:
+            time = self.time
+
+        num_states = 4
+        num_gains = len(gains)
+        num_columns = num_gains
+
+        if initial_condition_sensitivities:
+            num_columns += num_states
+
+        y0 = np.zeros(num_states + num_states * num_columns)
+        if initial_conditions is not None:
+            y0[:num_states] = initial_conditions
+        if initial_condition_sensitivities:
+            # dx0/dx0 = I
+            z0 = y0[num_states:].reshape(num_states, num_columns)
+            z0[:, num_gains:] = np.eye(num_states)
+
+        rhs = self.ode_function()
+
+        sensitivity_block = np.eye(num_columns)
+
+        def jacobian(y, t, g):
+            # The dependence of the sensitivity equations on the states is
+            # left out, which only affects the convergence of the implicit
+            # steps, not the accuracy of the solution.
+            jac = np.zeros((len(y), len(y)))
+            state_jac = rhs.jacobian(y[:num_states], t, g)
+            jac[:num_states, :num_states] = state_jac
+            jac[num_states:, num_states:] = np.kron(state_jac,
+                                                    sensitivity_block)
+            return jac
+
+        y = odeint(rhs.sensitivities, y0, time, args=(gains,),
+                   Dfun=jacobian)
+
+        sensitivities = y[:, num_states:].reshape(-1, num_states,
+                                                  num_columns)
+
+        if initial_condition_sensitivities:
+            return (y[:, :num_states], sensitivities[:, :, :num_gains],
+                    sensitivities[:, :, num_gains:])
+        else:
+            return y[:, :num_states], sensitivities
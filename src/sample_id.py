@@ -44,9 +44,11 @@ indirect_dc_gains = indirect_collocation.identify(num_nodes, data.interval,
 
 # Indirect identification via single shooting
 print('Indirect Identification via Shooting.')
+runtime = h.closed_loop_runtime(data.time, data.ref_noise, data.actual['a'])
 indirect_sh_gains = indirect_shooting.identify(data.time,
                                                data.measured['x'], data.rhs,
-                                               (data.r, data.p), h, method="CMA")
+                                               (data.r, data.p), h,
+                                               method="CMA", runtime=runtime)
 
 print_gains(h.numerical_gains.flatten(),
             direct_gains,
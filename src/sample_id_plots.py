@@ -15,7 +15,12 @@ paths = utils.config_paths()
 
 sample_rate = 300.0  # hz
 duration = 20.0  # s
-num_nodes = int(sample_rate * duration) + 1
+num_samples = int(sample_rate * duration) + 1
+
+# The collocation nodes don't need to be as dense as the samples to resolve
+# the dynamics of the system.
+node_rate = 100.0  # hz
+num_nodes = int(node_rate * duration) + 1
 time_interval = duration / (num_nodes - 1)
 
 ref_noise = 0.0  # np.deg2rad(1.0)
@@ -33,23 +38,19 @@ model = QuietStandingModel(scaled_gains=0.5 * np.ones((2, 4)))
 model.derive()
 
 print('Generating simulated noisy data.')
-data = DataGenerator(duration, num_nodes, ref_noise, platform_pos_mag,
+data = DataGenerator(duration, num_samples, ref_noise, platform_pos_mag,
                      model=model)
 data.generate(accel_noise, coord_noise, speed_noise, torque_noise)
 
 # Indirect identification via direct collocation
 print('Indirect Identification via Direct Collocation.')
-prob = indirect_collocation.setup_problem(num_nodes, data.interval,
-                                          data.measured['x'],
-                                          data.measured['a'], model)
-
-initial_guess = np.zeros(prob.num_free)
-
-solution, info = prob.solve(initial_guess)
+ider = indirect_collocation.CollocationIdentifier(model, num_nodes,
+                                                  time_interval,
+                                                  num_samples=num_samples)
+ider.update(data.measured['x'], data.measured['a'])
 
-identified_states = solution[:-8].reshape(4, num_nodes).T
-identified_gains = (model.gain_scale_factors.flatten() *
-                    solution[-8:]).reshape(2, 4)
+identified_gains = ider.identify().reshape(2, 4)
+identified_states = ider.solution[:-8].reshape(4, num_nodes).T
 
 gain_relative_error = ((identified_gains - model.numerical_gains) /
                        model.numerical_gains * 100.0)
@@ -94,14 +95,15 @@ params = {'backend': 'ps',
 plt.rcParams.update(params)
 fig, axes = plt.subplots(2, 1, sharex=True)
 
-plot_dur = 3.0 * sample_rate
+plot_dur = int(3.0 * sample_rate)
+plot_nodes = int(3.0 * node_rate)
 
 # coordinates
 axes[0].plot(data.time[:plot_dur],
              np.rad2deg(data.measured['x'][:plot_dur, :2]), '.k',
              markersize=1.0, label='_nolegend_')
-axes[0].plot(data.time[:plot_dur],
-             np.rad2deg(identified_states[:plot_dur, :2]), '-', alpha=0.75)
+axes[0].plot(ider.node_times[:plot_nodes],
+             np.rad2deg(identified_states[:plot_nodes, :2]), '-', alpha=0.75)
 axes[0].set_ylabel('Angle [deg]')
 axes[0].legend([r'$\theta_a$', r'$\theta_h$'])
 
@@ -109,8 +111,8 @@ axes[0].legend([r'$\theta_a$', r'$\theta_h$'])
 axes[1].plot(data.time[:plot_dur],
              np.rad2deg(data.measured['x'][:plot_dur, 2:]), '.k',
              markersize=1.0, label='_nolegend_')
-axes[1].plot(data.time[:plot_dur],
-             np.rad2deg(identified_states[:plot_dur, 2:]), '-', alpha=0.75)
+axes[1].plot(ider.node_times[:plot_nodes],
+             np.rad2deg(identified_states[:plot_nodes, 2:]), '-', alpha=0.75)
 axes[1].set_ylabel('Angluar Rate [deg/s]')
 axes[1].set_xlabel('Time [s]')
 axes[1].legend([r'$\omega_a$', r'$\omega_h$'])
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+"""This compares the cost of the gradient of the shooting objective from
+finite differences to the exact gradient from the forward sensitivity
+equations, and the time to identify the gains by single shooting with SLSQP
+and finite differences, with SLSQP and the exact gradient, and with
+Levenberg-Marquardt and the exact Jacobian of the state errors."""
+
+import time
+
+import numpy as np
+
+from model import QuietStandingModel
+from measured_data import DataGenerator
+import indirect_shooting
+
+num_nodes = 1001
+duration = 10.0
+
+model = QuietStandingModel(scaled_gains=0.5 * np.ones((2, 4)))
+model.derive()
+
+data = DataGenerator(duration, num_nodes, 0.0, 0.05, model)
+data.generate(0.0, 0.0, 0.0, 0.0)
+
+runtime = model.closed_loop_runtime(data.time, data.ref_noise,
+                                    data.actual['a'])
+
+known_gains = model.numerical_gains.flatten()
+scale_factors = model.gain_scale_factors.flatten()
+measured_states = data.measured['x']
+
+
+def finite_difference_gradient(gains, step=1e-6):
+    def f(gains):
+        return indirect_shooting.sum_of_squares(
+            measured_states, runtime.simulate(scale_factors * gains))
+    value = f(gains)
+    return np.array([(f(gains + step * e) - value) / step
+                     for e in np.eye(len(gains))])
+
+
+def exact_gradient(gains):
+    return indirect_shooting.objective_and_gradient(
+        gains, runtime, measured_states, model.gain_scale_factors)[1]
+
+
+def timed(function, *args, **kwargs):
+    start = time.time()
+    result = function(*args, **kwargs)
+    return result, time.time() - start
+
+
+if __name__ == "__main__":
+
+    # The scaled gains are 0.5, so this is 20% from the known gains.
+    initial_guess = 0.4 * np.ones(8)
+
+    # Compiles the extension if needed.
+    exact_gradient(initial_guess)
+
+    fd, fd_time = timed(finite_difference_gradient, initial_guess)
+    exact, exact_time = timed(exact_gradient, initial_guess)
+
+    print('Gradient time: finite differences {:1.3f} s, exact {:1.3f} '
+          's'.format(fd_time, exact_time))
+    print('  Relative difference: {:1.2e}'.format(
+        np.linalg.norm(fd - exact) / np.linalg.norm(exact)))
+
+    runs = [('SLSQP, finite differences', {}),
+            ('SLSQP, exact gradient', {'exact_gradient': True}),
+            ('Levenberg-Marquardt, exact Jacobian', {'method': 'LM'})]
+
+    results = []
+    for name, kwargs in runs:
+        identified, elapsed = timed(
+            indirect_shooting.identify, data.time, measured_states,
+            data.rhs, (data.r, data.p), model, initial_guess=initial_guess,
+            runtime=runtime, **kwargs)
+        results.append((name, identified, elapsed))
+
+    for name, identified, elapsed in results:
+        print(name)
+        print('  Time: {:1.1f} s'.format(elapsed))
+        print('  Max gain error: {:1.2%}'.format(
+            np.max(np.abs(identified - known_gains) / known_gains)))
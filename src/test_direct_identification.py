@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+"""This tests the direct identification methods against the SciPy least
+squares solution of a single trial."""
+
+import numpy as np
+
+import direct_identification
+
+gains = np.random.random((2, 4))
+states = np.random.random((3, 5, 200, 4))
+torques = (-np.dot(states, gains.T) +
+           0.01 * np.random.random((3, 5, 200, 2)))
+
+identified, residuals, ranks = direct_identification.identify_batch(
+    torques, states)
+
+ider = direct_identification.ControllerIdentifier(torques[1, 2],
+                                                  states[1, 2])
+
+np.testing.assert_allclose(identified[1, 2], ider.identify().flatten())
+np.testing.assert_allclose(residuals[1, 2], ider.residuals)
+assert (ranks == 4).all()
+
+# The recursive estimate converges to the least squares estimate. The
+# initial covariance acts like a ridge penalty of its inverse on the gains,
+# so it is made large enough for that bias to be well below the tolerance
+# (the default of 1e6 biases the small gains by up to 1e-5 relative).
+rls = direct_identification.RecursiveControllerIdentifier(
+    initial_covariance=1e9)
+rls.update(torques[1, 2, 0], states[1, 2, 0])
+rls.update(torques[1, 2, 1:], states[1, 2, 1:])
+
+assert rls.num_samples == 200
+np.testing.assert_allclose(rls.identify().flatten(), identified[1, 2],
+                           rtol=1e-6)
+
+# The prefixes and windows give the least squares estimates of each slice.
+cum = direct_identification.CumulativeControllerIdentifier(torques[1, 2],
+                                                           states[1, 2])
+
+np.testing.assert_allclose(cum.identify_prefixes([200])[0], identified[1, 2])
+np.testing.assert_allclose(
+    cum.identify_windows([10, 50], [60, 150]),
+    [direct_identification.identify(torques[1, 2, 10:60],
+                                    states[1, 2, 10:60]),
+     direct_identification.identify(torques[1, 2, 50:150],
+                                    states[1, 2, 50:150])])
+
+# A short window late in a long trial keeps its precision, the sums are not
+# differences of sums over the whole trial. The states are offset from zero
+# so that the sums of their products grow with the trial length.
+long_states = 1.0 + 0.1 * np.random.random((60001, 4))
+long_torques = (-np.dot(long_states, gains.T) +
+                0.01 * np.random.random((60001, 2)))
+cum = direct_identification.CumulativeControllerIdentifier(long_torques,
+                                                           long_states)
+np.testing.assert_allclose(
+    cum.identify_windows([59901], [60001])[0],
+    direct_identification.identify(long_torques[59901:],
+                                   long_states[59901:]), rtol=1e-9)
+
+# The ridge path starts at the least squares estimate and shrinks the gains.
+path = ider.ridge_path([0.0, 1.0, 1e6])
+np.testing.assert_allclose(path[0], identified[1, 2])
+assert (np.abs(path[2]) < np.abs(path[1])).all()
+
+lower, upper = ider.bootstrap(num_resamples=200, block_length=10, seed=0,
+                              n_jobs=2)
+assert ider.bootstrap_gains.shape == (200, 8)
+assert (lower < identified[1, 2]).all() and (identified[1, 2] < upper).all()
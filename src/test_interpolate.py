@@ -8,6 +8,8 @@ from scipy.interpolate import interp1d
 
 from fast_interpolate import Interpolator
 
+np.random.seed(0)
+
 x = np.linspace(0.0, 10.0, 5000)
 y = np.random.random((len(x), 4))
 
@@ -19,3 +21,64 @@ res = np.empty((4,))
 x_new = 10.0 * np.random.random(1)[0]
 
 np.testing.assert_allclose(f(x_new), i.interpolate(x_new, res))
+
+# The uniform spacing is detected and gives the same results as searching
+# for the interval.
+assert i.uniform
+searching = Interpolator(x, y, uniform=False)
+
+x_many = np.sort(10.0 * np.random.random(1000))
+x_many[:2] = x[0], x[-1]
+
+np.testing.assert_allclose(f(x_many), i.interpolate_many(x_many))
+np.testing.assert_allclose(f(x_many), searching.interpolate_many(x_many))
+
+# Non-uniformly spaced data.
+x_log = np.logspace(-2.0, 1.0, 5000)
+f_log = interp1d(x_log, y, axis=0)
+i_log = Interpolator(x_log, y)
+assert not i_log.uniform
+
+x_many = np.sort(0.01 + 9.99 * np.random.random(1000))
+out = np.empty((len(x_many), 4))
+np.testing.assert_allclose(f_log(x_many), i_log.interpolate_many(x_many, out))
+
+# Many threads can share one interpolator.
+from multiprocessing.pool import ThreadPool
+
+pool = ThreadPool(4)
+x_chunks = np.array_split(x_many, 8)
+results = pool.map(i_log.interpolate_many, x_chunks)
+pool.close()
+
+np.testing.assert_allclose(f_log(x_many), np.vstack(results))
+
+# Zero order hold gives the value at the start of each interval.
+f_zero = interp1d(x, y, axis=0, kind='zero')
+i_zero = Interpolator(x, y, kind='zero')
+x_many = np.sort(10.0 * np.random.random(1000))
+np.testing.assert_allclose(f_zero(x_many), i_zero.interpolate_many(x_many))
+
+# Exactly at the sample times the hold gives the value of that sample, even
+# where the computed uniform position rounds below the sample's index.
+x_samples = np.linspace(0.0, 40.0, 4001)
+y_samples = np.ascontiguousarray(np.random.random((len(x_samples), 4)))
+for uniform in [True, False]:
+    i_samples = Interpolator(x_samples, y_samples, uniform=uniform,
+                             kind='zero')
+    np.testing.assert_equal(i_samples.interpolate_many(x_samples),
+                            y_samples)
+
+# The cubic interpolation of a quadratic is exact.
+y_quad = np.ascontiguousarray(np.vstack((x**2, 3.0 - x**2)).T)
+i_cubic = Interpolator(x, y_quad, kind='cubic')
+np.testing.assert_allclose(np.vstack((x_many**2, 3.0 - x_many**2)).T,
+                           i_cubic.interpolate_many(x_many))
+
+# The derivatives of the cubic polynomials need at least three samples.
+try:
+    Interpolator(x[:2], y_quad[:2], kind='cubic')
+except ValueError:
+    pass
+else:
+    raise AssertionError('Cubic interpolation of two samples was accepted.')
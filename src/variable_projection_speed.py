@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+
+"""This compares the number of iterations and the time to indirectly
+identify the gains of the sample_id.py scenario with direct collocation,
+where IPOPT searches for the states and the gains, to the variable
+projection solve, where the gains are eliminated by linear least squares and
+only the states are searched for, and to single shooting."""
+
+import time
+
+import numpy as np
+
+from model import QuietStandingModel
+from measured_data import DataGenerator
+import indirect_collocation
+import indirect_shooting
+
+num_nodes = 4001
+duration = 20.0
+
+ref_noise_std = 0.0
+platform_pos_mag = 0.01
+
+ipopt_options = {'print_level': 0,
+                 'sb': "yes",
+                 'linear_solver': 'ma57'}
+
+h = QuietStandingModel(scaled_gains=0.5 * np.ones((2, 4)))
+h.derive()
+
+data = DataGenerator(duration, num_nodes, ref_noise_std, platform_pos_mag,
+                     model=h)
+data.generate(0.0, 0.0, 0.0, 0.0)
+
+known_gains = h.numerical_gains.flatten()
+
+
+def report(name, gains, duration, iterations=None):
+    print(name)
+    print('  Time: {:1.1f} s'.format(duration))
+    if iterations is not None:
+        print('  Iterations: {}'.format(iterations))
+    print('  Max gain error: {:1.2%}'.format(
+        np.max(np.abs(gains - known_gains) / known_gains)))
+
+
+if __name__ == "__main__":
+
+    ider = indirect_collocation.CollocationIdentifier(
+        h, num_nodes, data.interval, ipopt_options=ipopt_options)
+    ider.update(data.measured['x'], data.measured['a'])
+
+    # Like indirect_collocation.identify(), this starts from all zeros.
+    start = time.time()
+    gains = ider.identify()
+    report('Direct collocation', gains, time.time() - start,
+           ider.iterations)
+
+    start = time.time()
+    gains = ider.identify_projected()
+    report('Direct collocation with variable projection', gains,
+           time.time() - start, ider.iterations)
+
+    start = time.time()
+    gains = indirect_shooting.identify(data.time, data.measured['x'],
+                                       data.rhs, (data.r, data.p), h)
+    report('Single shooting', gains, time.time() - start)
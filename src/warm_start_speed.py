@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+"""This compares the indirect identification of a small grid of trials, like
+the one in figure_bias.py, when every trial starts from the measured states
+and the known gains (cold start) to when each trial starts from the solution
+of its neighbour in the row (warm start). Both sweeps have the same IPOPT
+options, including the CPU time limit."""
+
+import shutil
+import tempfile
+
+import numpy as np
+
+from model import QuietStandingModel
+from measured_data import reference_noise, platform_acceleration
+import collocation_sweep
+from utils import timeit
+
+num_nodes = 501
+duration = 5.0
+time_interval = duration / (num_nodes - 1)
+
+ref_noise_stds = np.linspace(0.0, 0.04, num=4)
+platform_pos_mags = np.linspace(0.0, 0.1, num=11)
+
+ipopt_options = {'print_level': 0,
+                 'sb': "yes",
+                 'linear_solver': 'ma57',
+                 'max_iter': 300,
+                 'max_cpu_time': 6.0}
+
+model = QuietStandingModel(scaled_gains=0.5)
+model.derive()
+
+time = np.linspace(0.0, duration, num=num_nodes)
+
+shape = (len(ref_noise_stds), len(platform_pos_mags))
+
+np.random.seed(0)
+
+reference_noises = np.empty(shape + (num_nodes, 4))
+measured_accel = np.empty(shape + (num_nodes,))
+
+for i, ref_noise_std in enumerate(ref_noise_stds):
+    for j, platform_pos_mag in enumerate(platform_pos_mags):
+        reference_noises[i, j] = reference_noise(num_nodes, ref_noise_std)
+        measured_accel[i, j] = platform_acceleration(time, platform_pos_mag)
+
+measured_states = model.simulate_ensemble(
+    time, reference_noises.reshape(-1, num_nodes, 4),
+    measured_accel.reshape(-1, num_nodes)).reshape(shape + (num_nodes, 4))
+
+
+@timeit
+def sweep(warm_start):
+    directory = tempfile.mkdtemp()
+    try:
+        store = collocation_sweep.CellStore(directory)
+        return collocation_sweep.identify_grid(
+            measured_states, measured_accel, time_interval, store,
+            scaled_gains=0.5, ipopt_options=ipopt_options,
+            warm_start=warm_start)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+
+    for warm_start in [False, True]:
+
+        results, duration = sweep(warm_start)
+
+        print('Warm start' if warm_start else 'Cold start')
+        print('  Total time: {:1.1f} s'.format(duration))
+        print('  Solve time per trial: {:1.2f} s'.format(
+            results['time'].mean()))
+        print('  Iterations per trial: {:1.1f}'.format(
+            results['iterations'].mean()))
+        print('  Warm started trials: {}'.format(
+            results['warm_start'].sum()))
+        statuses, counts = np.unique(results['status'], return_counts=True)
+        for status, count in zip(statuses, counts):
+            print('  IPOPT status {}: {} trials'.format(status, count))
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+
+"""This module identifies the gains of a long trial with indirect
+identification via direct collocation by splitting the trial into
+overlapping time windows of the same length. Each window is a separate
+collocation problem with its own states and gains, so the size of the
+problems and of their factorizations is bounded by the window length and the
+windows can be solved in parallel. The windows are made to agree on a single
+set of gains with the consensus form of the alternating direction method of
+multipliers (ADMM):
+
+1. Every window is solved on its own and the consensus gains are the mean
+   of the window gains.
+2. Every window is solved again with a quadratic penalty that pulls its
+   gains towards the consensus gains, offset by the window's running sum of
+   disagreements, and is warm started from its last solution.
+3. The consensus gains are the mean of the offset window gains. Steps 2 and
+   3 are repeated until the window gains all agree with the consensus gains.
+
+All gains are the scaled gains of the collocation problem, i.e. the free
+variables bounded by 0 and 1."""
+
+from multiprocessing import Pool
+
+import numpy as np
+from logbook import Logger
+
+from model import QuietStandingModel
+import indirect_collocation
+
+log = Logger('Log')
+
+# The collocation problem of each worker process.
+_worker = {}
+
+
+def window_starts(num_nodes, window_nodes, overlap):
+    """Returns the index of the first node of each window such that every
+    window has window_nodes nodes, neighbouring windows share at least
+    overlap nodes and the windows cover all of the nodes.
+
+    Parameters
+    ==========
+    num_nodes : integer
+        The number of nodes of the trial.
+    window_nodes : integer
+        The number of nodes of each window.
+    overlap : integer
+        The minimum number of nodes shared by neighbouring windows.
+
+    Returns
+    =======
+    starts : ndarray, shape(w,)
+
+    """
+
+    if window_nodes >= num_nodes:
+        return np.array([0])
+
+    if overlap >= window_nodes:
+        raise ValueError('The overlap must be smaller than the window.')
+
+    num_windows = int(np.ceil(float(num_nodes - window_nodes) /
+                              (window_nodes - overlap))) + 1
+
+    return np.round(np.linspace(0, num_nodes - window_nodes,
+                                num=num_windows)).astype(int)
+
+
+def _initialize_worker(num_nodes, time_interval, scaled_gains,
+                       ipopt_options):
+    """Builds the model and the collocation problem of a window in a worker
+    process."""
+
+    model = QuietStandingModel(scaled_gains=scaled_gains)
+    model.derive()
+
+    _worker['ider'] = indirect_collocation.CollocationIdentifier(
+        model, num_nodes, time_interval, ipopt_options=ipopt_options)
+
+
+def _solve_window(task):
+    """Returns the scaled gains, the gain scale factors and the solution of
+    one window."""
+
+    (k, measured_states, measured_accel, penalty, target,
+     initial_guess, multipliers) = task
+
+    ider = _worker['ider']
+
+    ider.update(measured_states, measured_accel)
+    ider.set_gain_penalty(penalty, target)
+
+    if initial_guess is None:
+        # The free gains are the scaled gains, bounded by 0 and 1.
+        model = ider.model
+        initial_guess = ider.initial_guess(model.numerical_gains /
+                                           model.gain_scale_factors)
+
+    ider.identify(initial_guess, multipliers=multipliers)
+
+    return (k, ider.solution[-8:].copy(),
+            ider.model.gain_scale_factors.flatten(), ider.solution,
+            ider.multipliers, int(ider.info['status']), ider.iterations)
+
+
+def identify(measured_states, measured_platform_accel, time_interval,
+             window_nodes, overlap=None, scaled_gains=0.5, penalty=1.0,
+             max_iterations=20, tolerance=1e-4, ipopt_options=None,
+             processes=None):
+    """Returns the gains identified from overlapping windows of a trial by
+    indirect identification via direct collocation.
+
+    Parameters
+    ==========
+    measured_states : ndarray, shape(N, 4)
+        The measured state trajectories.
+    measured_platform_accel : ndarray, shape(N,)
+        The measured platform acceleration.
+    time_interval : float
+        The time in seconds between the samples.
+    window_nodes : integer
+        The number of nodes of each window.
+    overlap : integer, optional
+        The minimum number of nodes shared by neighbouring windows, defaults
+        to a tenth of the window.
+    scaled_gains : float or array_like, shape(2, 4), optional
+        The scaled gains of the model, see QuietStandingModel.
+    penalty : float, optional
+        The ADMM penalty parameter. Half of it is the weight of the squared
+        distance of the window gains from the consensus gains in the window
+        objectives, which are roughly the duration of the window times the
+        sum of the squared state errors.
+    max_iterations : integer, optional
+        The maximum number of consensus iterations after the independent
+        solves. If zero, the gains are the mean of the window gains.
+    tolerance : float, optional
+        The iterations stop when no scaled window gain differs from the
+        consensus gains by more than this.
+    ipopt_options : dictionary, optional
+        The IPOPT options of the window problems.
+    processes : integer, optional
+        The number of worker processes, defaults to the number of cores.
+
+    Returns
+    =======
+    results : dictionary
+        The identified 'gains', shape(8,), the 'window_gains' of the last
+        iteration, shape(w, 8), the 'starts' of the windows, shape(w,), the
+        number of consensus 'iterations', the IPOPT 'status' and
+        'ipopt_iterations' of each window in the last iteration, shape(w,),
+        and the final 'residual', the largest difference between the scaled
+        window and consensus gains.
+
+    """
+
+    num_nodes = measured_states.shape[0]
+
+    window_nodes = min(window_nodes, num_nodes)
+
+    if overlap is None:
+        overlap = window_nodes // 10
+
+    starts = window_starts(num_nodes, window_nodes, overlap)
+    num_windows = len(starts)
+
+    log.info('Identifying the gains from {} windows of {} nodes.'.format(
+        num_windows, window_nodes))
+
+    if ipopt_options is None:
+        ipopt_options = {}
+
+    window_gains = np.zeros((num_windows, 8))
+    offsets = np.zeros((num_windows, 8))
+    consensus = np.zeros(8)
+    solutions = [None] * num_windows
+    multipliers = [None] * num_windows
+    status = np.zeros(num_windows, dtype=int)
+    ipopt_iterations = np.zeros(num_windows, dtype=int)
+    scale_factors = np.ones(8)
+
+    def solve_windows(weight):
+        tasks = ((k,
+                  measured_states[start:start + window_nodes],
+                  measured_platform_accel[start:start + window_nodes],
+                  weight, consensus - offsets[k], solutions[k],
+                  multipliers[k])
+                 for k, start in enumerate(starts))
+        for k, gains, factors, solution, mults, stat, iters in \
+                pool.imap_unordered(_solve_window, tasks):
+            window_gains[k] = gains
+            scale_factors[:] = factors
+            solutions[k] = solution
+            multipliers[k] = mults
+            status[k] = stat
+            ipopt_iterations[k] = iters
+
+    pool = Pool(processes, initializer=_initialize_worker,
+                initargs=(window_nodes, time_interval, scaled_gains,
+                          ipopt_options))
+
+    try:
+        solve_windows(0.0)
+        consensus[:] = window_gains.mean(axis=0)
+        residual = np.max(np.abs(window_gains - consensus))
+
+        iteration = 0
+        while iteration < max_iterations and residual > tolerance:
+            iteration += 1
+            solve_windows(penalty / 2.0)
+            consensus[:] = np.clip((window_gains + offsets).mean(axis=0),
+                                   0.0, 1.0)
+            offsets += window_gains - consensus
+            residual = np.max(np.abs(window_gains - consensus))
+            log.info('Consensus iteration {}, residual {:1.2e}'.format(
+                iteration, residual))
+    finally:
+        pool.terminate()
+
+    return {'gains': scale_factors * consensus,
+            'window_gains': scale_factors * window_gains,
+            'starts': starts,
+            'iterations': iteration,
+            'status': status,
+            'ipopt_iterations': ipopt_iterations,
+            'residual': residual}